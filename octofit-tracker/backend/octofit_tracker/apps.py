@@ -0,0 +1,11 @@
+from django.apps import AppConfig
+from django.core import checks
+
+
+class OctofitTrackerConfig(AppConfig):
+    default_auto_field = 'django.db.models.BigAutoField'
+    name = 'octofit_tracker'
+
+    def ready(self):
+        from .checks import check_mongo_indexes
+        checks.register(check_mongo_indexes, checks.Tags.database)
@@ -4,4 +4,10 @@ from django.core.asgi import get_asgi_application
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'octofit_tracker.settings')
 
-application = get_asgi_application()
\ No newline at end of file
+django_application = get_asgi_application()
+
+# Imported after Django is set up
+from octofit_tracker.async_mongo import lifespan  # noqa: E402
+
+# The lifespan wrapper opens and closes the async MongoDB client per worker
+application = lifespan(django_application)
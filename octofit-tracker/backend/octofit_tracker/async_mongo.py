@@ -0,0 +1,156 @@
+import asyncio
+import contextvars
+import logging
+
+from django.conf import settings
+
+from .memory import MemoryCollection
+from .mongo import connection, get_setting
+
+try:
+    from motor.motor_asyncio import AsyncIOMotorClient
+except ImportError:
+    AsyncIOMotorClient = None
+
+# asyncio access to MongoDB for the async views. Under ASGI the worker's
+# event loop owns a motor client (pinned in requirements.txt), opened and
+# closed by the lifespan protocol (see lifespan() below and asgi.py), so requests
+# waiting on the database hold no thread. Without motor, or on a loop that
+# has no client (e.g. an async view served through WSGI), the synchronous
+# collections are used and blocking pymongo calls run in the loop's thread
+# pool.
+
+logger = logging.getLogger(__name__)
+
+
+class MotorCollection:
+    """The collection methods the async views use, on a motor collection"""
+
+    def __init__(self, collection):
+        self.collection = collection
+
+    @property
+    def name(self):
+        return self.collection.name
+
+    async def find_one(self, filter, projection=None):
+        return await self.collection.find_one(filter, projection)
+
+    async def find_many(self, filter, projection=None, sort=None, limit=0):
+        cursor = self.collection.find(filter, projection, sort=sort, limit=limit)
+        return await cursor.to_list(length=None)
+
+
+class ThreadedCollection:
+    """
+    The same methods on a synchronous collection. pymongo calls run in the
+    event loop's default executor; the in-memory store never blocks on I/O
+    and is called directly.
+    """
+
+    def __init__(self, collection):
+        self.collection = collection
+        self.blocking = not isinstance(collection, MemoryCollection)
+
+    @property
+    def name(self):
+        return self.collection.name
+
+    async def _run(self, function, *args, **kwargs):
+        if not self.blocking:
+            return function(*args, **kwargs)
+        loop = asyncio.get_running_loop()
+        # Carry the request's context variables (e.g. its timings) into the thread
+        context = contextvars.copy_context()
+        return await loop.run_in_executor(None, lambda: context.run(function, *args, **kwargs))
+
+    async def find_one(self, filter, projection=None):
+        return await self._run(self.collection.find_one, filter, projection)
+
+    async def find_many(self, filter, projection=None, sort=None, limit=0):
+        return await self._run(lambda: list(self.collection.find(filter, projection, sort=sort, limit=limit)))
+
+
+class AsyncMongoConnection:
+    """
+    Owns the motor client of the current ASGI worker.
+
+    connect() runs at lifespan startup and close() at shutdown. A motor client
+    is bound to the event loop it was created on, so get_collection() only
+    hands out motor collections on that loop.
+    """
+
+    def __init__(self):
+        self._client = None
+        self._db = None
+        self._loop = None
+
+    @property
+    def client(self):
+        return self._client
+
+    async def connect(self):
+        if self._client is not None:
+            return
+        if AsyncIOMotorClient is None or get_setting('MONGODB_IN_MEMORY'):
+            if AsyncIOMotorClient is None:
+                logger.info("motor is not installed; async views run pymongo calls in threads")
+            # Connect the synchronous manager now rather than in the first request
+            await asyncio.get_running_loop().run_in_executor(None, connection.get_database)
+            return
+        client = AsyncIOMotorClient(settings.MONGODB_HOST, settings.MONGODB_PORT, **connection._client_options())
+        if get_setting('MONGODB_FALLBACK_TO_MOCK'):
+            # Same policy as the synchronous connection manager
+            try:
+                await client.admin.command('ping')
+            except Exception as e:
+                logger.error(f"MongoDB connection error: {e}. Async views use the in-memory document store instead.")
+                client.close()
+                return
+        self._client = client
+        self._db = client[settings.MONGODB_NAME]
+        self._loop = asyncio.get_running_loop()
+        logger.info("Connected the async MongoDB client")
+
+    async def close(self):
+        if self._client is not None:
+            self._client.close()
+        self._client = self._db = self._loop = None
+
+    def get_collection(self, name):
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            loop = None
+        if self._db is not None and loop is self._loop:
+            return MotorCollection(self._db[name])
+        return ThreadedCollection(connection.get_collection(name))
+
+
+# Async connection of the current process
+async_connection = AsyncMongoConnection()
+
+
+def lifespan(application):
+    """
+    Wrap an ASGI application to open the async MongoDB client at lifespan
+    startup and close it at shutdown. Django's own ASGI handler does not
+    implement the lifespan protocol.
+    """
+    async def app(scope, receive, send):
+        if scope['type'] != 'lifespan':
+            return await application(scope, receive, send)
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                try:
+                    await async_connection.connect()
+                except Exception as e:
+                    await send({'type': 'lifespan.startup.failed', 'message': str(e)})
+                    return
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                await async_connection.close()
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+    return app
@@ -0,0 +1,160 @@
+from asgiref.sync import sync_to_async
+from bson import ObjectId
+from bson.errors import InvalidId
+from django.http import HttpResponse
+from pymongo import ASCENDING
+from rest_framework import status
+from rest_framework.exceptions import APIException
+from rest_framework.request import Request
+
+from . import batch, conditional, leaderboard, views
+from .async_mongo import async_connection
+from .cache import response_cache
+from .pagination import KeysetPagination
+from .renderers import FastJSONRenderer
+from .serializers import (
+    UserSerializer, TeamSerializer, ActivitySerializer,
+    LeaderboardSerializer, WorkoutSerializer
+)
+
+# Native async versions of the five resource endpoints, mounted under
+# /api/async/. GET and HEAD read through the asyncio MongoDB client and
+# return the same bodies and headers as the DRF views (keyset pagination,
+# ?ids=, ?fields=, ETags and the response cache where the DRF view has them).
+# Writes and the in-memory leaderboard rankings are handled by the DRF views,
+# run in a thread.
+
+
+def json_response(data, status_code=status.HTTP_200_OK):
+    return HttpResponse(FastJSONRenderer().render(data), content_type='application/json', status=status_code)
+
+
+class AsyncResource:
+    def __init__(self, collection_name, serializer_class, id_kwarg, sync_view, not_found,
+                 ordering=(('_id', ASCENDING),), cached=False, versioned=False, batched=False):
+        self.collection_name = collection_name
+        self.serializer_class = serializer_class
+        self.id_kwarg = id_kwarg
+        self.sync_view = sync_to_async(sync_view.as_view())
+        self.not_found = not_found
+        self.ordering = ordering
+        self.cached = cached
+        self.versioned = versioned
+        self.batched = batched
+
+    def as_view(self):
+        async def view(request, **kwargs):
+            if request.method not in ('GET', 'HEAD') or not self.handles(request):
+                return await self.sync_view(request, **kwargs)
+            try:
+                return await self.get(Request(request), kwargs.get(self.id_kwarg))
+            except APIException as exc:
+                return json_response({'detail': exc.detail}, exc.status_code)
+        # As DRF views are; Django 4.1's csrf_exempt() can't wrap coroutines
+        view.csrf_exempt = True
+        return view
+
+    def handles(self, request):
+        # Reference expansion is left to the DRF views
+        return 'expand' not in request.GET
+
+    async def get(self, request, object_id):
+        cache_key = None
+        if self.cached and response_cache.enabled(self.collection_name):
+            cache_key = response_cache.make_key(self.collection_name, object_id, request.query_params)
+            cached = response_cache.get(cache_key)
+            if cached is not None:
+                return self.cached_response(request, *cached)
+
+        fields = self.serializer_class.fields_from_request(request)
+        projection = self.get_projection(fields)
+        collection = async_connection.get_collection(self.collection_name)
+        paginator = missing = None
+        if object_id:
+            try:
+                document = await collection.find_one({'_id': ObjectId(object_id)}, projection)
+            except InvalidId:
+                return json_response({'detail': 'Invalid ID format'}, status.HTTP_400_BAD_REQUEST)
+            if document is None:
+                return json_response({'detail': self.not_found}, status.HTTP_404_NOT_FOUND)
+            documents = [document]
+        elif self.batched and 'ids' in request.query_params:
+            object_ids = batch.ids_from_query(request)
+            documents = await collection.find_many(batch.query(object_ids), projection)
+            documents, missing = batch.in_request_order(documents, object_ids)
+        else:
+            paginator = KeysetPagination(ordering=self.ordering)
+            query, projection, limit = paginator.prepare_query(request, projection=projection)
+            documents = await collection.find_many(query, projection, sort=paginator.ordering, limit=limit + 1)
+            documents = paginator.trim_page(documents, limit)
+
+        etag = modified = None
+        if self.versioned:
+            next_cursor = paginator.next_cursor if paginator is not None else None
+            etag, modified = conditional.validators(documents, fields, next_cursor=next_cursor)
+            response = conditional.not_modified(request, etag, modified)
+            if response is not None:
+                return conditional.set_validators(response, etag, modified)
+
+        documents = await self.prepare(documents)
+        if object_id:
+            data = self.serializer_class.represent(documents[0], fields)
+        elif missing is not None:
+            data = batch.data(self.serializer_class, documents, missing, fields)
+        else:
+            data = self.serializer_class.represent_many(documents, fields)
+        response = json_response(data)
+        if paginator is not None:
+            paginator.set_link_headers(response)
+        if self.versioned:
+            conditional.set_validators(response, etag, modified)
+        if cache_key is not None:
+            response_cache.set(cache_key, response, data)
+            response['X-Cache'] = 'MISS'
+        return response
+
+    def get_projection(self, fields):
+        projection = self.serializer_class.get_projection(fields)
+        return conditional.with_validator_fields(projection) if self.versioned else projection
+
+    async def prepare(self, documents):
+        return documents
+
+    def cached_response(self, request, data, headers):
+        response = conditional.not_modified(request, *conditional.cached_validators(headers))
+        if response is None:
+            response = json_response(data)
+        for name, value in headers.items():
+            response[name] = value
+        response['X-Cache'] = 'HIT'
+        return response
+
+
+class AsyncLeaderboard(AsyncResource):
+    def handles(self, request):
+        # Ranked and around-user reads come from the in-memory rankings
+        return super().handles(request) and not (request.GET.get('category') or request.GET.get('around'))
+
+    def get_projection(self, fields):
+        projection = super().get_projection(fields)
+        if projection is not None:
+            # Needed to look up the live rank
+            projection.update(score=1, category=1)
+        return projection
+
+    async def prepare(self, documents):
+        # A ranking may have to be (re)loaded from the database
+        return await sync_to_async(lambda: [leaderboard.with_live_rank(entry) for entry in documents],
+                                   thread_sensitive=False)()
+
+
+users = AsyncResource('users', UserSerializer, 'user_id', views.UserViewSet, 'User not found',
+                      cached=True, versioned=True, batched=True)
+teams = AsyncResource('teams', TeamSerializer, 'team_id', views.TeamViewSet, 'Team not found',
+                      cached=True, versioned=True, batched=True)
+activities = AsyncResource('activities', ActivitySerializer, 'activity_id', views.ActivityViewSet,
+                           'Activity not found', ordering=views.ACTIVITY_ORDERING)
+leaderboard_entries = AsyncLeaderboard('leaderboard', LeaderboardSerializer, 'entry_id', views.LeaderboardViewSet,
+                                       'Leaderboard entry not found')
+workouts = AsyncResource('workouts', WorkoutSerializer, 'workout_id', views.WorkoutViewSet, 'Workout not found',
+                         cached=True, versioned=True, batched=True)
@@ -0,0 +1,85 @@
+from bson import ObjectId
+from bson.errors import InvalidId
+from django.conf import settings
+from rest_framework.exceptions import ParseError
+from rest_framework.response import Response
+
+from . import conditional
+
+# Multi-get by id for the list endpoints: GET /api/<resource>/?ids=a,b,c, or
+# POST /api/<resource>/batch/ with {"ids": [...]} for lists too long for a
+# URL. The documents are read with a single $in query and returned in the
+# order the ids were asked for; ids with no document are listed separately:
+#
+#     {"results": [...], "missing": ["..."]}
+
+DEFAULT_MAX_IDS = 1000
+
+
+def max_ids():
+    return getattr(settings, 'API_MAX_BATCH_IDS', DEFAULT_MAX_IDS)
+
+
+def ids_from_query(request):
+    """The ids of a ?ids= request, or None if the parameter is not given"""
+    value = request.query_params.get('ids')
+    if value is None:
+        return None
+    return parse_ids([part.strip() for part in value.split(',') if part.strip()])
+
+
+def ids_from_body(request):
+    ids = request.data.get('ids') if isinstance(request.data, dict) else None
+    if not isinstance(ids, list) or not all(isinstance(value, str) for value in ids):
+        raise ParseError('Expected {"ids": [...]} with a list of id strings')
+    return parse_ids(ids)
+
+
+def parse_ids(ids):
+    """The distinct ids as ObjectIds, in the order first given"""
+    if not ids:
+        raise ParseError('No ids given')
+    object_ids = {}
+    for value in ids:
+        if value not in object_ids:
+            try:
+                object_ids[value] = ObjectId(value)
+            except InvalidId:
+                raise ParseError(f'Invalid ID format: {value}')
+    if len(object_ids) > max_ids():
+        raise ParseError(f'At most {max_ids()} ids can be fetched at once')
+    return list(object_ids.values())
+
+
+def query(object_ids):
+    return {'_id': {'$in': object_ids}}
+
+
+def in_request_order(documents, object_ids):
+    """The documents in the order of `object_ids`, and the ids not found"""
+    by_id = {document['_id']: document for document in documents}
+    found, missing = [], []
+    for object_id in object_ids:
+        document = by_id.get(object_id)
+        if document is None:
+            missing.append(str(object_id))
+        else:
+            found.append(document)
+    return found, missing
+
+
+def get_response(request, collection, serializer_class, object_ids):
+    """Fetch documents by id with one query and build the response"""
+    fields = serializer_class.fields_from_request(request)
+    projection = conditional.with_validator_fields(serializer_class.get_projection(fields))
+    documents = list(collection.find(query(object_ids), projection))
+    documents, missing = in_request_order(documents, object_ids)
+    etag, modified = conditional.validators(documents, fields)
+    response = conditional.not_modified(request, etag, modified)
+    if response is None:
+        response = Response(data(serializer_class, documents, missing, fields))
+    return conditional.set_validators(response, etag, modified)
+
+
+def data(serializer_class, documents, missing, fields=None):
+    return {'results': serializer_class.represent_many(documents, fields), 'missing': missing}
@@ -0,0 +1,263 @@
+import functools
+import os
+import threading
+import time
+from collections import OrderedDict
+from urllib.parse import urlencode
+
+from django.conf import settings
+from rest_framework.response import Response
+
+from . import conditional, metrics
+
+# Read-through cache for the GET handlers of the rarely written resources
+# (users, teams, workouts by default). Responses are cached as serialized
+# data, so content negotiation still happens per request.
+#
+# Entries are keyed on generation numbers that the write handlers bump: one
+# per resource for its lists and one per object for its detail entries. A
+# bump invalidates every variant (any ?limit=, ?cursor=, ?fields=) at once
+# without having to enumerate them, and works the same on a shared cache.
+
+DEFAULT_TIMEOUT = 30
+DEFAULT_MAX_ENTRIES = 1000
+DEFAULT_RESOURCES = ('users', 'teams', 'workouts')
+
+# Response headers stored with the data
+CACHED_HEADERS = ('Link', 'X-Next-Cursor', 'ETag', 'Last-Modified')
+
+_MISSING = object()
+
+
+class LocMemBackend:
+    """Thread-safe in-process LRU cache with per-entry expiry"""
+
+    def __init__(self, max_entries=DEFAULT_MAX_ENTRIES):
+        self.max_entries = max_entries
+        self.evictions = 0
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()  # key -> (expires_at, value)
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return default
+            if entry[0] is not None and entry[0] <= time.monotonic():
+                del self._entries[key]
+                return default
+            self._entries.move_to_end(key)
+            return entry[1]
+
+    def set(self, key, value, timeout=None):
+        expires_at = None if timeout is None else time.monotonic() + timeout
+        with self._lock:
+            self._entries[key] = (expires_at, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def add(self, key, value, timeout=None):
+        with self._lock:
+            if key in self._entries:
+                return False
+        self.set(key, value, timeout)
+        return True
+
+    def incr(self, key):
+        with self._lock:
+            expires_at, value = self._entries[key]
+            self._entries[key] = (expires_at, value + 1)
+            return value + 1
+
+    def delete(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class DjangoCacheBackend:
+    """
+    Stores entries in one of the CACHES configured in settings, e.g. a shared
+    Redis or Memcached instance. Size limits and eviction are that cache's.
+    """
+
+    def __init__(self, alias):
+        from django.core.cache import caches
+        self.cache = caches[alias]
+
+    def get(self, key, default=None):
+        return self.cache.get(key, default)
+
+    def set(self, key, value, timeout=None):
+        self.cache.set(key, value, timeout)
+
+    def add(self, key, value, timeout=None):
+        return self.cache.add(key, value, timeout)
+
+    def incr(self, key):
+        try:
+            return self.cache.incr(key)
+        except ValueError:
+            raise KeyError(key)
+
+    def delete(self, key):
+        self.cache.delete(key)
+
+    def clear(self):
+        self.cache.clear()
+
+
+class ResponseCache:
+    """
+    Cache of GET responses keyed on resource, id and query parameters.
+
+    Settings: API_CACHE_BACKEND ('locmem' or the alias of a Django cache),
+    API_CACHE_TIMEOUT (seconds), API_CACHE_MAX_ENTRIES (locmem only) and
+    API_CACHE_RESOURCES (the resources that are cached at all).
+    """
+    key_prefix = 'octofit:response'
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._backend = None
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    @property
+    def backend(self):
+        if self._backend is None:
+            with self._lock:
+                if self._backend is None:
+                    name = getattr(settings, 'API_CACHE_BACKEND', 'locmem')
+                    if name == 'locmem':
+                        self._backend = LocMemBackend(getattr(settings, 'API_CACHE_MAX_ENTRIES', DEFAULT_MAX_ENTRIES))
+                    else:
+                        self._backend = DjangoCacheBackend(name)
+        return self._backend
+
+    def reset(self):
+        """Drop the backend and counters; the backend is rebuilt from settings on next use"""
+        with self._lock:
+            self._backend = None
+            self.hits = self.misses = self.invalidations = 0
+
+    def after_fork_in_child(self):
+        self._lock = threading.Lock()
+        self._backend = None
+        self.hits = self.misses = self.invalidations = 0
+
+    def enabled(self, resource):
+        return resource in getattr(settings, 'API_CACHE_RESOURCES', DEFAULT_RESOURCES)
+
+    @property
+    def timeout(self):
+        return getattr(settings, 'API_CACHE_TIMEOUT', DEFAULT_TIMEOUT)
+
+    def _generation(self, scope):
+        key = f'{self.key_prefix}:{scope}:generation'
+        generation = self.backend.get(key)
+        if generation is None:
+            # Start from the clock so that a lost generation never comes back
+            # to a number that old entries were stored under
+            self.backend.add(key, time.time_ns(), None)
+            generation = self.backend.get(key)
+        return generation
+
+    def _bump(self, scope):
+        try:
+            self.backend.incr(f'{self.key_prefix}:{scope}:generation')
+        except KeyError:
+            # Nothing was cached under the old generation
+            pass
+
+    def make_key(self, resource, object_id, query_params):
+        query = urlencode(sorted(query_params.lists()), doseq=True)
+        if object_id is None:
+            scope = resource
+            return f'{self.key_prefix}:{resource}:list:{self._generation(scope)}:{query}'
+        scope = f'{resource}:{object_id}'
+        return f'{self.key_prefix}:{resource}:detail:{object_id}:{self._generation(scope)}:{query}'
+
+    def get(self, key):
+        value = self.backend.get(key, _MISSING)
+        if value is _MISSING:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return value
+
+    def set(self, key, response, data=None):
+        """Store a response's data, or the given data for plain Django responses"""
+        headers = {name: response[name] for name in CACHED_HEADERS if response.has_header(name)}
+        self.backend.set(key, (response.data if data is None else data, headers), self.timeout)
+
+    def invalidate(self, resource, object_id=None):
+        """Forget every list of a resource and, if given, one of its objects"""
+        if not self.enabled(resource):
+            return
+        self.invalidations += 1
+        self._bump(resource)
+        if object_id is not None:
+            self._bump(f'{resource}:{object_id}')
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        stats = {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_ratio': round(self.hits / lookups, 4) if lookups else None,
+            'invalidations': self.invalidations,
+        }
+        if isinstance(self.backend, LocMemBackend):
+            stats.update(entries=len(self.backend), evictions=self.backend.evictions)
+        return stats
+
+
+# Response cache of the current process
+response_cache = ResponseCache()
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=response_cache.after_fork_in_child)
+
+
+def cached_response(resource, id_kwarg, uncached_params=()):
+    """
+    Serve a view's GET from the response cache, calling it on a miss. Only
+    200 responses are stored. Adds X-Cache: HIT or MISS. Requests with any of
+    `uncached_params` bypass the cache, for responses that embed data whose
+    writes don't invalidate this resource.
+    """
+    def decorator(method):
+        @functools.wraps(method)
+        def wrapper(view, request, *args, **kwargs):
+            if not response_cache.enabled(resource) or any(name in request.query_params for name in uncached_params):
+                return method(view, request, *args, **kwargs)
+            key = response_cache.make_key(resource, kwargs.get(id_kwarg), request.query_params)
+            cached = response_cache.get(key)
+            if metrics.enabled():
+                metrics.cache_lookups.labels(resource, 'miss' if cached is None else 'hit').inc()
+            if cached is not None:
+                data, headers = cached
+                response = conditional.not_modified(request, *conditional.cached_validators(headers))
+                if response is None:
+                    response = Response(data)
+                for name, value in headers.items():
+                    response[name] = value
+                response['X-Cache'] = 'HIT'
+                return response
+            response = method(view, request, *args, **kwargs)
+            if response.status_code == 200:
+                response_cache.set(key, response)
+            response['X-Cache'] = 'MISS'
+            return response
+        return wrapper
+    return decorator
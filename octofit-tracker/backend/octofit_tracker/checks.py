@@ -0,0 +1,38 @@
+from django.conf import settings
+from django.core import checks
+from pymongo.errors import PyMongoError
+
+from .indexes import registry_drift
+from .mongo import connection
+
+
+def check_mongo_indexes(app_configs, databases=None, **kwargs):
+    """Report declared MongoDB indexes that are missing or differ from the registry"""
+    # Like Django's own database checks, only talk to MongoDB when asked to
+    # with `check --database`, unless the check is enabled for every startup
+    if databases is None and not getattr(settings, 'MONGODB_CHECK_INDEXES_ON_STARTUP', False):
+        return []
+    db = connection.get_database()
+    if db is None:
+        # Running on the in-memory store
+        return []
+    try:
+        drifts = registry_drift(db)
+    except PyMongoError as e:
+        return [checks.Warning(f"Could not read MongoDB indexes: {e}", id='octofit_tracker.W003')]
+
+    messages = []
+    for drift in drifts:
+        for model in drift.missing + drift.mismatched:
+            messages.append(checks.Warning(
+                f"Index {model.document['name']} on {drift.collection} is missing or out of date",
+                hint="Run `python manage.py ensure_indexes`.",
+                id='octofit_tracker.W001',
+            ))
+        for name in drift.unknown:
+            messages.append(checks.Info(
+                f"Index {name} on {drift.collection} is not declared in INDEXES",
+                hint="Run `python manage.py ensure_indexes --reconcile` to drop it.",
+                id='octofit_tracker.I002',
+            ))
+    return messages
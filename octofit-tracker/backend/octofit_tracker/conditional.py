@@ -0,0 +1,147 @@
+import calendar
+import hashlib
+from datetime import datetime
+
+from django.utils.cache import get_conditional_response
+from django.utils.http import http_date, parse_etags, parse_http_date_safe, quote_etag
+from pymongo import ReturnDocument
+from rest_framework import status
+from rest_framework.exceptions import APIException, ParseError
+
+# Conditional request support. Documents carry a `version` counter that every
+# update bumps and an `updated_at` timestamp; ETags are derived from the
+# versions of the documents in a response and the requested fields, so a
+# matching If-None-Match is answered with 304 before anything is serialized.
+# The ETag of a single document also carries its version, so that writes
+# with If-Match can be checked inside the update itself.
+
+# Fields every read must include for the validators to be computed
+VALIDATOR_FIELDS = ('version', 'updated_at')
+
+
+def now():
+    # MongoDB stores milliseconds and HTTP dates seconds
+    return datetime.utcnow().replace(microsecond=0)
+
+
+def versioned_update(document):
+    """$set a document's fields and bump its version"""
+    document = dict(document)
+    document.pop('version', None)
+    document['updated_at'] = now()
+    return {'$set': document, '$inc': {'version': 1}}
+
+
+def with_validator_fields(projection):
+    if projection is None:
+        return None
+    return dict(projection, **{field: 1 for field in VALIDATOR_FIELDS})
+
+
+class PreconditionFailed(APIException):
+    status_code = status.HTTP_412_PRECONDITION_FAILED
+    default_detail = 'The resource has been modified since it was read.'
+    default_code = 'precondition_failed'
+
+
+def make_etag(documents, fields=None, related=None, next_cursor=None):
+    """
+    ETag of one document or a page of documents in a given representation,
+    with `related` the documents embedded in it by ?expand=, if any, and
+    `next_cursor` the cursor of the page after it, if any
+    """
+    digest = hashlib.blake2b(digest_size=12)
+    digest.update(repr(sorted(fields) if fields is not None else None).encode())
+    # The Link and X-Next-Cursor headers are part of a page
+    digest.update(f'next:{next_cursor};'.encode())
+    for document in documents:
+        digest.update(f"{document.get('_id')}:{document.get('version', 0)};".encode())
+    if related is not None:
+        digest.update(b'related;')
+        for document in related:
+            digest.update(f"{document.get('_id')}:{document.get('version', 0)};".encode())
+    if len(documents) == 1:
+        return quote_etag(f"{digest.hexdigest()}.{documents[0].get('version', 0)}")
+    return quote_etag(digest.hexdigest())
+
+
+def etag_version(etag):
+    """The document version in a single-document ETag, or None"""
+    if etag.startswith('W/'):
+        etag = etag[2:]
+    _, _, version = etag.strip('"').rpartition('.')
+    return int(version) if version.isdigit() else None
+
+
+def expected_versions(request):
+    """
+    Versions a write is conditional on, from If-Match or a `version` field in
+    the body, or None for an unconditional write. If-Match: * only requires
+    the document to exist.
+    """
+    header = request.headers.get('If-Match')
+    if header and header.strip() != '*':
+        versions = {etag_version(etag) for etag in parse_etags(header)}
+        if None in versions or not versions:
+            # Can't be the ETag of any version of this document
+            raise PreconditionFailed()
+        return sorted(versions)
+    version = request.data.get('version') if hasattr(request.data, 'get') else None
+    if version is None:
+        return None
+    if isinstance(version, bool) or not isinstance(version, int):
+        raise ParseError('Invalid version')
+    return [version]
+
+
+def last_modified(documents):
+    """Newest updated_at of the documents as a timestamp, or None"""
+    timestamps = [document['updated_at'] for document in documents if document.get('updated_at')]
+    if not timestamps:
+        return None
+    return calendar.timegm(max(timestamps).utctimetuple())
+
+
+def validators(documents, fields=None, related=None, next_cursor=None):
+    return make_etag(documents, fields, related, next_cursor), last_modified(list(documents) + list(related or ()))
+
+
+def not_modified(request, etag, modified):
+    """A 304 response if the request's preconditions match, else None"""
+    return get_conditional_response(request, etag=etag, last_modified=modified)
+
+
+def update_document(collection, object_id, changes, versions=None, versioned=True, return_document=ReturnDocument.AFTER):
+    """
+    Apply `changes` to a document with one find_one_and_update that $sets only
+    those fields, and return the post-image (or the pre-image if asked), or
+    None if there is no such document. Versioned documents also get their
+    version bumped and updated_at set. With `versions`, the update only
+    applies if the stored version is one of them; otherwise PreconditionFailed
+    is raised.
+    """
+    query = {'_id': object_id}
+    if versions is not None:
+        query['version'] = versions[0] if len(versions) == 1 else {'$in': versions}
+    if changes:
+        update = versioned_update(changes) if versioned else {'$set': dict(changes)}
+        document = collection.find_one_and_update(query, update, return_document=return_document)
+    else:
+        # Nothing to write
+        document = collection.find_one(query)
+    if document is None and versions is not None and collection.count_documents({'_id': object_id}, limit=1):
+        raise PreconditionFailed()
+    return document
+
+
+def set_validators(response, etag, modified):
+    response['ETag'] = etag
+    if modified is not None:
+        response['Last-Modified'] = http_date(modified)
+    return response
+
+
+def cached_validators(headers):
+    """ETag and Last-Modified timestamp of a cached response's headers"""
+    modified = headers.get('Last-Modified')
+    return headers.get('ETag'), parse_http_date_safe(modified) if modified else None
@@ -0,0 +1,104 @@
+from rest_framework.exceptions import ParseError
+
+from . import batch, conditional
+from .models import users_collection
+from .serializers import UserSerializer
+
+# Server-side expansion of references (?expand=members on teams, ?expand=user
+# on leaderboard entries). The referenced documents of a whole page are read
+# with one $in query per expansion, projected to the fields their serializer
+# shows, and embedded in the representations:
+#
+#     /api/teams/?expand=members        "members": [{"_id": ..., "username": ...}, ...]
+#     /api/leaderboard/?expand=user     "user_id": "...", "user": {"_id": ..., ...}
+#
+# References to documents that no longer exist are left out of lists and
+# expand to null otherwise.
+
+expand_query_param = 'expand'
+
+
+class Expansion:
+    def __init__(self, name, field, collection, serializer_class, many=False):
+        self.name = name
+        self.field = field
+        self.collection = collection
+        self.serializer_class = serializer_class
+        self.many = many
+
+    def references(self, document):
+        value = document.get(self.field)
+        if self.many:
+            return value or []
+        return [value] if value is not None else []
+
+    def fetch(self, documents):
+        """The referenced documents of a page, by _id"""
+        object_ids = list(dict.fromkeys(
+            object_id for document in documents for object_id in self.references(document)
+        ))
+        if not object_ids:
+            return {}
+        projection = self.serializer_class.get_projection(self.serializer_class.readable_fields())
+        projection = conditional.with_validator_fields(projection)
+        return {related['_id']: related for related in self.collection.find(batch.query(object_ids), projection)}
+
+    def embed(self, document, item, represented):
+        if self.many:
+            item[self.name] = [represented[object_id] for object_id in self.references(document)
+                               if object_id in represented]
+        else:
+            references = self.references(document)
+            item[self.name] = represented.get(references[0]) if references else None
+
+
+TEAM_EXPANSIONS = {
+    'members': Expansion('members', 'members', users_collection, UserSerializer, many=True),
+}
+LEADERBOARD_EXPANSIONS = {
+    'user': Expansion('user', 'user_id', users_collection, UserSerializer),
+}
+
+
+def from_request(request, available):
+    """The expansions asked for with ?expand=, or an empty list"""
+    value = request.query_params.get(expand_query_param)
+    if not value:
+        return []
+    requested = list(dict.fromkeys(name.strip() for name in value.split(',') if name.strip()))
+    unknown = [name for name in requested if name not in available]
+    if unknown:
+        raise ParseError(f"Unknown expansion(s): {', '.join(unknown)}")
+    return [available[name] for name in requested]
+
+
+def with_reference_fields(projection, expansions):
+    """A projection that also reads the fields the expansions follow"""
+    if projection is None or not expansions:
+        return projection
+    return dict(projection, **{expansion.field: 1 for expansion in expansions})
+
+
+def fetch(documents, expansions):
+    """Read the documents a page refers to, with one query per expansion"""
+    return [(expansion, expansion.fetch(documents)) for expansion in expansions]
+
+
+def related(fetched):
+    """The documents read by fetch(), for the response validators, or None without expansions"""
+    if not fetched:
+        return None
+    return [document for _, by_id in fetched for document in by_id.values()]
+
+
+def embed(documents, data, fetched):
+    """
+    Embed the fetched documents in `data`, the representations of `documents`
+    (a list, or the representation of a single document), and return it
+    """
+    items = data if isinstance(data, list) else [data]
+    for expansion, by_id in fetched:
+        represented = dict(zip(by_id, expansion.serializer_class.represent_many(list(by_id.values()))))
+        for document, item in zip(documents, items):
+            expansion.embed(document, item, represented)
+    return data
@@ -0,0 +1,68 @@
+from collections import namedtuple
+
+from .models import INDEXES
+from .mongo import connection
+
+# Index options that change query behaviour; anything else (background, v, ns)
+# does not count as drift
+COMPARED_OPTIONS = ('unique', 'sparse', 'partialFilterExpression', 'expireAfterSeconds')
+
+IndexDrift = namedtuple('IndexDrift', ['collection', 'missing', 'mismatched', 'unknown'])
+
+
+def _signature(document):
+    # IndexModel keeps keys in a SON document, index_information() in a list
+    keys = document['key']
+    if hasattr(keys, 'items'):
+        keys = keys.items()
+    keys = tuple((field, int(direction) if isinstance(direction, float) else direction)
+                 for field, direction in keys)
+    options = tuple((option, document.get(option) or None) for option in COMPARED_OPTIONS)
+    return keys, options
+
+
+def index_drift(collection, index_models):
+    """Compare a collection's indexes with the ones declared for it"""
+    declared = {model.document['name']: model for model in index_models}
+    existing = collection.index_information()
+    existing.pop('_id_', None)
+
+    missing, mismatched = [], []
+    for name, model in declared.items():
+        if name not in existing:
+            missing.append(model)
+        elif _signature(existing[name]) != _signature(model.document):
+            mismatched.append(model)
+    unknown = sorted(name for name in existing if name not in declared)
+    return IndexDrift(collection.name, missing, mismatched, unknown)
+
+
+def registry_drift(db=None, registry=None):
+    """Return the drift of every collection in the registry that has any"""
+    db = db if db is not None else connection.get_database()
+    registry = registry if registry is not None else INDEXES
+    drifts = []
+    for collection_name, index_models in registry.items():
+        drift = index_drift(db[collection_name], index_models)
+        if drift.missing or drift.mismatched or drift.unknown:
+            drifts.append(drift)
+    return drifts
+
+
+def apply_drift(db, drift, reconcile=False):
+    """
+    Create missing indexes. With reconcile, also rebuild mismatched indexes
+    and drop indexes that are not in the registry.
+    """
+    collection = db[drift.collection]
+    if reconcile:
+        for model in drift.mismatched:
+            collection.drop_index(model.document['name'])
+        for name in drift.unknown:
+            collection.drop_index(name)
+        to_create = drift.missing + drift.mismatched
+    else:
+        to_create = drift.missing
+    if to_create:
+        collection.create_indexes(to_create)
+    return [model.document['name'] for model in to_create]
@@ -0,0 +1,189 @@
+import asyncio
+import contextlib
+import logging
+import time
+from contextvars import ContextVar
+
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+from pymongo import monitoring
+
+# Per-request timings (API_REQUEST_TIMING). RequestTimingMiddleware opens a
+# RequestTimings for each request in a context variable, and while it is open
+# the MongoDB command listener and the measured phases add to it:
+#
+#     db         commands sent, their total and longest duration and the
+#                documents they returned (from pymongo command monitoring)
+#     serialize  documents -> representations (the serializers' represent paths)
+#     render     representations -> response body (the renderers)
+#
+# The totals are sent back in a Server-Timing header and logged as one line
+# per request on this module's logger. With the setting off the middleware
+# removes itself, no listener is attached to the MongoClient and measure()
+# returns a shared no-op context manager.
+#
+# Commands are only seen from MongoDB itself: the in-memory store sends none.
+
+logger = logging.getLogger(__name__)
+
+_current = ContextVar('octofit_request_timings', default=None)
+
+# Reused by every measure() made outside a timed request
+_NOT_MEASURED = contextlib.nullcontext()
+
+PHASES = ('serialize', 'render')
+
+
+def enabled():
+    return getattr(settings, 'API_REQUEST_TIMING', False)
+
+
+class RequestTimings:
+    __slots__ = ('started', 'db_commands', 'db_seconds', 'db_max_seconds', 'db_documents', 'phases')
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.db_commands = 0
+        self.db_seconds = 0.0
+        self.db_max_seconds = 0.0
+        self.db_documents = 0
+        self.phases = dict.fromkeys(PHASES, 0.0)
+
+    def add_command(self, seconds, documents=0):
+        self.db_commands += 1
+        self.db_seconds += seconds
+        if seconds > self.db_max_seconds:
+            self.db_max_seconds = seconds
+        self.db_documents += documents
+
+    def as_dict(self, total_seconds):
+        return dict({
+            'total_ms': round(total_seconds * 1000, 3),
+            'db_commands': self.db_commands,
+            'db_ms': round(self.db_seconds * 1000, 3),
+            'db_max_ms': round(self.db_max_seconds * 1000, 3),
+            'db_documents': self.db_documents,
+        }, **{f'{phase}_ms': round(seconds * 1000, 3) for phase, seconds in self.phases.items()})
+
+    def server_timing(self, total_seconds):
+        """Value of the Server-Timing header"""
+        metrics = [
+            f'db;dur={self.db_seconds * 1000:.3f};desc="{self.db_commands} commands, {self.db_documents} documents"',
+            f'db-max;dur={self.db_max_seconds * 1000:.3f}',
+        ]
+        metrics += [f'{phase};dur={seconds * 1000:.3f}' for phase, seconds in self.phases.items()]
+        metrics.append(f'total;dur={total_seconds * 1000:.3f}')
+        return ', '.join(metrics)
+
+
+def current():
+    """The RequestTimings of the request being handled, or None"""
+    return _current.get()
+
+
+class _Phase:
+    __slots__ = ('timings', 'phase', 'started')
+
+    def __init__(self, timings, phase):
+        self.timings = timings
+        self.phase = phase
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+
+    def __exit__(self, *exc_info):
+        self.timings.phases[self.phase] += time.perf_counter() - self.started
+
+
+def measure(phase):
+    """Context manager adding its duration to a phase of the current request"""
+    timings = _current.get()
+    if timings is None:
+        return _NOT_MEASURED
+    return _Phase(timings, phase)
+
+
+def _returned_documents(reply):
+    cursor = reply.get('cursor') if isinstance(reply, dict) else None
+    if not isinstance(cursor, dict):
+        return 0
+    return len(cursor.get('firstBatch') or cursor.get('nextBatch') or ())
+
+
+class CommandTimingListener(monitoring.CommandListener):
+    """
+    Adds every command that completes during a timed request to its
+    RequestTimings. pymongo calls listeners synchronously in the thread that
+    ran the command, so the request's context variable is visible here.
+    """
+
+    def started(self, event):
+        pass
+
+    def succeeded(self, event):
+        timings = _current.get()
+        if timings is not None:
+            timings.add_command(event.duration_micros / 1e6, _returned_documents(event.reply))
+
+    def failed(self, event):
+        timings = _current.get()
+        if timings is not None:
+            timings.add_command(event.duration_micros / 1e6)
+
+
+command_listener = CommandTimingListener()
+
+
+def event_listeners():
+    """The event_listeners option for new MongoClients"""
+    return [command_listener] if enabled() else []
+
+
+class RequestTimingMiddleware:
+    """
+    Times each request and reports it in a Server-Timing header and a log
+    line. Works in both sync and async middleware chains, so async views
+    stay async under ASGI.
+    """
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        if not enabled():
+            raise MiddlewareNotUsed
+        self.get_response = get_response
+        if asyncio.iscoroutinefunction(get_response):
+            # Mark the instance as a coroutine function, as Django's MiddlewareMixin does
+            self._is_coroutine = asyncio.coroutines._is_coroutine
+
+    def __call__(self, request):
+        if asyncio.iscoroutinefunction(self.get_response):
+            return self.__acall__(request)
+        timings = RequestTimings()
+        token = _current.set(timings)
+        try:
+            response = self.get_response(request)
+        finally:
+            _current.reset(token)
+        return self.report(request, response, timings)
+
+    async def __acall__(self, request):
+        timings = RequestTimings()
+        token = _current.set(timings)
+        try:
+            response = await self.get_response(request)
+        finally:
+            _current.reset(token)
+        return self.report(request, response, timings)
+
+    def report(self, request, response, timings):
+        total = time.perf_counter() - timings.started
+        response['Server-Timing'] = timings.server_timing(total)
+        values = timings.as_dict(total)
+        logger.info(
+            'request method=%s path=%s status=%s %s',
+            request.method, request.path, response.status_code,
+            ' '.join(f'{key}={value}' for key, value in values.items()),
+            extra={'timings': dict(values, method=request.method, path=request.path, status=response.status_code)},
+        )
+        return response
@@ -0,0 +1,347 @@
+import logging
+import os
+import threading
+import time
+from bisect import bisect_left, bisect_right, insort
+from collections import defaultdict
+from datetime import datetime
+
+from django.conf import settings
+from pymongo import DESCENDING, UpdateOne
+
+from .models import activities_collection, leaderboard_collection
+
+# Server-computed leaderboard. Scores are the calories burned per user, per
+# activity type and overall; ranks are dense (equal scores share a rank).
+#
+# Every activity write applies its score delta to the leaderboard collection
+# with $inc, and each process keeps an in-memory ranking per category (sorted
+# arrays + bisect) so that rank lookups are O(log n) and reads never scan the
+# collection. rebuild() recomputes everything with an aggregation pipeline
+# ($setWindowFields and $unionWith need MongoDB 5.0 or later).
+
+logger = logging.getLogger(__name__)
+
+OVERALL = 'OVERALL'
+
+# Activity field summed into a user's score
+SCORE_FIELD = 'calories'
+
+
+def activity_category(activity):
+    return (activity.get('activity_type') or '').upper()
+
+
+def _group_scores(category_expression):
+    return {'$group': {
+        '_id': {'user_id': '$user_id', 'category': category_expression},
+        'score': {'$sum': f'${SCORE_FIELD}'},
+    }}
+
+
+def leaderboard_pipeline(computed_at, into=None):
+    """Aggregation over activities producing one ranked entry per user and category"""
+    into = into or leaderboard_collection.name
+    return [
+        _group_scores({'$toUpper': '$activity_type'}),
+        {'$unionWith': {'coll': activities_collection.name, 'pipeline': [_group_scores(OVERALL)]}},
+        # Users with nothing to score have no entry, as with incremental updates
+        {'$match': {'score': {'$ne': 0}}},
+        {'$setWindowFields': {
+            'partitionBy': '$_id.category',
+            'sortBy': {'score': DESCENDING},
+            'output': {'rank': {'$denseRank': {}}},
+        }},
+        {'$project': {
+            '_id': 0,
+            'user_id': '$_id.user_id',
+            'category': '$_id.category',
+            'score': 1,
+            'rank': 1,
+            'computed_at': {'$literal': computed_at},
+        }},
+        # Entries keep their _id across rebuilds; relies on the unique
+        # (user_id, category) index from models.INDEXES
+        {'$merge': {
+            'into': into,
+            'on': ['user_id', 'category'],
+            'whenMatched': 'merge',
+            'whenNotMatched': 'insert',
+        }},
+    ]
+
+
+def rebuild():
+    """
+    Recompute the whole leaderboard from activities.
+
+    Returns the number of entries in the rebuilt leaderboard. Entries that the
+    run did not produce (users with no activities left, manual entries) are
+    removed, except those upserted by activity writes during the run: these
+    are stamped with a later computed_at. An activity written while the
+    pipeline runs may still be counted twice or not at all in the merged
+    scores; `manage.py reconcile_leaderboard --fix` repairs that.
+    """
+    # MongoDB stores milliseconds; whole seconds compare equal after the round trip
+    computed_at = datetime.utcnow().replace(microsecond=0)
+    activities_collection.aggregate(leaderboard_pipeline(computed_at), allowDiskUse=True)
+    leaderboard_collection.delete_many({'$or': [
+        {'computed_at': {'$lt': computed_at}},
+        {'computed_at': {'$exists': False}},
+    ]})
+    rankings.reset()
+    return leaderboard_collection.count_documents({})
+
+
+def recompute_scores():
+    """Full recomputation of every (user_id, category) score, for reconciliation"""
+    scores = defaultdict(int)
+    pipeline = [_group_scores({'$toUpper': '$activity_type'})]
+    for group in activities_collection.aggregate(pipeline, allowDiskUse=True):
+        user_id, category = group['_id']['user_id'], group['_id']['category']
+        scores[(user_id, category)] += group['score']
+        scores[(user_id, OVERALL)] += group['score']
+    return {key: score for key, score in scores.items() if score != 0}
+
+
+class CategoryRanking:
+    """
+    Order-statistics index over the scores of one category.
+
+    `entries` holds (-score, user_id) sorted best first and `distinct_scores`
+    every distinct score in ascending order, so the dense rank of a score is
+    one bisect and a user's neighbours are a slice.
+    """
+
+    def __init__(self, category):
+        self.category = category
+        self.entries = []
+        self.distinct_scores = []
+        self.score_counts = defaultdict(int)
+        self.users = {}  # user_id -> (score, entry _id)
+
+    def __len__(self):
+        return len(self.entries)
+
+    def set_score(self, user_id, score, entry_id=None):
+        previous = self.users.get(user_id)
+        if previous is not None:
+            if entry_id is None:
+                entry_id = previous[1]
+            self._remove(user_id, previous[0])
+        self.users[user_id] = (score, entry_id)
+        insort(self.entries, (-score, user_id))
+        if self.score_counts[score] == 0:
+            insort(self.distinct_scores, score)
+        self.score_counts[score] += 1
+
+    def remove(self, user_id):
+        previous = self.users.pop(user_id, None)
+        if previous is not None:
+            self._remove(user_id, previous[0])
+
+    def _remove(self, user_id, score):
+        del self.entries[bisect_left(self.entries, (-score, user_id))]
+        self.score_counts[score] -= 1
+        if self.score_counts[score] == 0:
+            del self.score_counts[score]
+            del self.distinct_scores[bisect_left(self.distinct_scores, score)]
+
+    def rank_of_score(self, score):
+        """Dense rank: one more than the number of distinct higher scores"""
+        return len(self.distinct_scores) - bisect_right(self.distinct_scores, score) + 1
+
+    def rank(self, user_id):
+        entry = self.users.get(user_id)
+        return None if entry is None else self.rank_of_score(entry[0])
+
+    def _document(self, user_id):
+        score, entry_id = self.users[user_id]
+        return {
+            '_id': entry_id,
+            'user_id': user_id,
+            'category': self.category,
+            'score': score,
+            'rank': self.rank_of_score(score),
+        }
+
+    def page(self, limit, after=None):
+        """Up to `limit` entries best first, starting after the (score, user_id) key"""
+        start = 0 if after is None else bisect_right(self.entries, (-after[0], after[1]))
+        return [self._document(user_id) for _, user_id in self.entries[start:start + limit]]
+
+    def around(self, user_id, window):
+        """The user's entry with up to `window` entries on either side, or None"""
+        if user_id not in self.users:
+            return None
+        position = bisect_left(self.entries, (-self.users[user_id][0], user_id))
+        return [
+            self._document(neighbour)
+            for _, neighbour in self.entries[max(0, position - window):position + window + 1]
+        ]
+
+
+class LeaderboardRankings:
+    """
+    Per-process rankings of every category, loaded from the leaderboard
+    collection on first use.
+
+    Writes made by this process update the rankings immediately. Writes made
+    by other worker processes show up when a category is reloaded, every
+    LEADERBOARD_RANKING_REFRESH_SECONDS (None to never reload).
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._categories = {}
+        # Category -> Event set when its load in progress completes
+        self._loading = {}
+
+    def reset(self):
+        with self._lock:
+            self._categories = {}
+            self._loading = {}
+
+    def after_fork_in_child(self):
+        self._lock = threading.Lock()
+        self._categories = {}
+        self._loading = {}
+
+    def _load(self, category):
+        ranking = CategoryRanking(category)
+        cursor = leaderboard_collection.find({'category': category}, {'user_id': 1, 'score': 1})
+        for entry in cursor:
+            ranking.set_score(entry['user_id'], entry.get('score', 0), entry['_id'])
+        return ranking
+
+    def _fresh(self, loaded):
+        refresh = getattr(settings, 'LEADERBOARD_RANKING_REFRESH_SECONDS', 60)
+        return loaded is not None and (refresh is None or time.monotonic() - loaded[1] < refresh)
+
+    def category(self, category):
+        """
+        The ranking of a category, (re)loading it when missing or expired.
+        Loads are single-flight: while one request reloads a category, the
+        others keep serving its expired ranking, or wait for a first load.
+        """
+        loaded = self._categories.get(category)
+        if self._fresh(loaded):
+            return loaded[0]
+        with self._lock:
+            loaded = self._categories.get(category)
+            if self._fresh(loaded):
+                return loaded[0]
+            waiting = self._loading.get(category)
+            if waiting is None:
+                loading = self._loading[category] = threading.Event()
+            elif loaded is not None:
+                return loaded[0]
+        if waiting is not None:
+            waiting.wait()
+            # Loaded by now, or the load failed and this request retries it
+            return self.category(category)
+        try:
+            ranking = self._load(category)
+            with self._lock:
+                if self._loading.get(category) is loading:
+                    self._categories[category] = (ranking, time.monotonic())
+        finally:
+            with self._lock:
+                if self._loading.get(category) is loading:
+                    del self._loading[category]
+            loading.set()
+        return ranking
+
+    def page(self, category, limit, after=None):
+        ranking = self.category(category)
+        with self._lock:
+            return ranking.page(limit, after)
+
+    def around(self, category, user_id, window):
+        ranking = self.category(category)
+        with self._lock:
+            return ranking.around(user_id, window)
+
+    def rank_of_score(self, category, score):
+        ranking = self.category(category)
+        with self._lock:
+            return ranking.rank_of_score(score)
+
+    def apply(self, category, user_id, score, entry_id):
+        with self._lock:
+            loaded = self._categories.get(category)
+            if loaded is None:
+                # Not loaded yet; the first read will pick the new score up
+                return
+            if score == 0:
+                loaded[0].remove(user_id)
+            else:
+                loaded[0].set_score(user_id, score, entry_id)
+
+
+# Rankings of the current process
+rankings = LeaderboardRankings()
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=rankings.after_fork_in_child)
+
+
+def with_live_rank(entry):
+    """Replace the stored rank of a leaderboard document with its current rank"""
+    if 'score' in entry and 'category' in entry:
+        entry['rank'] = rankings.rank_of_score(entry['category'], entry['score'])
+    return entry
+
+
+def score_deltas(removed=(), added=()):
+    """Score change of every (user_id, category) touched by the given activities"""
+    deltas = defaultdict(int)
+    for activities, sign in ((removed, -1), (added, 1)):
+        for activity in activities:
+            if activity.get('user_id') is None:
+                continue
+            points = sign * (activity.get(SCORE_FIELD) or 0)
+            deltas[(activity['user_id'], activity_category(activity))] += points
+            deltas[(activity['user_id'], OVERALL)] += points
+    return {key: delta for key, delta in deltas.items() if delta}
+
+
+def apply_score_deltas(deltas):
+    """
+    $inc the leaderboard entries by the given deltas in one bulk write and
+    bring this process's rankings up to date with the resulting scores.
+    """
+    if not deltas:
+        return
+    now = datetime.utcnow()
+    leaderboard_collection.bulk_write([
+        UpdateOne(
+            {'user_id': user_id, 'category': category},
+            # A concurrent rebuild() keeps entries created after it started
+            {'$inc': {'score': delta}, '$setOnInsert': {'computed_at': now}}, upsert=True
+        )
+        for (user_id, category), delta in deltas.items()
+    ], ordered=False)
+    keys = [{'user_id': user_id, 'category': category} for user_id, category in deltas]
+    emptied = []
+    for entry in leaderboard_collection.find({'$or': keys}, {'user_id': 1, 'category': 1, 'score': 1}):
+        score = entry.get('score', 0)
+        rankings.apply(entry['category'], entry['user_id'], score, entry['_id'])
+        if score == 0:
+            emptied.append(entry['_id'])
+    if emptied:
+        leaderboard_collection.delete_many({'_id': {'$in': emptied}, 'score': 0})
+
+
+def record_activity_changes(removed=(), added=()):
+    """
+    Apply the score changes of written activities. A failure here is logged
+    rather than raised: the activity itself is already stored, and
+    `manage.py reconcile_leaderboard --fix` repairs any drift.
+    """
+    if not getattr(settings, 'LEADERBOARD_INCREMENTAL_UPDATES', True):
+        return
+    try:
+        apply_score_deltas(score_deltas(removed, added))
+    except Exception:
+        logger.exception("Failed to apply leaderboard score changes")
@@ -0,0 +1,154 @@
+import asyncio
+import io
+import statistics
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from urllib.parse import urlsplit
+
+from django.core.management.base import BaseCommand, CommandError
+from octofit_tracker import synthetic
+from octofit_tracker.models import activities_collection, users_collection
+from octofit_tracker.mongo import connection
+
+
+class Command(BaseCommand):
+    help = (
+        'Compare the throughput of a list endpoint on the WSGI path (DRF views, a thread per request) '
+        'and the ASGI path (async views on one event loop) with slow clients, in-process'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--requests', type=int, default=2000, help='Requests per path (default: 2000)')
+        parser.add_argument('--threads', type=int, default=32, help='WSGI worker threads (default: 32)')
+        parser.add_argument('--concurrency', type=int, default=1000,
+                            help='Concurrent ASGI connections (default: 1000)')
+        parser.add_argument('--client-delay', type=float, default=0.5,
+                            help='Seconds each client takes to read its response (default: 0.5)')
+        parser.add_argument('--resource', default='users', help='Resource to list (default: users)')
+        parser.add_argument('--query', default='limit=20', help='Query string of the list requests')
+
+    def handle(self, *args, **options):
+        if min(options['requests'], options['threads'], options['concurrency']) <= 0:
+            raise CommandError('--requests, --threads and --concurrency must be positive')
+        if connection.get_database() is None:
+            self.seed_memory_store()
+
+        sync_path = f"/api/{options['resource']}/?{options['query']}"
+        async_path = f"/api/async/{options['resource']}/?{options['query']}"
+        self.stdout.write(f"{options['requests']} requests, {options['client_delay']}s per client read")
+        self.stdout.write(f"{'path':<36}{'req/s':>10}{'p50 ms':>10}{'p99 ms':>10}")
+        wsgi = self.run_wsgi(sync_path, options)
+        self.report(f"WSGI, {options['threads']} threads", wsgi, options)
+        asgi = asyncio.run(self.run_asgi(async_path, options))
+        self.report(f"ASGI, {options['concurrency']} connections", asgi, options)
+        self.stdout.write(self.style.SUCCESS(
+            f'ASGI served {(len(asgi[1]) / asgi[0]) / (len(wsgi[1]) / wsgi[0]):.1f}x the requests per second'
+        ))
+
+    def seed_memory_store(self):
+        self.stdout.write('No MongoDB server; seeding the in-memory store with synthetic data')
+        start = datetime(2024, 1, 1)
+        users_collection.insert_many([synthetic.generate_user(42, index, start) for index in range(500)])
+        activities_collection.insert_many(synthetic.sample_activities(5000, 42, start))
+
+    def report(self, name, result, options):
+        elapsed, latencies = result
+        latencies = sorted(latencies)
+        p99 = latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))]
+        self.stdout.write(
+            f'{name:<36}{len(latencies) / elapsed:>10.0f}'
+            f'{statistics.median(latencies) * 1000:>10.1f}{p99 * 1000:>10.1f}'
+        )
+
+    def run_wsgi(self, path, options):
+        from octofit_tracker.wsgi import application
+        url = urlsplit(path)
+        delay = options['client_delay']
+
+        def request(_):
+            started = time.perf_counter()
+            environ = {
+                'REQUEST_METHOD': 'GET', 'PATH_INFO': url.path, 'QUERY_STRING': url.query,
+                'SERVER_NAME': 'localhost', 'SERVER_PORT': '8000', 'HTTP_HOST': 'localhost',
+                'SERVER_PROTOCOL': 'HTTP/1.1', 'wsgi.version': (1, 0), 'wsgi.url_scheme': 'http',
+                'wsgi.input': io.BytesIO(), 'wsgi.errors': sys.stderr, 'wsgi.multithread': True,
+                'wsgi.multiprocess': False, 'wsgi.run_once': False,
+            }
+            statuses = []
+            body = b''.join(application(environ, lambda status, headers, exc_info=None: statuses.append(status)))
+            if not statuses[0].startswith('200'):
+                raise CommandError(f'{path}: {statuses[0]} {body[:200]!r}')
+            # The worker thread is busy until the client has read the response
+            time.sleep(delay)
+            return time.perf_counter() - started
+
+        started = time.perf_counter()
+        with ThreadPoolExecutor(options['threads']) as executor:
+            latencies = list(executor.map(request, range(options['requests'])))
+        return time.perf_counter() - started, latencies
+
+    async def run_asgi(self, path, options):
+        from octofit_tracker.asgi import application
+        url = urlsplit(path)
+        delay = options['client_delay']
+        slots = asyncio.Semaphore(options['concurrency'])
+        scope = {
+            'type': 'http', 'asgi': {'version': '3.0'}, 'http_version': '1.1', 'method': 'GET',
+            'scheme': 'http', 'path': url.path, 'raw_path': url.path.encode(), 'root_path': '',
+            'query_string': url.query.encode(), 'headers': [(b'host', b'localhost')],
+            'client': ('127.0.0.1', 50000), 'server': ('localhost', 8000),
+        }
+
+        async def request():
+            async with slots:
+                started = time.perf_counter()
+                received = asyncio.Event()
+                response = {}
+
+                async def receive():
+                    if not received.is_set():
+                        received.set()
+                        return {'type': 'http.request', 'body': b'', 'more_body': False}
+                    # The client stays connected
+                    await asyncio.Future()
+
+                async def send(message):
+                    if message['type'] == 'http.response.start':
+                        response['status'] = message['status']
+                    elif not message.get('more_body'):
+                        # Reading the response only suspends this connection
+                        await asyncio.sleep(delay)
+
+                await application(dict(scope), receive, send)
+                if response.get('status') != 200:
+                    raise CommandError(f"{path}: {response.get('status')}")
+                return time.perf_counter() - started
+
+        await self.lifespan(application, 'startup')
+        try:
+            started = time.perf_counter()
+            latencies = await asyncio.gather(*(request() for _ in range(options['requests'])))
+            return time.perf_counter() - started, latencies
+        finally:
+            await self.lifespan(application, 'shutdown')
+
+    async def lifespan(self, application, event):
+        """Send one lifespan event as an ASGI server would"""
+        messages = asyncio.Queue()
+        await messages.put({'type': f'lifespan.{event}'})
+        replies = []
+
+        async def send(message):
+            replies.append(message)
+
+        async def receive():
+            return await messages.get()
+
+        task = asyncio.ensure_future(application({'type': 'lifespan', 'asgi': {'version': '3.0'}}, receive, send))
+        while not replies:
+            await asyncio.sleep(0.001)
+        task.cancel()
+        if replies[0]['type'].endswith('failed'):
+            raise CommandError(f"Lifespan {event} failed: {replies[0].get('message')}")
@@ -0,0 +1,381 @@
+import gc
+import json
+import math
+import platform
+import random
+import statistics
+import sys
+import time
+from collections import namedtuple
+from datetime import datetime
+
+import django
+from bson import ObjectId
+from django.core.management.base import BaseCommand, CommandError
+from django.test import Client
+from django.test.utils import override_settings
+from django.urls import get_resolver, reverse
+from octofit_tracker import leaderboard, rollups, synthetic
+from octofit_tracker.cache import response_cache
+from octofit_tracker.models import (
+    Activity, Leaderboard, Team, User, Workout,
+    users_collection, teams_collection, activities_collection,
+    leaderboard_collection, workouts_collection, rollups_collection
+)
+from octofit_tracker.mongo import connection
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+# One benchmarked request type: `build(dataset, index)` returns the path and
+# JSON body of the index-th request; building it is not timed. Reads run
+# first, then creates and updates, then deletes.
+Scenario = namedtuple('Scenario', ['route', 'operation', 'method', 'expected_status', 'build'])
+
+READ, WRITE, DELETE = range(3)
+
+PHASES = {'GET': READ, 'POST': WRITE, 'PUT': WRITE, 'DELETE': DELETE}
+
+# Metrics compared with the baseline: 1 if higher is worse, -1 if lower is
+METRICS = {'p50_ms': 1, 'p95_ms': 1, 'p99_ms': 1, 'throughput': -1}
+
+# Token the benchmark client presents to /api/cache/stats/
+CACHE_STATS_TOKEN = 'benchmark'
+
+
+class Dataset:
+    """Ids of the seeded documents, handed out to the scenarios"""
+
+    def __init__(self, seed):
+        self.rng = random.Random(seed)
+        self.ids = {}
+        self.created = 0
+
+    def pick(self, kind):
+        return str(self.rng.choice(self.ids[kind]))
+
+    def sample(self, kind, count):
+        return [str(object_id) for object_id in self.rng.sample(self.ids[kind], min(count, len(self.ids[kind])))]
+
+    def victim(self, kind):
+        """
+        Insert a new document for a delete to remove, as the API's create
+        would have stored it, so that deletes never run out of documents and
+        leave the seeded data as it was
+        """
+        collection, build = VICTIMS[kind]
+        document = build(self).to_mongo()
+        collection.insert_one(document)
+        if kind == 'activities':
+            leaderboard.record_activity_changes(added=[document])
+            rollups.record_activity_changes(added=[document])
+        return str(document['_id'])
+
+    def unique(self):
+        self.created += 1
+        return f'bench{self.created:08d}'
+
+
+def new_activity(dataset):
+    return {
+        'user_id': dataset.pick('users'), 'activity_type': 'Running', 'duration': 30,
+        'calories': 300, 'distance': 5000.0, 'date': '2024-06-01T07:30:00Z',
+    }
+
+
+def new_user(dataset):
+    name = dataset.unique()
+    return {'username': name, 'email': f'{name}@example.com', 'password': 'password123'}
+
+
+VICTIMS = {
+    'users': (users_collection, lambda d: User(**new_user(d))),
+    'teams': (teams_collection, lambda d: Team(name=d.unique())),
+    'activities': (activities_collection, lambda d: Activity(
+        user_id=ObjectId(d.pick('users')), activity_type='Running', duration=30, calories=300,
+        distance=5000.0, date=datetime(2024, 6, 1, 7, 30),
+    )),
+    'workouts': (workouts_collection, lambda d: Workout(name=d.unique())),
+}
+
+
+def resource_scenarios(kind, singular, create=None, update=None, batched=True):
+    """List and detail of one resource, and its create, update and delete unless read-only"""
+    scenarios = [
+        Scenario(f'{singular}-list', 'list', 'GET', 200, lambda d, i: (reverse(f'{singular}-list') + '?limit=20', None)),
+        Scenario(f'{singular}-detail', 'detail', 'GET', 200,
+                 lambda d, i: (reverse(f'{singular}-detail', args=[d.pick(kind)]), None)),
+        Scenario(f'async-{singular}-list', 'list', 'GET', 200,
+                 lambda d, i: (reverse(f'async-{singular}-list') + '?limit=20', None)),
+        Scenario(f'async-{singular}-detail', 'detail', 'GET', 200,
+                 lambda d, i: (reverse(f'async-{singular}-detail', args=[d.pick(kind)]), None)),
+    ]
+    if create is not None:
+        scenarios += [
+            Scenario(f'{singular}-list', 'create', 'POST', 201, lambda d, i: (reverse(f'{singular}-list'), create(d))),
+            Scenario(f'{singular}-detail', 'update', 'PUT', 200,
+                     lambda d, i: (reverse(f'{singular}-detail', args=[d.pick(kind)]), update(d))),
+            Scenario(f'{singular}-detail', 'delete', 'DELETE', 204,
+                     lambda d, i: (reverse(f'{singular}-detail', args=[d.victim(kind)]), None)),
+        ]
+    if batched:
+        scenarios += [
+            Scenario(f'{singular}-list', 'multi-get', 'GET', 200,
+                     lambda d, i: (reverse(f'{singular}-list') + '?ids=' + ','.join(d.sample(kind, 20)), None)),
+            Scenario(f'{singular}-batch', 'multi-get', 'POST', 200,
+                     lambda d, i: (reverse(f'{singular}-batch'), {'ids': d.sample(kind, 20)})),
+        ]
+    return scenarios
+
+
+SCENARIOS = [
+    Scenario('api-root', 'root', 'GET', 200, lambda d, i: (reverse('api-root'), None)),
+    Scenario('cache-stats', 'stats', 'GET', 200, lambda d, i: (reverse('cache-stats'), None)),
+    Scenario('metrics', 'scrape', 'GET', 200, lambda d, i: (reverse('metrics'), None)),
+    *resource_scenarios('users', 'user', new_user, lambda d: {'first_name': d.unique()}),
+    Scenario('user-stats', 'stats', 'GET', 200,
+             lambda d, i: (reverse('user-stats', args=[d.pick('users')]) + '?granularity=week', None)),
+    *resource_scenarios('teams', 'team', lambda d: {'name': d.unique(), 'members': d.sample('users', 5)},
+                        lambda d: {'description': d.unique()}),
+    Scenario('team-list', 'expand', 'GET', 200, lambda d, i: (reverse('team-list') + '?limit=20&expand=members', None)),
+    *resource_scenarios('activities', 'activity', new_activity, lambda d: {'duration': 45}, batched=False),
+    Scenario('activity-bulk', 'create', 'POST', 201,
+             lambda d, i: (reverse('activity-bulk'), [new_activity(d) for _ in range(100)])),
+    Scenario('activity-export', 'export', 'GET', 200,
+             lambda d, i: (reverse('activity-export') + f"?user_id={d.pick('users')}", None)),
+    *resource_scenarios('leaderboard', 'leaderboard', batched=False),
+    Scenario('leaderboard-list', 'ranked', 'GET', 200,
+             lambda d, i: (reverse('leaderboard-list') + '?category=OVERALL&limit=20&expand=user', None)),
+    *resource_scenarios('workouts', 'workout', lambda d: {'name': d.unique(), 'duration': 30},
+                        lambda d: {'difficulty': 'hard'}),
+]
+
+
+def percentile(ordered, percent):
+    """Nearest-rank percentile of sorted values"""
+    return ordered[max(0, math.ceil(percent / 100 * len(ordered)) - 1)]
+
+
+def peak_rss_mb():
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Kilobytes on Linux, bytes on macOS
+    return round(peak / (1024 * 1024 if sys.platform == 'darwin' else 1024), 1)
+
+
+class Command(BaseCommand):
+    help = (
+        'Measure latency percentiles, throughput and peak RSS of every API route at several data scales, '
+        'through the Django test client against a seeded in-memory store, and compare with a JSON baseline'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--scales', default='1000,100000',
+                            help='Comma-separated numbers of activities to seed, with one user per 50 '
+                                 '(default: 1000,100000; 1000000 needs several GB of memory)')
+        parser.add_argument('--requests', type=int, default=200, help='Measured requests per scenario (default: 200)')
+        parser.add_argument('--rounds', type=int, default=3,
+                            help='Measure each scenario this many times and keep the median of each metric '
+                                 '(default: 3)')
+        parser.add_argument('--warmup', type=int, default=20, help='Unmeasured requests per scenario (default: 20)')
+        parser.add_argument('--routes', help='Only benchmark these comma-separated route names')
+        parser.add_argument('--seed', type=int, default=42, help='Random seed of the data and requests')
+        parser.add_argument('--output', help='Write the results to this JSON file, e.g. to make a new baseline')
+        parser.add_argument('--baseline', help='Compare with the results in this JSON file and fail on regressions')
+        parser.add_argument('--threshold', type=float, default=0.25,
+                            help='Relative slowdown that counts as a regression (default: 0.25)')
+        parser.add_argument('--min-delta-ms', type=float, default=1.0,
+                            help='Ignore latency changes smaller than this, as noise (default: 1.0)')
+
+    def handle(self, *args, **options):
+        try:
+            scales = [int(scale) for scale in options['scales'].split(',')]
+        except ValueError:
+            raise CommandError('--scales must be comma-separated integers')
+        if min(scales + [options['requests'], options['rounds']]) <= 0 or options['warmup'] < 0:
+            raise CommandError('--scales, --requests and --rounds must be positive')
+        baseline = self.load_baseline(options['baseline']) if options['baseline'] else None
+
+        self.check_coverage()
+        scenarios = sorted(SCENARIOS, key=lambda scenario: PHASES[scenario.method])
+        if options['routes']:
+            routes = set(options['routes'].split(','))
+            scenarios = [scenario for scenario in scenarios if scenario.route in routes]
+            if not scenarios:
+                raise CommandError(f"No scenarios for routes: {options['routes']}")
+
+        results = {
+            'environment': {
+                'python': platform.python_version(),
+                'django': django.get_version(),
+                'platform': platform.platform(),
+                'requests': options['requests'],
+                'rounds': options['rounds'],
+                'recorded_at': datetime.utcnow().replace(microsecond=0).isoformat() + 'Z',
+            },
+            'scales': {},
+        }
+        self.stdout.write(f"{'endpoint':<40}{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}{'req/s':>9}")
+        # Benchmarks write and delete; they never touch a real database. Metrics
+        # are on, so /metrics is measured and every route includes their cost,
+        # and the benchmark client carries the cache stats token
+        with override_settings(MONGODB_IN_MEMORY=True, ALLOWED_HOSTS=['testserver'], API_METRICS=True,
+                               API_CACHE_STATS_TOKEN=CACHE_STATS_TOKEN,
+                               API_CACHE_STATS_HEADER='X-Octofit-Cache-Stats'):
+            try:
+                for scale in scales:
+                    results['scales'][str(scale)] = self.run_scale(scale, scenarios, options)
+            finally:
+                self.reset_store()
+
+        if options['output']:
+            with open(options['output'], 'w') as output:
+                json.dump(results, output, indent=2, sort_keys=True)
+            self.stdout.write(f"Wrote {options['output']}")
+        if baseline is not None:
+            self.compare(baseline, results, options)
+
+    def check_coverage(self):
+        routes = {pattern.name for pattern in get_resolver().url_patterns if getattr(pattern, 'name', None)}
+        missing = sorted(routes - {scenario.route for scenario in SCENARIOS})
+        if missing:
+            raise CommandError(f"No benchmark scenario for route(s): {', '.join(missing)}")
+
+    def load_baseline(self, path):
+        try:
+            with open(path) as baseline:
+                return json.load(baseline)
+        except (OSError, ValueError) as e:
+            raise CommandError(f'Cannot read the baseline {path}: {e}')
+
+    def reset_store(self):
+        connection.close()
+        response_cache.reset()
+        leaderboard.rankings.reset()
+
+    def run_scale(self, scale, scenarios, options):
+        self.reset_store()
+        self.stdout.write(self.style.MIGRATE_HEADING(f'{scale} activities'))
+        started = time.perf_counter()
+        dataset = self.seed(scale, options['seed'])
+        seed_seconds = time.perf_counter() - started
+        self.stdout.write(f"Seeded in {seed_seconds:.1f}s")
+
+        client = Client(HTTP_X_OCTOFIT_CACHE_STATS=CACHE_STATS_TOKEN)
+        endpoints = {}
+        for scenario in scenarios:
+            key = f'{scenario.route} {scenario.method} {scenario.operation}'
+            # Don't charge this scenario for collecting the previous one's garbage
+            gc.collect()
+            for index in range(options['warmup']):
+                self.request(client, scenario, dataset, index)
+            rounds = []
+            for round_index in range(options['rounds']):
+                first = options['warmup'] + round_index * options['requests']
+                rounds.append(self.summarize([
+                    self.request(client, scenario, dataset, index)
+                    for index in range(first, first + options['requests'])
+                ]))
+            endpoints[key] = {metric: statistics.median(summary[metric] for summary in rounds) for metric in rounds[0]}
+            self.stdout.write(
+                f"{key:<40}{endpoints[key]['p50_ms']:>9.2f}{endpoints[key]['p95_ms']:>9.2f}"
+                f"{endpoints[key]['p99_ms']:>9.2f}{endpoints[key]['throughput']:>9.0f}"
+            )
+        rss = peak_rss_mb()
+        if rss is not None:
+            self.stdout.write(f'Peak RSS: {rss} MB')
+        return {'seed_seconds': round(seed_seconds, 2), 'peak_rss_mb': rss, 'endpoints': endpoints}
+
+    def request(self, client, scenario, dataset, index):
+        path, data = scenario.build(dataset, index)
+        body = json.dumps(data) if data is not None else ''
+        started = time.perf_counter()
+        response = client.generic(scenario.method, path, body, content_type='application/json')
+        if response.streaming:
+            b''.join(response.streaming_content)
+        elapsed = time.perf_counter() - started
+        if response.status_code != scenario.expected_status:
+            content = b'' if response.streaming else response.content[:200]
+            raise CommandError(f'{scenario.method} {path}: {response.status_code} {content!r}')
+        return elapsed
+
+    def summarize(self, latencies):
+        ordered = sorted(latencies)
+        return {
+            'p50_ms': round(percentile(ordered, 50) * 1000, 3),
+            'p95_ms': round(percentile(ordered, 95) * 1000, 3),
+            'p99_ms': round(percentile(ordered, 99) * 1000, 3),
+            'throughput': round(len(latencies) / sum(latencies), 1),
+        }
+
+    def seed(self, scale, seed):
+        """Synthetic users, teams, activities, leaderboard, rollups and workouts"""
+        start = datetime(2024, 1, 1)
+        dataset = Dataset(seed)
+        activities = synthetic.sample_activities(scale, seed, start)
+        users = [synthetic.generate_user(seed, index, start) for index in range(max(100, scale // 50))]
+        teams = [
+            Team(name=f'Team {index}', members=[user['_id'] for user in users[index * 25:(index + 1) * 25]]).to_mongo()
+            for index in range(max(1, len(users) // 25))
+        ]
+        entries = [
+            Leaderboard(user_id=user_id, score=score, rank=0, category=category).to_mongo()
+            for (user_id, category), score in leaderboard.score_deltas(added=activities).items()
+        ]
+        daily = [
+            dict(user_id=user_id, day=day, activity_type=activity_type, **totals)
+            for (user_id, day, activity_type), totals in rollups.rollup_deltas(added=activities).items()
+        ]
+        workouts = [
+            Workout(name=f'Workout {index}', duration=30, difficulty='medium').to_mongo()
+            for index in range(max(50, scale // 100))
+        ]
+        for kind, collection, documents in (
+            ('users', users_collection, users),
+            ('teams', teams_collection, teams),
+            ('activities', activities_collection, activities),
+            ('leaderboard', leaderboard_collection, entries),
+            (None, rollups_collection, daily),
+            ('workouts', workouts_collection, workouts),
+        ):
+            for first in range(0, len(documents), 5000):
+                collection.insert_many(documents[first:first + 5000], ordered=False)
+            if kind is not None:
+                dataset.ids[kind] = [document['_id'] for document in documents]
+        return dataset
+
+    def compare(self, baseline, results, options):
+        threshold, min_delta = options['threshold'], options['min_delta_ms']
+        regressions = []
+        for setting in ('requests', 'rounds', 'python', 'django'):
+            if baseline.get('environment', {}).get(setting) != results['environment'][setting]:
+                self.stdout.write(self.style.WARNING(f'The baseline was recorded with a different {setting}'))
+        for scale, current in results['scales'].items():
+            previous = baseline.get('scales', {}).get(scale)
+            if previous is None:
+                self.stdout.write(f'No baseline for {scale} activities')
+                continue
+            if current['peak_rss_mb'] and previous.get('peak_rss_mb') and \
+                    current['peak_rss_mb'] > previous['peak_rss_mb'] * (1 + threshold):
+                regressions.append(f"{scale}: peak RSS {previous['peak_rss_mb']} -> {current['peak_rss_mb']} MB")
+            for key, metrics in current['endpoints'].items():
+                old = previous.get('endpoints', {}).get(key)
+                if old is None:
+                    continue
+                for metric, worse in METRICS.items():
+                    if worse > 0:
+                        regressed = metrics[metric] > old[metric] * (1 + threshold) and \
+                            metrics[metric] - old[metric] > min_delta
+                    else:
+                        regressed = metrics[metric] < old[metric] / (1 + threshold) and \
+                            1000 / metrics[metric] - 1000 / old[metric] > min_delta
+                    if regressed:
+                        regressions.append(f'{scale}: {key} {metric} {old[metric]} -> {metrics[metric]}')
+        if regressions:
+            for regression in regressions:
+                self.stdout.write(self.style.ERROR(f'  {regression}'))
+            raise CommandError(f'{len(regressions)} regression(s) past {threshold:.0%} of the baseline')
+        self.stdout.write(self.style.SUCCESS(f'No regressions past {threshold:.0%} of the baseline'))
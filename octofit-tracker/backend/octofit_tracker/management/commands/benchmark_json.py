@@ -0,0 +1,72 @@
+import io
+import time
+from datetime import datetime
+
+from django.core.management.base import BaseCommand, CommandError
+from rest_framework.parsers import JSONParser
+from rest_framework.renderers import JSONRenderer
+from octofit_tracker import synthetic
+from octofit_tracker.parsers import FastJSONParser
+from octofit_tracker.renderers import FastJSONRenderer, orjson
+from octofit_tracker.serializers import ActivitySerializer, LeaderboardSerializer, UserSerializer
+
+
+class Command(BaseCommand):
+    help = 'Measure JSON encode/decode throughput of list responses with the stdlib and fast renderer/parser'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--page-size', type=int, default=1000, help='Items per list response (default: 1000)')
+        parser.add_argument('--iterations', type=int, default=50, help='Encodes and decodes per measurement (default: 50)')
+        parser.add_argument('--seed', type=int, default=42, help='Random seed of the synthetic documents')
+
+    def handle(self, *args, **options):
+        page_size, iterations = options['page_size'], options['iterations']
+        if page_size <= 0 or iterations <= 0:
+            raise CommandError('--page-size and --iterations must be positive')
+        if orjson is None:
+            self.stdout.write(self.style.WARNING('orjson is not installed; the fast classes use the stdlib encoder'))
+
+        self.stdout.write(f"{'endpoint':<14}{'bytes':>10}{'':>4}{'encode MB/s':>14}{'decode MB/s':>14}")
+        for endpoint, data in self.payloads(page_size, options['seed']).items():
+            body = JSONRenderer().render(data)
+            if FastJSONParser().parse(io.BytesIO(FastJSONRenderer().render(data))) != JSONParser().parse(io.BytesIO(body)):
+                raise CommandError(f'{endpoint}: fast and stdlib JSON differ')
+            results = {}
+            for name, renderer, parser in (
+                ('stdlib', JSONRenderer(), JSONParser()),
+                ('fast', FastJSONRenderer(), FastJSONParser()),
+            ):
+                encode = self.measure(lambda: renderer.render(data), iterations)
+                decode = self.measure(lambda: parser.parse(io.BytesIO(body)), iterations)
+                results[name] = (encode, decode)
+                megabytes = len(body) * iterations / 1e6
+                self.stdout.write(
+                    f'{endpoint:<14}{len(body):>10}{name:>10}'
+                    f'{megabytes / encode:>14.1f}{megabytes / decode:>14.1f}'
+                )
+            (stdlib_encode, stdlib_decode), (fast_encode, fast_decode) = results['stdlib'], results['fast']
+            self.stdout.write(self.style.SUCCESS(
+                f'{endpoint}: encode {stdlib_encode / fast_encode:.1f}x, decode {stdlib_decode / fast_decode:.1f}x as fast'
+            ))
+
+    def payloads(self, page_size, seed):
+        """Response bodies of full list pages, as the views produce them"""
+        start = datetime(2024, 1, 1)
+        activities = synthetic.sample_activities(page_size, seed, start)
+        users = [synthetic.generate_user(seed, index, start) for index in range(page_size)]
+        entries = [
+            {'_id': activity['_id'], 'user_id': activity['user_id'], 'score': activity['calories'],
+             'rank': rank, 'category': 'OVERALL'}
+            for rank, activity in enumerate(activities, start=1)
+        ]
+        return {
+            'activities': ActivitySerializer.represent_many(activities),
+            'users': UserSerializer.represent_many(users),
+            'leaderboard': LeaderboardSerializer.represent_many(entries),
+        }
+
+    def measure(self, run, iterations):
+        started = time.perf_counter()
+        for _ in range(iterations):
+            run()
+        return time.perf_counter() - started
@@ -0,0 +1,105 @@
+import gc
+import time
+import tracemalloc
+
+from bson import ObjectId
+from django.core.management.base import BaseCommand, CommandError
+from octofit_tracker import synthetic
+from octofit_tracker.models import Activity
+
+
+class PlainActivity:
+    """The previous Activity model: a plain class with a per-instance __dict__"""
+
+    def __init__(self, _id=None, user_id=None, activity_type='', duration=0, date=None, calories=0, distance=0):
+        self._id = _id or ObjectId()
+        self.user_id = user_id
+        self.activity_type = activity_type
+        self.duration = duration
+        self.date = date
+        self.calories = calories
+        self.distance = distance
+
+    @staticmethod
+    def from_mongo(mongo_doc):
+        return PlainActivity(
+            _id=mongo_doc.get('_id'),
+            user_id=mongo_doc.get('user_id'),
+            activity_type=mongo_doc.get('activity_type', ''),
+            duration=mongo_doc.get('duration', 0),
+            date=mongo_doc.get('date'),
+            calories=mongo_doc.get('calories', 0),
+            distance=mongo_doc.get('distance', 0)
+        )
+
+    def to_mongo(self):
+        return {
+            '_id': self._id,
+            'user_id': self.user_id,
+            'activity_type': self.activity_type,
+            'duration': self.duration,
+            'date': self.date,
+            'calories': self.calories,
+            'distance': self.distance
+        }
+
+
+class Command(BaseCommand):
+    help = 'Measure per-object memory and from_mongo/to_mongo time of the Activity model on synthetic documents'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--count', type=int, default=1_000_000, help='Number of activity documents (default: 1000000)')
+        parser.add_argument('--seed', type=int, default=42, help='Random seed of the synthetic documents')
+
+    def handle(self, *args, **options):
+        count = options['count']
+        if count <= 0:
+            raise CommandError('--count must be positive')
+
+        self.stdout.write(f'Generating {count} synthetic activity documents...')
+        documents = synthetic.sample_activities(count, options['seed'])
+
+        self.stdout.write(f"{'model':<16}{'bytes/object':>14}{'from_mongo':>14}{'to_mongo':>14}")
+        results = {}
+        for name, model in (('PlainActivity', PlainActivity), ('Activity', Activity)):
+            size, objects = self.measure_memory(model, documents)
+            from_mongo = self.measure_time(lambda: [model.from_mongo(document) for document in documents])
+            to_mongo = self.measure_time(lambda: [obj.to_mongo() for obj in objects])
+            del objects
+            results[name] = (size, from_mongo, to_mongo)
+            self.stdout.write(
+                f'{name:<16}{size / count:>14.1f}'
+                f'{from_mongo / count * 1e9:>11.0f} ns{to_mongo / count * 1e9:>11.0f} ns'
+            )
+
+        plain, slotted = results['PlainActivity'], results['Activity']
+        self.stdout.write(self.style.SUCCESS(
+            f'Activity uses {1 - slotted[0] / plain[0]:.0%} less memory per object, '
+            f'from_mongo is {plain[1] / slotted[1]:.1f}x and to_mongo {plain[2] / slotted[2]:.1f}x as fast'
+        ))
+
+    def measure_memory(self, model, documents):
+        """Bytes allocated for the model objects of the documents (the field values are shared)"""
+        gc.collect()
+        tracemalloc.start()
+        try:
+            objects = [model.from_mongo(document) for document in documents]
+            size = tracemalloc.get_traced_memory()[0]
+        finally:
+            tracemalloc.stop()
+        # Leave out the list holding the objects
+        return size - objects.__sizeof__(), objects
+
+    def measure_time(self, run, repeat=3):
+        """Best wall time of `repeat` runs, with the collector off as in timeit"""
+        best = None
+        gc.disable()
+        try:
+            for _ in range(repeat):
+                started = time.perf_counter()
+                run()
+                elapsed = time.perf_counter() - started
+                best = elapsed if best is None else min(best, elapsed)
+        finally:
+            gc.enable()
+        return best
@@ -0,0 +1,45 @@
+from django.core.management.base import BaseCommand, CommandError
+from octofit_tracker.indexes import apply_drift, registry_drift
+from octofit_tracker.mongo import connection
+
+class Command(BaseCommand):
+    help = 'Create the MongoDB indexes declared in octofit_tracker.models.INDEXES and report drift'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--check', action='store_true',
+            help='Only report drift; exit with an error if any index is missing or different',
+        )
+        parser.add_argument(
+            '--reconcile', action='store_true',
+            help='Also rebuild mismatched indexes and drop indexes that are not declared',
+        )
+
+    def handle(self, *args, **options):
+        db = connection.get_database()
+        if db is None:
+            raise CommandError('MongoDB is not available; indexes cannot be managed on the in-memory store')
+
+        drifts = registry_drift(db)
+        if not drifts:
+            self.stdout.write(self.style.SUCCESS('All declared indexes are in place'))
+            return
+
+        for drift in drifts:
+            for model in drift.missing:
+                self.stdout.write(f"{drift.collection}: missing index {model.document['name']}")
+            for model in drift.mismatched:
+                self.stdout.write(f"{drift.collection}: index {model.document['name']} differs from its declaration")
+            for name in drift.unknown:
+                self.stdout.write(f"{drift.collection}: undeclared index {name}")
+
+        if options['check']:
+            raise CommandError('Index drift detected')
+
+        for drift in drifts:
+            created = apply_drift(db, drift, reconcile=options['reconcile'])
+            for name in created:
+                self.stdout.write(f"{drift.collection}: built index {name}")
+            if options['reconcile'] and drift.unknown:
+                self.stdout.write(f"{drift.collection}: dropped {', '.join(drift.unknown)}")
+        self.stdout.write(self.style.SUCCESS('Indexes are up to date'))
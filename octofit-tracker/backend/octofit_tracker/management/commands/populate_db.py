@@ -1,17 +1,53 @@
-from django.core.management.base import BaseCommand
+import multiprocessing
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import django
+from django.core.management import call_command
+from django.core.management.base import BaseCommand, CommandError
 from octofit_tracker.models import User, Team, Activity, Leaderboard, Workout
-from octofit_tracker.models import users_collection, teams_collection, activity_collection, leaderboard_collection, workouts_collection
+from octofit_tracker.models import users_collection, teams_collection, activities_collection, leaderboard_collection, workouts_collection
+from octofit_tracker.models import rollups_collection
+from octofit_tracker.mongo import connection
+from octofit_tracker import leaderboard, rollups, synthetic
 from datetime import datetime, timedelta
 from bson import ObjectId
 
+
+def _init_worker():
+    # Worker processes started with "spawn" need their own Django setup
+    from django.apps import apps
+    if not apps.ready:
+        django.setup()
+
+
 class Command(BaseCommand):
     help = 'Populate the database with test data for users, teams, activities, leaderboard, and workouts'
 
-    def handle(self, *args, **kwargs):
-        # First, drop all indexes to avoid conflicts
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--users', type=int,
+            help='Generate this many synthetic users instead of the small demo dataset',
+        )
+        parser.add_argument(
+            '--activities-per-user', type=int, default=50,
+            help='Mean number of activities per synthetic user (default: 50)',
+        )
+        parser.add_argument('--teams', type=int, help='Number of synthetic teams (default: one per 25 users)')
+        parser.add_argument('--days', type=int, default=365, help='Spread activities over this many days (default: 365)')
+        parser.add_argument('--seed', type=int, default=42, help='Random seed; the same seed generates the same data')
+        parser.add_argument('--workers', type=int, default=1, help='Number of worker processes')
+        parser.add_argument('--batch-size', type=int, default=5000, help='Documents per insert_many call')
+
+    def handle(self, *args, **options):
+        if connection.get_database() is None:
+            raise CommandError('MongoDB is not available; nothing to populate')
+
+        # First, drop all indexes to avoid conflicts. Loading without indexes
+        # and building them afterwards is also much faster for large datasets.
         self.stdout.write('Dropping existing indexes...')
         try:
-            activity_collection.drop_indexes()
+            activities_collection.drop_indexes()
             leaderboard_collection.drop_indexes()
             workouts_collection.drop_indexes()
             teams_collection.drop_indexes()
@@ -26,10 +62,36 @@ class Command(BaseCommand):
         self.stdout.write('Clearing existing collections...')
         users_collection.delete_many({})
         teams_collection.delete_many({})
-        activity_collection.delete_many({})
+        activities_collection.delete_many({})
         leaderboard_collection.delete_many({})
         workouts_collection.delete_many({})
-        
+        rollups_collection.delete_many({})
+
+        if options['users'] is not None:
+            self.populate_synthetic(options)
+        else:
+            self.populate_demo()
+
+        # Create workouts
+        self.stdout.write('Creating workouts...')
+        self.create_workouts()
+
+        self.stdout.write('Building indexes...')
+        call_command('ensure_indexes', stdout=self.stdout)
+
+        # The leaderboard and rollups pipelines merge on unique indexes, so they
+        # run once the indexes are back. Both need MongoDB 5.0 or later
+        # ($setWindowFields, $dateTrunc); the synthetic leaderboard is already
+        # written, but its rollups still come from the pipeline
+        if options['users'] is None:
+            self.stdout.write('Computing leaderboard entries...')
+            self.stdout.write(f'Computed {leaderboard.rebuild()} leaderboard entries')
+        self.stdout.write('Building activity rollups...')
+        self.stdout.write(f'Built {rollups.rebuild()} rollups')
+
+        self.stdout.write(self.style.SUCCESS('Successfully populated the database with test data!'))
+
+    def populate_demo(self):
         # Create users
         self.stdout.write('Creating users...')
         user_ids = self.create_users()
@@ -38,20 +100,107 @@ class Command(BaseCommand):
         self.stdout.write('Creating teams...')
         self.create_teams(user_ids)
         
-        # Create activities
+        # Create activities; their leaderboard is computed once the indexes are back
         self.stdout.write('Creating activities...')
         self.create_activities(user_ids)
-        
-        # Create leaderboard entries
+
+    def populate_synthetic(self, options):
+        user_total = options['users']
+        workers = max(1, options['workers'])
+        batch_size = max(1, options['batch_size'])
+        seed = options['seed']
+        days = max(1, options['days'])
+        end = datetime.utcnow().replace(hour=0, minute=0, second=0, microsecond=0)
+        start = end - timedelta(days=days)
+
+        # Small shards keep every worker busy until the end
+        shard_size = max(1, min(10000, -(-user_total // (workers * 4))))
+        shards = [(first, min(first + shard_size, user_total)) for first in range(0, user_total, shard_size)]
+        self.stdout.write(
+            f'Generating {user_total} users with ~{options["activities_per_user"]} activities each '
+            f'in {len(shards)} shards on {workers} worker(s)...'
+        )
+
+        started = time.perf_counter()
+        users_written = activities_written = 0
+        totals = {}
+        context = multiprocessing.get_context()
+        with ProcessPoolExecutor(max_workers=workers, mp_context=context, initializer=_init_worker) as pool:
+            futures = [
+                pool.submit(
+                    synthetic.populate_shard, seed, first, last,
+                    options['activities_per_user'], start, days, batch_size,
+                )
+                for first, last in shards
+            ]
+            for done, future in enumerate(as_completed(futures), start=1):
+                user_count, activity_count, shard_totals = future.result()
+                users_written += user_count
+                activities_written += activity_count
+                totals.update(shard_totals)
+                self.stdout.write(f'Shard {done}/{len(shards)}: {users_written} users, {activities_written} activities')
+
+        elapsed = time.perf_counter() - started
+        self.stdout.write(
+            f'Wrote {users_written + activities_written} documents in {elapsed:.1f}s '
+            f'({(users_written + activities_written) / max(elapsed, 1e-9):.0f} docs/s)'
+        )
+
+        team_count = options['teams'] or max(1, user_total // 25)
+        self.stdout.write(f'Creating {team_count} teams...')
+        self.create_synthetic_teams(seed, user_total, team_count, start, batch_size)
+
         self.stdout.write('Creating leaderboard entries...')
-        self.create_leaderboard(user_ids)
-        
-        # Create workouts
-        self.stdout.write('Creating workouts...')
-        self.create_workouts()
-        
-        self.stdout.write(self.style.SUCCESS('Successfully populated the database with test data!'))
-    
+        self.create_synthetic_leaderboard(seed, totals, start, batch_size)
+
+    def create_synthetic_teams(self, seed, user_total, team_count, start, batch_size):
+        teams = []
+        for team_index in range(team_count):
+            members = [
+                synthetic.user_id_for(seed, index, start)
+                for index in range(team_index, user_total, team_count)
+            ]
+            teams.append(Team(
+                _id=synthetic.make_object_id(seed, 'team', team_index, start),
+                name=f'Team {team_index + 1}',
+                description=f'Synthetic team {team_index + 1}',
+                members=members,
+            ).to_mongo())
+            if len(teams) >= batch_size:
+                teams_collection.insert_many(teams, ordered=False)
+                teams = []
+        if teams:
+            teams_collection.insert_many(teams, ordered=False)
+
+    def create_synthetic_leaderboard(self, seed, totals, start, batch_size):
+        # Same entries as octofit_tracker.leaderboard (total calories per
+        # activity type and overall, dense ranks, no zero scores), computed in
+        # Python from the shard totals instead of another pass over activities
+        scores = {}
+        for index, user_totals in totals.items():
+            for category, score in [(leaderboard.OVERALL, sum(user_totals.values())), *user_totals.items()]:
+                if score != 0:
+                    scores.setdefault(category, []).append((score, index))
+
+        entries = []
+        for category, category_scores in scores.items():
+            category_scores.sort(key=lambda item: item[0], reverse=True)
+            rank, previous_score = 0, None
+            for score, index in category_scores:
+                if score != previous_score:
+                    rank, previous_score = rank + 1, score
+                entries.append(Leaderboard(
+                    user_id=synthetic.user_id_for(seed, index, start),
+                    score=score,
+                    rank=rank,
+                    category=category,
+                ).to_mongo())
+                if len(entries) >= batch_size:
+                    leaderboard_collection.insert_many(entries, ordered=False)
+                    entries = []
+        if entries:
+            leaderboard_collection.insert_many(entries, ordered=False)
+
     def create_users(self):
         users = [
             User(username='thundergod', email='thundergod@mhigh.edu', password='thundergodpassword', 
@@ -66,14 +215,12 @@ class Command(BaseCommand):
                  first_name='Sleep', last_name='Token')
         ]
         
-        user_ids = []
+        mongo_docs = [user.to_mongo() for user in users]
+        users_collection.insert_many(mongo_docs)
         for user in users:
-            mongo_doc = user.to_mongo()
-            users_collection.insert_one(mongo_doc)
-            user_ids.append(mongo_doc['_id'])
             self.stdout.write(f"Created user: {user.username}")
         
-        return user_ids
+        return [mongo_doc['_id'] for mongo_doc in mongo_docs]
     
     def create_teams(self, user_ids):
         teams = [
@@ -81,18 +228,21 @@ class Command(BaseCommand):
             Team(name='Gold Team', description='The Gold Team', members=[user_ids[1], user_ids[3], user_ids[4]])
         ]
         
+        mongo_docs = []
         for team in teams:
             mongo_doc = team.to_mongo()
             # Add a unique team_id
             mongo_doc['team_id'] = str(ObjectId())
-            teams_collection.insert_one(mongo_doc)
+            mongo_docs.append(mongo_doc)
+        teams_collection.insert_many(mongo_docs)
+        for team in teams:
             self.stdout.write(f"Created team: {team.name}")
     
     def create_activities(self, user_ids):
         # Using full datetime objects instead of date objects for MongoDB compatibility
         today = datetime.now()
         
-        activities = []
+        mongo_docs = []
         activity_types = ['CYCLING', 'WEIGHTLIFTING', 'RUNNING', 'YOGA', 'SWIMMING']
         durations = [60, 120, 90, 30, 75]
         calories = [500, 700, 800, 200, 600]
@@ -115,31 +265,10 @@ class Command(BaseCommand):
             mongo_doc = activity.to_mongo()
             mongo_doc['activity_id'] = activity_id
             
-            activity_collection.insert_one(mongo_doc)
+            mongo_docs.append(mongo_doc)
             self.stdout.write(f"Created activity: {activity.activity_type} for user {activity.user_id}")
-    
-    def create_leaderboard(self, user_ids):
-        categories = ['OVERALL', 'OVERALL', 'OVERALL', 'OVERALL', 'OVERALL',
-                      'CYCLING', 'WEIGHTLIFTING', 'RUNNING', 'YOGA', 'SWIMMING']
-        scores = [100, 90, 95, 85, 80, 95, 98, 92, 88, 94]
-        ranks = [1, 2, 3, 4, 5, 1, 1, 1, 1, 1]
         
-        for i, (category, score, rank) in enumerate(zip(categories, scores, ranks)):
-            user_id = user_ids[i % len(user_ids)]
-            
-            leaderboard_entry = Leaderboard(
-                user_id=user_id,
-                score=score,
-                rank=rank,
-                category=category
-            )
-            
-            # Add a unique leaderboard_id
-            mongo_doc = leaderboard_entry.to_mongo()
-            mongo_doc['leaderboard_id'] = str(ObjectId())
-            
-            leaderboard_collection.insert_one(mongo_doc)
-            self.stdout.write(f"Created leaderboard entry: {category} rank {rank} for user {user_id}")
+        activities_collection.insert_many(mongo_docs)
     
     def create_workouts(self):
         workout_data = [
@@ -180,6 +309,7 @@ class Command(BaseCommand):
             }
         ]
         
+        mongo_docs = []
         for data in workout_data:
             workout = Workout(**data)
             
@@ -187,5 +317,7 @@ class Command(BaseCommand):
             mongo_doc = workout.to_mongo()
             mongo_doc['workout_id'] = str(ObjectId())
             
-            workouts_collection.insert_one(mongo_doc)
-            self.stdout.write(f"Created workout: {workout.name}")
\ No newline at end of file
+            mongo_docs.append(mongo_doc)
+            self.stdout.write(f"Created workout: {workout.name}")
+        
+        workouts_collection.insert_many(mongo_docs)
\ No newline at end of file
@@ -0,0 +1,22 @@
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from pymongo.errors import OperationFailure
+from octofit_tracker import leaderboard
+from octofit_tracker.mongo import connection
+
+class Command(BaseCommand):
+    help = 'Recompute leaderboard scores and ranks from activities with an aggregation pipeline'
+
+    def handle(self, *args, **options):
+        if connection.get_database() is None:
+            raise CommandError('MongoDB is not available; the leaderboard cannot be rebuilt on the in-memory store')
+
+        self.stdout.write('Rebuilding leaderboard...')
+        started = time.perf_counter()
+        try:
+            entries = leaderboard.rebuild()
+        except OperationFailure as e:
+            raise CommandError(f'Leaderboard aggregation failed (MongoDB 5.0+ is required): {e}')
+        elapsed = time.perf_counter() - started
+        self.stdout.write(self.style.SUCCESS(f'Rebuilt {entries} leaderboard entries in {elapsed:.1f}s'))
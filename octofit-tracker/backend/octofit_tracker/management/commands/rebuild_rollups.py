@@ -0,0 +1,33 @@
+import time
+
+from bson import ObjectId
+from bson.errors import InvalidId
+from django.core.management.base import BaseCommand, CommandError
+from pymongo.errors import OperationFailure
+from octofit_tracker import rollups
+from octofit_tracker.mongo import connection
+
+class Command(BaseCommand):
+    help = 'Recompute the daily activity rollups from activities with an aggregation pipeline'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--user', help='Only rebuild the rollups of this user id')
+
+    def handle(self, *args, **options):
+        if connection.get_database() is None:
+            raise CommandError('MongoDB is not available; the rollups cannot be rebuilt on the in-memory store')
+        user_id = None
+        if options['user']:
+            try:
+                user_id = ObjectId(options['user'])
+            except InvalidId:
+                raise CommandError(f"Invalid user id: {options['user']}")
+
+        self.stdout.write('Rebuilding activity rollups...')
+        started = time.perf_counter()
+        try:
+            count = rollups.rebuild(user_id)
+        except OperationFailure as e:
+            raise CommandError(f'Rollup aggregation failed (MongoDB 5.0+ is required): {e}')
+        elapsed = time.perf_counter() - started
+        self.stdout.write(self.style.SUCCESS(f'Rebuilt {count} rollup documents in {elapsed:.1f}s'))
@@ -0,0 +1,51 @@
+from django.core.management.base import BaseCommand, CommandError
+from pymongo.errors import OperationFailure
+from octofit_tracker import leaderboard
+from octofit_tracker.models import leaderboard_collection
+from octofit_tracker.mongo import connection
+
+# Entries listed per kind of drift
+EXAMPLES = 5
+
+class Command(BaseCommand):
+    help = 'Compare the incrementally maintained leaderboard with a full recomputation from activities'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--fix', action='store_true',
+            help='Rebuild the leaderboard if it has drifted',
+        )
+
+    def handle(self, *args, **options):
+        if connection.get_database() is None:
+            raise CommandError('MongoDB is not available; the leaderboard cannot be reconciled on the in-memory store')
+
+        expected = leaderboard.recompute_scores()
+        stored = {
+            (entry['user_id'], entry['category']): entry.get('score', 0)
+            for entry in leaderboard_collection.find({}, {'user_id': 1, 'category': 1, 'score': 1})
+        }
+        missing = [key for key in expected if key not in stored]
+        extra = [key for key in stored if key not in expected]
+        mismatched = [key for key in expected if key in stored and stored[key] != expected[key]]
+
+        if not (missing or extra or mismatched):
+            self.stdout.write(self.style.SUCCESS(f'Leaderboard is consistent ({len(stored)} entries)'))
+            return
+
+        self.stdout.write(f'{len(missing)} missing, {len(extra)} extra and {len(mismatched)} mismatched entries')
+        for user_id, category in missing[:EXAMPLES]:
+            self.stdout.write(f'  missing: {user_id} {category} (expected {expected[(user_id, category)]})')
+        for user_id, category in extra[:EXAMPLES]:
+            self.stdout.write(f'  extra: {user_id} {category} (score {stored[(user_id, category)]})')
+        for key in mismatched[:EXAMPLES]:
+            self.stdout.write(f'  mismatched: {key[0]} {key[1]} (stored {stored[key]}, expected {expected[key]})')
+
+        if not options['fix']:
+            raise CommandError('Leaderboard drift detected; run with --fix to rebuild it')
+
+        try:
+            entries = leaderboard.rebuild()
+        except OperationFailure as e:
+            raise CommandError(f'Leaderboard aggregation failed (MongoDB 5.0+ is required): {e}')
+        self.stdout.write(self.style.SUCCESS(f'Rebuilt {entries} leaderboard entries'))
@@ -0,0 +1,1521 @@
+import re
+import threading
+from bisect import bisect_left, insort
+from datetime import datetime, timedelta
+from itertools import product
+
+from bson import ObjectId, decode, encode
+from pymongo import ASCENDING, DESCENDING, ReturnDocument
+from pymongo.errors import BulkWriteError, DuplicateKeyError, OperationFailure
+from pymongo.operations import DeleteMany, DeleteOne, InsertOne, ReplaceOne, UpdateMany, UpdateOne
+from pymongo.results import BulkWriteResult, DeleteResult, InsertManyResult, InsertOneResult, UpdateResult
+
+# In-process document store with the interface of the pymongo collection
+# methods this project uses. It stands in for MongoDB when the server can't be
+# reached (MONGODB_FALLBACK_TO_MOCK) or isn't wanted (MONGODB_IN_MEMORY), so
+# the API, tests and benchmarks can run without a database.
+#
+# Documents go through a BSON round trip on the way in, so they come back
+# exactly as pymongo would return them (naive UTC datetimes truncated to
+# milliseconds, tuples as lists). Stored documents are never modified in
+# place: updates build a new document, and reads hand out copies.
+#
+# Queries support equality (including array membership), $eq, $ne, $gt,
+# $gte, $lt, $lte, $in, $nin, $exists, $regex, $not, $size, $all,
+# $elemMatch, $and, $or and $nor. Secondary indexes keep a hash map of their
+# keys (for unique constraints) and a sorted list (for equality, $in and range
+# scans and for sorting without a full sort). Only a small aggregation subset
+# is implemented; unsupported stages raise OperationFailure as an old server
+# would.
+
+# Type brackets in MongoDB's sort order. Range operators only match values of
+# the same bracket as their argument.
+_NULL, _NUMBER, _STRING, _OBJECT, _ARRAY, _BINARY, _OBJECT_ID, _BOOL, _DATE, _OTHER = range(1, 11)
+# Sorts after every (bracket, value) pair
+_TOP = (99,)
+
+
+_BRACKETS = {
+    type(None): _NULL, bool: _BOOL, int: _NUMBER, float: _NUMBER, str: _STRING, dict: _OBJECT,
+    list: _ARRAY, bytes: _BINARY, ObjectId: _OBJECT_ID, datetime: _DATE,
+}
+
+
+def _bracket(value):
+    bracket = _BRACKETS.get(type(value))
+    if bracket is not None:
+        return bracket
+    # Subclasses such as Int64 and SON
+    if value is None:
+        return _NULL
+    if isinstance(value, bool):
+        return _BOOL
+    if isinstance(value, (int, float)):
+        return _NUMBER
+    if isinstance(value, str):
+        return _STRING
+    if isinstance(value, dict):
+        return _OBJECT
+    if isinstance(value, list):
+        return _ARRAY
+    if isinstance(value, bytes):
+        return _BINARY
+    if isinstance(value, ObjectId):
+        return _OBJECT_ID
+    if isinstance(value, datetime):
+        return _DATE
+    return _OTHER
+
+
+def _sort_key(value):
+    bracket = _bracket(value)
+    if bracket == _OBJECT_ID:
+        # Same order as ObjectId, but compared in C
+        return bracket, value.binary
+    if bracket == _OBJECT:
+        return bracket, tuple((key, _sort_key(item)) for key, item in value.items())
+    if bracket == _ARRAY:
+        return bracket, tuple(_sort_key(item) for item in value)
+    if bracket == _OTHER:
+        return bracket, repr(value)
+    return bracket, value
+
+
+def _hash_key(value):
+    """Hashable form of a value; 1 and 1.0 are equal, 1 and True are not"""
+    bracket = _bracket(value)
+    if bracket == _OBJECT_ID:
+        return bracket, value.binary
+    if bracket == _OBJECT:
+        return bracket, tuple((key, _hash_key(item)) for key, item in value.items())
+    if bracket == _ARRAY:
+        return bracket, tuple(_hash_key(item) for item in value)
+    if bracket == _OTHER:
+        return bracket, repr(value)
+    return bracket, value
+
+
+def _normalize(document):
+    """The document as MongoDB would store and return it"""
+    return decode(encode(document))
+
+
+def _normalize_value(value):
+    if isinstance(value, (datetime, tuple)):
+        return _normalize({'v': value})['v']
+    return value
+
+
+def _copy(value):
+    if isinstance(value, dict):
+        return {key: _copy(item) for key, item in value.items()}
+    if isinstance(value, list):
+        return [_copy(item) for item in value]
+    return value
+
+
+def _lookup(document, path):
+    """Values at a dotted path; arrays along the path are traversed. Empty if missing."""
+    if '.' not in path:
+        return [document[path]] if path in document else []
+    values = [document]
+    for part in path.split('.'):
+        found = []
+        for value in values:
+            if isinstance(value, dict):
+                if part in value:
+                    found.append(value[part])
+            elif isinstance(value, list):
+                if part.isdigit() and int(part) < len(value):
+                    found.append(value[int(part)])
+                found.extend(item[part] for item in value if isinstance(item, dict) and part in item)
+        values = found
+    return values
+
+
+def _first(document, path):
+    values = _lookup(document, path)
+    return values[0] if values else None
+
+
+# Query matching
+
+def _equal(a, b):
+    if isinstance(a, bool) != isinstance(b, bool):
+        return False
+    try:
+        return a == b
+    except TypeError:
+        return False
+
+
+def _matches_value(values, expected):
+    """Equality as in {field: expected}: null matches missing, arrays match by element"""
+    if isinstance(expected, re.Pattern):
+        return _matches_regex(values, expected)
+    if expected is None and not values:
+        return True
+    for value in values:
+        if _equal(value, expected):
+            return True
+        if isinstance(value, list) and any(_equal(item, expected) for item in value):
+            return True
+    return False
+
+
+def _matches_regex(values, pattern):
+    for value in values:
+        for item in (value if isinstance(value, list) else [value]):
+            if isinstance(item, str) and pattern.search(item):
+                return True
+    return False
+
+
+def _compare(values, argument, test):
+    if argument is None:
+        # Only the inclusive operators match null (and missing) values
+        return test(0) and _matches_value(values, None)
+    bracket = _bracket(argument)
+    expected = _sort_key(argument)
+    for value in values:
+        for item in (value if isinstance(value, list) else [value]):
+            if _bracket(item) == bracket:
+                actual = _sort_key(item)
+                if test((actual > expected) - (actual < expected)):
+                    return True
+    return False
+
+
+def _regex(pattern, options=''):
+    if isinstance(pattern, re.Pattern):
+        return pattern
+    flags = 0
+    for option, flag in (('i', re.IGNORECASE), ('m', re.MULTILINE), ('s', re.DOTALL), ('x', re.VERBOSE)):
+        if option in (options or ''):
+            flags |= flag
+    return re.compile(pattern, flags)
+
+
+def _compile_operators(conditions):
+    tests = []
+    for operator, argument in conditions.items():
+        if operator == '$options':
+            continue
+        if operator == '$regex':
+            tests.append(lambda values, pattern=_regex(argument, conditions.get('$options')): _matches_regex(values, pattern))
+            continue
+        if operator == '$not':
+            inner = _compile_condition(argument)
+            tests.append(lambda values, inner=inner: not inner(values))
+            continue
+        if operator == '$elemMatch':
+            if all(key.startswith('$') for key in argument):
+                inner = _compile_operators(argument)
+                tests.append(lambda values, inner=inner: any(
+                    isinstance(value, list) and any(inner([item]) for item in value) for value in values))
+            else:
+                inner = compile_query(argument)
+                tests.append(lambda values, inner=inner: any(
+                    isinstance(value, list) and any(isinstance(item, dict) and inner(item) for item in value)
+                    for value in values))
+            continue
+        build = _OPERATORS.get(operator)
+        if build is None:
+            raise OperationFailure(f'unknown operator: {operator}', code=2)
+        tests.append(build(argument))
+    return lambda values: all(test(values) for test in tests)
+
+
+def _in(argument):
+    expected = [_normalize_value(item) for item in argument]
+    return lambda values: any(_matches_value(values, item) for item in expected)
+
+
+_OPERATORS = {
+    '$eq': lambda arg: (lambda values, arg=_normalize_value(arg): _matches_value(values, arg)),
+    '$ne': lambda arg: (lambda values, arg=_normalize_value(arg): not _matches_value(values, arg)),
+    '$gt': lambda arg: (lambda values, arg=_normalize_value(arg): _compare(values, arg, lambda c: c > 0)),
+    '$gte': lambda arg: (lambda values, arg=_normalize_value(arg): _compare(values, arg, lambda c: c >= 0)),
+    '$lt': lambda arg: (lambda values, arg=_normalize_value(arg): _compare(values, arg, lambda c: c < 0)),
+    '$lte': lambda arg: (lambda values, arg=_normalize_value(arg): _compare(values, arg, lambda c: c <= 0)),
+    '$in': _in,
+    '$nin': lambda arg: (lambda values, test=_in(arg): not test(values)),
+    '$exists': lambda arg: (lambda values: bool(values) == bool(arg)),
+    '$size': lambda arg: (lambda values: any(isinstance(value, list) and len(value) == arg for value in values)),
+    '$all': lambda arg: (lambda values: all(_matches_value(values, _normalize_value(item)) for item in arg)),
+}
+
+
+def _is_operator_document(value):
+    return isinstance(value, dict) and bool(value) and all(key.startswith('$') for key in value)
+
+
+def _compile_condition(condition):
+    if _is_operator_document(condition):
+        return _compile_operators(condition)
+    if isinstance(condition, re.Pattern):
+        return lambda values: _matches_regex(values, condition)
+    expected = _normalize_value(condition)
+    return lambda values: _matches_value(values, expected)
+
+
+def compile_query(query):
+    """Turn a query document into a predicate over documents"""
+    if not query:
+        return lambda document: True
+    tests = []
+    for key, condition in query.items():
+        if key in ('$and', '$or', '$nor'):
+            clauses = [compile_query(clause) for clause in condition]
+            if key == '$and':
+                tests.append(lambda document, clauses=clauses: all(clause(document) for clause in clauses))
+            elif key == '$or':
+                tests.append(lambda document, clauses=clauses: any(clause(document) for clause in clauses))
+            else:
+                tests.append(lambda document, clauses=clauses: not any(clause(document) for clause in clauses))
+        elif key.startswith('$'):
+            raise OperationFailure(f'unknown top level operator: {key}', code=2)
+        else:
+            test = _compile_condition(condition)
+            tests.append(lambda document, key=key, test=test: test(_lookup(document, key)))
+    if len(tests) == 1:
+        return tests[0]
+    return lambda document: all(test(document) for test in tests)
+
+
+def _field_intervals(query, field):
+    """
+    Ranges of sort keys that every document matching the query has at `field`,
+    as a list of (low, low_inclusive, high, high_inclusive), or None when the
+    query doesn't bound the field. Used to pick index ranges; the query itself
+    is still applied to every candidate.
+    """
+    if not query:
+        return None
+    if field in query:
+        intervals = _condition_intervals(query[field])
+        if intervals is not None:
+            return intervals
+    for clause in query.get('$and', ()):
+        intervals = _field_intervals(clause, field)
+        if intervals is not None:
+            return intervals
+    if query.get('$or'):
+        union = []
+        for clause in query['$or']:
+            intervals = _field_intervals(clause, field)
+            if intervals is None:
+                return None
+            union.extend(intervals)
+        return union
+    return None
+
+
+def _condition_intervals(condition):
+    if isinstance(condition, re.Pattern):
+        return None
+    if not _is_operator_document(condition):
+        if condition is None or isinstance(condition, (list, dict)):
+            return None
+        key = _sort_key(_normalize_value(condition))
+        return [(key, True, key, True)]
+    if '$eq' in condition:
+        return _condition_intervals(condition['$eq'])
+    if '$in' in condition:
+        intervals = []
+        for item in condition['$in']:
+            item_intervals = _condition_intervals(item)
+            if item_intervals is None:
+                return None
+            intervals.extend(item_intervals)
+        return intervals
+    low = high = None
+    low_inclusive = high_inclusive = True
+    for operator, inclusive, is_low in (('$gt', False, True), ('$gte', True, True), ('$lt', False, False), ('$lte', True, False)):
+        if operator not in condition or condition[operator] is None:
+            continue
+        key = _sort_key(_normalize_value(condition[operator]))
+        if is_low:
+            low, low_inclusive = key, inclusive
+        else:
+            high, high_inclusive = key, inclusive
+    if low is None and high is None:
+        return None
+    # Range operators never cross type brackets
+    bracket = (low or high)[0]
+    if low is None:
+        low, low_inclusive = (bracket,), True
+    if high is None:
+        high, high_inclusive = (bracket + 1,), False
+    return [(low, low_inclusive, high, high_inclusive)]
+
+
+# Projections
+
+def compile_projection(projection):
+    if projection is None:
+        return None
+    if isinstance(projection, (list, tuple)):
+        projection = {field: 1 for field in projection}
+    include_id = bool(projection.get('_id', 1))
+    fields = {field: bool(flag) for field, flag in projection.items() if field != '_id'}
+    if not fields:
+        if include_id:
+            return lambda document: {'_id': document['_id']} if '_id' in projection else _copy(document)
+        return lambda document: {key: _copy(value) for key, value in document.items() if key != '_id'}
+    if len(set(fields.values())) > 1:
+        raise OperationFailure('Cannot do exclusion on field in inclusion projection', code=31254)
+    if next(iter(fields.values())):
+        top_level = {field.split('.', 1)[0] for field in fields}
+        nested = [field for field in fields if '.' in field]
+
+        def include(document):
+            projected = {}
+            if include_id and '_id' in document:
+                projected['_id'] = document['_id']
+            for key, value in document.items():
+                if key in top_level and key != '_id':
+                    projected[key] = _copy(value)
+            for field in nested:
+                head, rest = field.split('.', 1)
+                if isinstance(document.get(head), dict):
+                    projected[head] = _pick(document[head], [f for f in fields if f.startswith(head + '.')], head)
+            return projected
+        return include
+
+    def exclude(document):
+        projected = _copy(document)
+        if not include_id:
+            projected.pop('_id', None)
+        for field in fields:
+            _unset_path(projected, field)
+        return projected
+    return exclude
+
+
+def _pick(subdocument, fields, prefix):
+    picked = {}
+    for field in fields:
+        rest = field[len(prefix) + 1:]
+        head = rest.split('.', 1)[0]
+        if head in subdocument:
+            if '.' in rest and isinstance(subdocument[head], dict):
+                picked[head] = _pick(subdocument[head], [field], f'{prefix}.{head}')
+            else:
+                picked[head] = _copy(subdocument[head])
+    return picked
+
+
+# Updates
+
+def _set_path(document, path, value):
+    parts = path.split('.')
+    for part in parts[:-1]:
+        if isinstance(document, list) and part.isdigit():
+            document = document[int(part)]
+            continue
+        document = document.setdefault(part, {})
+        if not isinstance(document, (dict, list)):
+            raise OperationFailure(f"Cannot create field '{part}' in element", code=28)
+    if isinstance(document, list) and parts[-1].isdigit():
+        index = int(parts[-1])
+        document.extend([None] * (index + 1 - len(document)))
+        document[index] = value
+    else:
+        document[parts[-1]] = value
+
+
+def _unset_path(document, path):
+    parts = path.split('.')
+    for part in parts[:-1]:
+        document = document.get(part) if isinstance(document, dict) else None
+        if document is None:
+            return
+    if isinstance(document, dict):
+        document.pop(parts[-1], None)
+
+
+def _get_path(document, path, default=None):
+    for part in path.split('.'):
+        if isinstance(document, dict) and part in document:
+            document = document[part]
+        elif isinstance(document, list) and part.isdigit() and int(part) < len(document):
+            document = document[int(part)]
+        else:
+            return default
+    return document
+
+
+_MISSING = object()
+
+
+def _is_number(value):
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+
+def _arithmetic(operator, combine):
+    def apply(document, path, argument, inserting):
+        if not _is_number(argument):
+            raise OperationFailure(f'Cannot {operator} with non-numeric argument', code=14)
+        current = _get_path(document, path, _MISSING)
+        if current is _MISSING:
+            # A missing field counts as 0
+            _set_path(document, path, combine(0, argument))
+        elif _is_number(current):
+            _set_path(document, path, combine(current, argument))
+        else:
+            raise OperationFailure(f'Cannot apply {operator} to a value of non-numeric type', code=14)
+    return apply
+
+
+def _bound(keep_new):
+    def apply(document, path, argument, inserting):
+        current = _get_path(document, path, _MISSING)
+        if current is _MISSING or keep_new(_sort_key(argument), _sort_key(current)):
+            _set_path(document, path, argument)
+    return apply
+
+
+def _set(document, path, argument, inserting):
+    _set_path(document, path, argument)
+
+
+def _set_on_insert(document, path, argument, inserting):
+    if inserting:
+        _set_path(document, path, argument)
+
+
+def _unset(document, path, argument, inserting):
+    _unset_path(document, path)
+
+
+def _array_at(document, path):
+    current = _get_path(document, path, _MISSING)
+    if current is _MISSING:
+        current = []
+        _set_path(document, path, current)
+    if not isinstance(current, list):
+        raise OperationFailure(f"The field '{path}' must be an array", code=2)
+    return current
+
+
+def _each(argument):
+    if isinstance(argument, dict) and '$each' in argument:
+        return list(argument['$each'])
+    return [argument]
+
+
+def _push(document, path, argument, inserting):
+    _array_at(document, path).extend(_each(argument))
+
+
+def _add_to_set(document, path, argument, inserting):
+    current = _array_at(document, path)
+    for item in _each(argument):
+        if not any(_equal(existing, item) for existing in current):
+            current.append(item)
+
+
+def _pull(document, path, argument, inserting):
+    current = _get_path(document, path, _MISSING)
+    if isinstance(current, list):
+        if isinstance(argument, dict) and not _is_operator_document(argument):
+            test = compile_query(argument)
+            keep = [item for item in current if not (isinstance(item, dict) and test(item))]
+        else:
+            test = _compile_condition(argument)
+            keep = [item for item in current if not test([item])]
+        _set_path(document, path, keep)
+
+
+def _current_date(document, path, argument, inserting):
+    _set_path(document, path, datetime.utcnow())
+
+
+_UPDATE_OPERATORS = {
+    '$set': _set,
+    '$setOnInsert': _set_on_insert,
+    '$unset': _unset,
+    '$inc': _arithmetic('$inc', lambda current, argument: current + argument),
+    '$mul': _arithmetic('$mul', lambda current, argument: current * argument),
+    '$min': _bound(lambda new, current: new < current),
+    '$max': _bound(lambda new, current: new > current),
+    '$push': _push,
+    '$addToSet': _add_to_set,
+    '$pull': _pull,
+    '$currentDate': _current_date,
+}
+
+
+def apply_update(document, update, inserting=False):
+    """A new document with the update operators applied"""
+    if not update or not all(key.startswith('$') for key in update):
+        raise ValueError('update only works with $ operators')
+    updated = _copy(document)
+    for operator, fields in update.items():
+        apply = _UPDATE_OPERATORS.get(operator)
+        if apply is None:
+            raise OperationFailure(f'Unknown modifier: {operator}', code=9)
+        for path, argument in fields.items():
+            apply(updated, path, argument, inserting)
+    if updated.get('_id', document.get('_id')) != document.get('_id') and '_id' in document:
+        raise OperationFailure(
+            "Performing an update on the path '_id' would modify the immutable field '_id'", code=66)
+    return updated
+
+
+def _upsert_seed(query):
+    """The fields an upsert copies from its query's equality conditions"""
+    document = {}
+    for key, condition in (query or {}).items():
+        if key == '$and':
+            for clause in condition:
+                document.update(_upsert_seed(clause))
+        elif key.startswith('$'):
+            continue
+        elif _is_operator_document(condition):
+            if '$eq' in condition:
+                _set_path(document, key, condition['$eq'])
+        elif not isinstance(condition, re.Pattern):
+            _set_path(document, key, condition)
+    return document
+
+
+def _normalize_sort(sort, direction=None):
+    if sort is None:
+        return None
+    if isinstance(sort, str):
+        return [(sort, direction or ASCENDING)]
+    if hasattr(sort, 'items'):
+        sort = sort.items()
+    return [tuple(item) if isinstance(item, (list, tuple)) else (item, ASCENDING) for item in sort]
+
+
+def _sort_documents(documents, sort):
+    documents = list(documents)
+    # Stable sorts from the least significant key up
+    for field, direction in reversed(sort):
+        documents.sort(key=lambda document: _sort_key(_first(document, field)), reverse=direction == DESCENDING)
+    return documents
+
+
+# Indexes
+
+def _index_name(keys):
+    return '_'.join(f'{field}_{direction}' for field, direction in keys)
+
+
+class _Index:
+    """A secondary index: key -> ids for unique checks, plus a sorted key list for scans"""
+
+    def __init__(self, name, keys, unique=False, sparse=False, partialFilterExpression=None, **options):
+        self.name = name
+        self.keys = [(field, direction) for field, direction in keys]
+        self.fields = [field for field, _ in self.keys]
+        self.unique = unique
+        self.sparse = sparse
+        self.partial_filter = partialFilterExpression
+        self._partial = compile_query(partialFilterExpression) if partialFilterExpression else None
+        self.options = options
+        self.multikey = False
+        self.entries = {}  # hash key tuple -> set of document ids
+        self.ordered = []  # (sort key tuple, _id sort key, document id)
+        self._deferred = False
+        self._sorted_length = 0
+
+    def info(self):
+        info = {'v': 2, 'key': list(self.keys)}
+        if self.unique:
+            info['unique'] = True
+        if self.sparse:
+            info['sparse'] = True
+        if self.partial_filter is not None:
+            info['partialFilterExpression'] = self.partial_filter
+        for option in ('expireAfterSeconds',):
+            if option in self.options:
+                info[option] = self.options[option]
+        return info
+
+    @property
+    def usable(self):
+        """Sparse and partial indexes don't hold every document, so they can't serve scans"""
+        return not self.sparse and self._partial is None
+
+    def keys_for(self, document):
+        if self._partial is not None and not self._partial(document):
+            return []
+        per_field = []
+        present = False
+        for field in self.fields:
+            values = _lookup(document, field)
+            present = present or bool(values)
+            expanded = []
+            for value in values or [None]:
+                if isinstance(value, list):
+                    self.multikey = True
+                    expanded.extend(value or [None])
+                else:
+                    expanded.append(value)
+            per_field.append(expanded)
+        if self.sparse and not present:
+            return []
+        return list(product(*per_field))
+
+    def add(self, document, document_id):
+        id_key = _sort_key(document['_id'])
+        for key in self.keys_for(document):
+            self.entries.setdefault(tuple(_hash_key(value) for value in key), set()).add(document_id)
+            entry = (tuple(_sort_key(value) for value in key), id_key, document_id)
+            if self._deferred:
+                self.ordered.append(entry)
+            else:
+                insort(self.ordered, entry)
+
+    def defer_sorting(self):
+        """Append new entries unsorted until resume_sorting(), for bulk inserts"""
+        self._deferred = True
+        self._sorted_length = len(self.ordered)
+
+    def resume_sorting(self):
+        self._deferred = False
+        appended = self.ordered[self._sorted_length:]
+        if len(appended) * 16 >= self._sorted_length:
+            self.ordered.sort()
+            return
+        # A small batch into a large index: re-sorting everything would cost
+        # far more than bisecting each new entry into place
+        del self.ordered[self._sorted_length:]
+        for entry in sorted(appended):
+            insort(self.ordered, entry)
+
+    def remove(self, document, document_id):
+        id_key = _sort_key(document['_id'])
+        for key in self.keys_for(document):
+            hashed = tuple(_hash_key(value) for value in key)
+            ids = self.entries.get(hashed)
+            if ids is not None:
+                ids.discard(document_id)
+                if not ids:
+                    del self.entries[hashed]
+            position = bisect_left(self.ordered, (tuple(_sort_key(value) for value in key), id_key))
+            if position < len(self.ordered) and self.ordered[position][2] == document_id:
+                del self.ordered[position]
+
+    def conflict(self, document, document_id):
+        """The key of `document` that another document already has, if any"""
+        if not self.unique:
+            return None
+        for key in self.keys_for(document):
+            ids = self.entries.get(tuple(_hash_key(value) for value in key))
+            if ids and (len(ids) > 1 or document_id not in ids):
+                return key
+        return None
+
+    def scan(self, intervals=None, reverse=False):
+        """Document ids in index order, restricted to intervals of the first field"""
+        if intervals is None:
+            bounds = [(0, len(self.ordered))]
+        else:
+            positions = []
+            for low, low_inclusive, high, high_inclusive in intervals:
+                start = bisect_left(self.ordered, ((low,),) if low_inclusive else ((low, _TOP),))
+                stop = bisect_left(self.ordered, ((high, _TOP),) if high_inclusive else ((high,),))
+                if start < stop:
+                    positions.append((start, stop))
+            # Merge overlapping $in/$or ranges so no entry is visited twice
+            bounds = []
+            for start, stop in sorted(positions):
+                if bounds and start <= bounds[-1][1]:
+                    bounds[-1] = (bounds[-1][0], max(stop, bounds[-1][1]))
+                else:
+                    bounds.append((start, stop))
+        if reverse:
+            bounds.reverse()
+        for start, stop in bounds:
+            positions = range(stop - 1, start - 1, -1) if reverse else range(start, stop)
+            for position in positions:
+                yield self.ordered[position][2]
+
+
+# Collections
+
+class MemoryCursor:
+    """Lazily evaluated result of MemoryCollection.find(), like pymongo's Cursor"""
+
+    def __init__(self, collection, filter=None, projection=None, skip=0, limit=0, sort=None, batch_size=0, **kwargs):
+        self.collection = collection
+        self._filter = filter or {}
+        self._projection = projection
+        self._skip = skip
+        self._limit = limit
+        self._sort = _normalize_sort(sort)
+        self._iterator = None
+
+    def _check_not_started(self):
+        if self._iterator is not None:
+            raise RuntimeError('cannot set options after executing query')
+
+    def sort(self, key_or_list, direction=None):
+        self._check_not_started()
+        self._sort = _normalize_sort(key_or_list, direction)
+        return self
+
+    def limit(self, limit):
+        self._check_not_started()
+        self._limit = limit
+        return self
+
+    def skip(self, skip):
+        self._check_not_started()
+        self._skip = skip
+        return self
+
+    def batch_size(self, batch_size):
+        return self
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self._iterator is None:
+            documents = self.collection._select(self._filter, self._sort, self._skip, abs(self._limit or 0))
+            project = compile_projection(self._projection) or _copy
+            self._iterator = (project(document) for document in documents)
+        return next(self._iterator)
+
+    next = __next__
+
+    def close(self):
+        self._iterator = iter(())
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class MemoryCollection:
+    """In-memory stand-in for a pymongo Collection"""
+
+    def __init__(self, name, database=None):
+        self.name = name
+        self.database = database
+        self._lock = threading.RLock()
+        self._documents = {}  # hashable _id -> document, in insertion order
+        self._indexes = {'_id_': _Index('_id_', [('_id', ASCENDING)], unique=True)}
+
+    @property
+    def full_name(self):
+        return f'{self.database.name}.{self.name}' if self.database is not None else self.name
+
+    def __repr__(self):
+        return f'MemoryCollection({self.name!r})'
+
+    # Planning
+
+    def _candidates(self, query, sort=None):
+        """
+        Stored documents that may match the query, and whether they already
+        come in `sort` order. Uses an index that supports the sort, else an
+        index bounded by the query, else the whole collection.
+        """
+        sort_index = None
+        if sort:
+            directions = {direction for _, direction in sort}
+            fields = [field for field, _ in sort]
+            if len(directions) == 1:
+                sort_index = next((index for index in self._indexes.values()
+                                   if index.usable and index.fields[:len(fields)] == fields), None)
+        bounded = None
+        for index in self._indexes.values():
+            if index.usable:
+                intervals = _field_intervals(query, index.fields[0])
+                if intervals is not None:
+                    bounded = (index, intervals)
+                    if index.unique or index.name == '_id_':
+                        break
+        if sort_index is not None and (bounded is None or bounded[0] is sort_index or sort_index.fields[0] == bounded[0].fields[0]):
+            intervals = _field_intervals(query, sort_index.fields[0])
+            reverse = sort[0][1] == DESCENDING
+            return self._resolve(sort_index.scan(intervals, reverse), sort_index.multikey), True
+        if bounded is not None:
+            index, intervals = bounded
+            return self._resolve(index.scan(intervals), index.multikey), False
+        return list(self._documents.values()), False
+
+    def _resolve(self, document_ids, deduplicate):
+        documents = self._documents
+        seen = set()
+        for document_id in document_ids:
+            if deduplicate:
+                if document_id in seen:
+                    continue
+                seen.add(document_id)
+            yield documents[document_id]
+
+    def _select(self, query, sort=None, skip=0, limit=0):
+        """Matching stored documents (not copies), sorted and sliced"""
+        matches = compile_query(query)
+        with self._lock:
+            candidates, ordered = self._candidates(query, sort)
+            if ordered or not sort:
+                selected = []
+                wanted = skip + limit if limit else None
+                for document in candidates:
+                    if matches(document):
+                        selected.append(document)
+                        if wanted is not None and len(selected) >= wanted:
+                            break
+                return selected[skip:]
+            selected = _sort_documents((document for document in candidates if matches(document)), sort)
+        return selected[skip:skip + limit] if limit else selected[skip:]
+
+    # Writes
+
+    def _duplicate_key_error(self, index, key):
+        key_value = dict(zip(index.fields, key))
+        message = (f'E11000 duplicate key error collection: {self.full_name} index: {index.name} '
+                   f'dup key: {key_value}')
+        return DuplicateKeyError(message, code=11000, details={
+            'code': 11000, 'errmsg': message,
+            'keyPattern': dict(index.keys), 'keyValue': key_value,
+        })
+
+    def _check_unique(self, document, document_id):
+        for index in self._indexes.values():
+            key = index.conflict(document, document_id)
+            if key is not None:
+                raise self._duplicate_key_error(index, key)
+
+    def _insert(self, document):
+        document_id = _hash_key(document['_id'])
+        if document_id in self._documents:
+            raise self._duplicate_key_error(self._indexes['_id_'], (document['_id'],))
+        self._check_unique(document, document_id)
+        self._documents[document_id] = document
+        for index in self._indexes.values():
+            index.add(document, document_id)
+
+    def _replace(self, current, replacement):
+        document_id = _hash_key(current['_id'])
+        for index in self._indexes.values():
+            index.remove(current, document_id)
+        try:
+            self._check_unique(replacement, document_id)
+        except DuplicateKeyError:
+            for index in self._indexes.values():
+                index.add(current, document_id)
+            raise
+        self._documents[document_id] = replacement
+        for index in self._indexes.values():
+            index.add(replacement, document_id)
+        return replacement
+
+    def _delete(self, document):
+        document_id = _hash_key(document['_id'])
+        for index in self._indexes.values():
+            index.remove(document, document_id)
+        del self._documents[document_id]
+
+    def _prepare(self, document):
+        if '_id' not in document:
+            # pymongo adds the generated _id to the caller's document too
+            document['_id'] = ObjectId()
+        return _normalize(document)
+
+    def _upsert(self, query, update, replacement=False):
+        seed = {} if replacement else _upsert_seed(query)
+        document = dict(seed, **update) if replacement else apply_update(seed, update, inserting=True)
+        document.setdefault('_id', ObjectId())
+        document = _normalize(document)
+        self._insert(document)
+        return document
+
+    def insert_one(self, document, **kwargs):
+        with self._lock:
+            self._insert(self._prepare(document))
+        return InsertOneResult(document['_id'], True)
+
+    def insert_many(self, documents, ordered=True, **kwargs):
+        documents = list(documents)
+        inserted_ids, errors = [], []
+        with self._lock:
+            # One sort per index at the end instead of an insort per document
+            for index in self._indexes.values():
+                index.defer_sorting()
+            try:
+                for position, document in enumerate(documents):
+                    try:
+                        self._insert(self._prepare(document))
+                        inserted_ids.append(document['_id'])
+                    except DuplicateKeyError as exc:
+                        errors.append(dict(exc.details, index=position, op=document))
+                        if ordered:
+                            break
+            finally:
+                for index in self._indexes.values():
+                    index.resume_sorting()
+        if errors:
+            raise BulkWriteError({
+                'writeErrors': errors, 'writeConcernErrors': [], 'nInserted': len(inserted_ids),
+                'nUpserted': 0, 'nMatched': 0, 'nModified': 0, 'nRemoved': 0, 'upserted': [],
+            })
+        return InsertManyResult(inserted_ids, True)
+
+    def _update(self, query, update, upsert=False, many=False, replacement=False, sort=None):
+        """Returns (matched, modified, upserted_id, before, after) of the last document written"""
+        if replacement and any(key.startswith('$') for key in update):
+            raise ValueError('replacement can not include $ operators')
+        matched = modified = 0
+        before = after = None
+        with self._lock:
+            for current in self._select(query, sort, limit=0 if many else 1):
+                matched += 1
+                if replacement:
+                    new = _normalize(dict(update, _id=current['_id']))
+                else:
+                    new = _normalize(apply_update(current, update))
+                before, after = current, current
+                if new != current:
+                    after = self._replace(current, new)
+                    modified += 1
+            if matched == 0 and upsert:
+                after = self._upsert(query, update, replacement)
+                return 0, 0, after['_id'], None, after
+        return matched, modified, None, before, after
+
+    def update_one(self, filter, update, upsert=False, **kwargs):
+        matched, modified, upserted_id, _, _ = self._update(filter, update, upsert)
+        return UpdateResult(self._raw_update_result(matched, modified, upserted_id), True)
+
+    def update_many(self, filter, update, upsert=False, **kwargs):
+        matched, modified, upserted_id, _, _ = self._update(filter, update, upsert, many=True)
+        return UpdateResult(self._raw_update_result(matched, modified, upserted_id), True)
+
+    def replace_one(self, filter, replacement, upsert=False, **kwargs):
+        matched, modified, upserted_id, _, _ = self._update(filter, replacement, upsert, replacement=True)
+        return UpdateResult(self._raw_update_result(matched, modified, upserted_id), True)
+
+    @staticmethod
+    def _raw_update_result(matched, modified, upserted_id):
+        raw = {'n': matched or int(upserted_id is not None), 'nModified': modified, 'ok': 1.0,
+               'updatedExisting': bool(matched)}
+        if upserted_id is not None:
+            raw['upserted'] = upserted_id
+        return raw
+
+    def _find_one_and_write(self, filter, update, projection, sort, upsert, return_document, replacement):
+        _, _, _, before, after = self._update(filter, update, upsert, replacement=replacement,
+                                              sort=_normalize_sort(sort))
+        document = after if return_document == ReturnDocument.AFTER else before
+        if document is None:
+            return None
+        return (compile_projection(projection) or _copy)(document)
+
+    def find_one_and_update(self, filter, update, projection=None, sort=None, upsert=False,
+                            return_document=ReturnDocument.BEFORE, **kwargs):
+        return self._find_one_and_write(filter, update, projection, sort, upsert, return_document, False)
+
+    def find_one_and_replace(self, filter, replacement, projection=None, sort=None, upsert=False,
+                             return_document=ReturnDocument.BEFORE, **kwargs):
+        return self._find_one_and_write(filter, replacement, projection, sort, upsert, return_document, True)
+
+    def find_one_and_delete(self, filter, projection=None, sort=None, **kwargs):
+        with self._lock:
+            documents = self._select(filter, _normalize_sort(sort), limit=1)
+            if not documents:
+                return None
+            self._delete(documents[0])
+        return (compile_projection(projection) or _copy)(documents[0])
+
+    def delete_one(self, filter, **kwargs):
+        with self._lock:
+            documents = self._select(filter, limit=1)
+            for document in documents:
+                self._delete(document)
+        return DeleteResult({'n': len(documents), 'ok': 1.0}, True)
+
+    def delete_many(self, filter, **kwargs):
+        with self._lock:
+            documents = self._select(filter)
+            for document in documents:
+                self._delete(document)
+        return DeleteResult({'n': len(documents), 'ok': 1.0}, True)
+
+    def bulk_write(self, requests, ordered=True, **kwargs):
+        result = {'writeErrors': [], 'writeConcernErrors': [], 'nInserted': 0, 'nUpserted': 0,
+                  'nMatched': 0, 'nModified': 0, 'nRemoved': 0, 'upserted': []}
+        with self._lock:
+            for position, request in enumerate(requests):
+                try:
+                    self._bulk_operation(request, position, result)
+                except DuplicateKeyError as exc:
+                    result['writeErrors'].append(dict(exc.details, index=position, op=request))
+                    if ordered:
+                        break
+        if result['writeErrors']:
+            raise BulkWriteError(result)
+        return BulkWriteResult(result, True)
+
+    def _bulk_operation(self, request, position, result):
+        if isinstance(request, InsertOne):
+            self._insert(self._prepare(request._doc))
+            result['nInserted'] += 1
+        elif isinstance(request, (UpdateOne, UpdateMany, ReplaceOne)):
+            matched, modified, upserted_id, _, _ = self._update(
+                request._filter, request._doc, request._upsert,
+                many=isinstance(request, UpdateMany), replacement=isinstance(request, ReplaceOne))
+            result['nMatched'] += matched
+            result['nModified'] += modified
+            if upserted_id is not None:
+                result['nUpserted'] += 1
+                result['upserted'].append({'index': position, '_id': upserted_id})
+        elif isinstance(request, (DeleteOne, DeleteMany)):
+            deleted = (self.delete_many if isinstance(request, DeleteMany) else self.delete_one)(request._filter)
+            result['nRemoved'] += deleted.deleted_count
+        else:
+            raise TypeError(f'{request!r} is not a valid request')
+
+    # Reads
+
+    def find(self, *args, **kwargs):
+        return MemoryCursor(self, *args, **kwargs)
+
+    def find_one(self, filter=None, *args, **kwargs):
+        if filter is not None and not isinstance(filter, dict):
+            filter = {'_id': filter}
+        kwargs['limit'] = 1
+        return next(MemoryCursor(self, filter, *args, **kwargs), None)
+
+    def count_documents(self, filter, skip=0, limit=0, **kwargs):
+        return len(self._select(filter, skip=skip, limit=limit))
+
+    def estimated_document_count(self, **kwargs):
+        return len(self._documents)
+
+    def distinct(self, key, filter=None, **kwargs):
+        values = {}
+        for document in self._select(filter or {}):
+            for value in _lookup(document, key):
+                for item in (value if isinstance(value, list) else [value]):
+                    values.setdefault(_hash_key(item), item)
+        return [_copy(value) for value in values.values()]
+
+    def aggregate(self, pipeline, **kwargs):
+        with self._lock:
+            documents = list(self._documents.values())
+        return iter([_copy(document) for document in run_pipeline(self, documents, pipeline)])
+
+    # Indexes
+
+    def create_index(self, keys, **kwargs):
+        if isinstance(keys, str):
+            keys = [(keys, ASCENDING)]
+        keys = [(field, direction) for field, direction in (keys.items() if hasattr(keys, 'items') else keys)]
+        name = kwargs.pop('name', None) or _index_name(keys)
+        kwargs.pop('background', None)
+        with self._lock:
+            existing = self._indexes.get(name)
+            if existing is not None:
+                if existing.keys != keys or existing.unique != kwargs.get('unique', False):
+                    raise OperationFailure(
+                        f'An existing index has the same name as the requested index: {name}', code=86)
+                return name
+            index = _Index(name, keys, **kwargs)
+            for document_id, document in self._documents.items():
+                key = index.conflict(document, document_id)
+                if key is not None:
+                    raise self._duplicate_key_error(index, key)
+                index.add(document, document_id)
+            self._indexes[name] = index
+        return name
+
+    def create_indexes(self, indexes, **kwargs):
+        names = []
+        for model in indexes:
+            document = dict(model.document)
+            keys = document.pop('key')
+            names.append(self.create_index(list(keys.items()), **document))
+        return names
+
+    def index_information(self):
+        return {name: index.info() for name, index in self._indexes.items()}
+
+    def list_indexes(self):
+        return iter([dict(index.info(), name=name) for name, index in self._indexes.items()])
+
+    def drop_index(self, index_or_name):
+        name = index_or_name if isinstance(index_or_name, str) else _index_name(index_or_name)
+        with self._lock:
+            if name == '_id_' or name not in self._indexes:
+                raise OperationFailure(f'index not found with name [{name}]', code=27)
+            del self._indexes[name]
+
+    def drop_indexes(self):
+        with self._lock:
+            self._indexes = {'_id_': self._indexes['_id_']}
+
+    def drop(self):
+        with self._lock:
+            self._documents = {}
+            for index in self._indexes.values():
+                index.entries, index.ordered = {}, []
+
+
+class MemoryDatabase:
+    """Named set of MemoryCollections, created on first access like pymongo's Database"""
+
+    def __init__(self, name='memory'):
+        self.name = name
+        self._lock = threading.Lock()
+        self._collections = {}
+
+    def get_collection(self, name):
+        with self._lock:
+            collection = self._collections.get(name)
+            if collection is None:
+                collection = self._collections[name] = MemoryCollection(name, self)
+            return collection
+
+    __getitem__ = get_collection
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        return self.get_collection(name)
+
+    def list_collection_names(self):
+        return list(self._collections)
+
+    def drop_collection(self, name):
+        with self._lock:
+            self._collections.pop(getattr(name, 'name', name), None)
+
+    def command(self, command, *args, **kwargs):
+        if command == 'ping' or command == {'ping': 1}:
+            return {'ok': 1.0}
+        raise OperationFailure(f'no such command: {command!r}', code=59)
+
+
+# Aggregation
+
+def _arguments(argument, document):
+    if isinstance(argument, list):
+        return [evaluate(item, document) for item in argument]
+    return [evaluate(argument, document)]
+
+
+def _string_case(convert):
+    def apply(argument, document):
+        value = _arguments(argument, document)[0]
+        return '' if value is None else convert(str(value))
+    return apply
+
+
+def _numeric(combine):
+    def apply(argument, document):
+        values = _arguments(argument, document)
+        if any(value is None for value in values):
+            return None
+        result = values[0]
+        for value in values[1:]:
+            result = combine(result, value)
+        return result
+    return apply
+
+
+def _comparison(test):
+    def apply(argument, document):
+        first, second = _arguments(argument, document)
+        first, second = _sort_key(first), _sort_key(second)
+        return test((first > second) - (first < second))
+    return apply
+
+
+def _cond(argument, document):
+    if isinstance(argument, list):
+        condition, then, otherwise = argument
+    else:
+        condition, then, otherwise = argument['if'], argument['then'], argument['else']
+    return evaluate(then if evaluate(condition, document) else otherwise, document)
+
+
+def _if_null(argument, document):
+    for value in _arguments(argument, document):
+        if value is not None:
+            return value
+    return None
+
+
+def _concat(argument, document):
+    values = _arguments(argument, document)
+    return None if any(value is None for value in values) else ''.join(values)
+
+
+_WEEKDAYS = ('monday', 'tuesday', 'wednesday', 'thursday', 'friday', 'saturday', 'sunday')
+
+
+def _date_trunc(argument, document):
+    """$dateTrunc of a naive UTC date, for binSize 1 and no timezone"""
+    date = evaluate(argument['date'], document)
+    if not isinstance(date, datetime):
+        return None
+    unit = argument['unit']
+    if unit == 'year':
+        return datetime(date.year, 1, 1)
+    if unit == 'month':
+        return datetime(date.year, date.month, 1)
+    day = datetime(date.year, date.month, date.day)
+    if unit == 'day':
+        return day
+    if unit == 'week':
+        # Full names or three-letter abbreviations, as MongoDB accepts
+        name = argument.get('startOfWeek', 'sunday').lower()[:3]
+        start = next(index for index, weekday in enumerate(_WEEKDAYS) if weekday.startswith(name))
+        return day - timedelta(days=(day.weekday() - start) % 7)
+    raise OperationFailure(f"$dateTrunc unit '{unit}' is not supported", code=5439014)
+
+
+_EXPRESSIONS = {
+    '$literal': lambda argument, document: argument,
+    '$toUpper': _string_case(str.upper),
+    '$toLower': _string_case(str.lower),
+    '$add': _numeric(lambda a, b: a + b),
+    '$subtract': _numeric(lambda a, b: a - b),
+    '$multiply': _numeric(lambda a, b: a * b),
+    '$divide': _numeric(lambda a, b: a / b),
+    '$eq': _comparison(lambda c: c == 0),
+    '$ne': _comparison(lambda c: c != 0),
+    '$gt': _comparison(lambda c: c > 0),
+    '$gte': _comparison(lambda c: c >= 0),
+    '$lt': _comparison(lambda c: c < 0),
+    '$lte': _comparison(lambda c: c <= 0),
+    '$and': lambda argument, document: all(_arguments(argument, document)),
+    '$or': lambda argument, document: any(_arguments(argument, document)),
+    '$cond': _cond,
+    '$ifNull': _if_null,
+    '$concat': _concat,
+    '$dateTrunc': _date_trunc,
+}
+
+
+def evaluate(expression, document):
+    """Value of an aggregation expression for one document"""
+    if isinstance(expression, str) and expression.startswith('$'):
+        if expression == '$$ROOT':
+            return document
+        values = _lookup(document, expression[1:])
+        return values[0] if values else None
+    if isinstance(expression, dict):
+        if len(expression) == 1 and next(iter(expression)).startswith('$'):
+            operator, argument = next(iter(expression.items()))
+            apply = _EXPRESSIONS.get(operator)
+            if apply is None:
+                raise OperationFailure(f"Unrecognized expression '{operator}'", code=168)
+            return apply(argument, document)
+        return {key: evaluate(value, document) for key, value in expression.items()}
+    if isinstance(expression, list):
+        return [evaluate(item, document) for item in expression]
+    return expression
+
+
+class _Accumulator:
+    def __init__(self, operator, expression):
+        self.operator = operator
+        self.expression = expression
+        self.values = []
+
+    def add(self, document):
+        self.values.append(evaluate(self.expression, document) if self.operator != '$count' else 1)
+
+    def result(self):
+        values = self.values
+        if self.operator in ('$sum', '$count'):
+            return sum(value for value in values if _is_number(value))
+        if self.operator == '$avg':
+            numbers = [value for value in values if _is_number(value)]
+            return sum(numbers) / len(numbers) if numbers else None
+        if self.operator in ('$min', '$max'):
+            present = [value for value in values if value is not None]
+            if not present:
+                return None
+            pick = min if self.operator == '$min' else max
+            return pick(present, key=_sort_key)
+        if self.operator == '$first':
+            return values[0] if values else None
+        if self.operator == '$last':
+            return values[-1] if values else None
+        if self.operator == '$push':
+            return values
+        if self.operator == '$addToSet':
+            return list({_hash_key(value): value for value in values}.values())
+        raise OperationFailure(f'unknown group operator {self.operator!r}', code=15952)
+
+
+def _group(documents, specification):
+    accumulators = {}
+    for field, accumulator in specification.items():
+        if field != '_id':
+            (operator, expression), = accumulator.items()
+            accumulators[field] = (operator, expression)
+    groups = {}
+    for document in documents:
+        key = evaluate(specification['_id'], document)
+        group = groups.get(_hash_key(key))
+        if group is None:
+            group = groups[_hash_key(key)] = (key, {
+                field: _Accumulator(operator, expression) for field, (operator, expression) in accumulators.items()
+            })
+        for accumulator in group[1].values():
+            accumulator.add(document)
+    return [
+        dict({'_id': key}, **{field: accumulator.result() for field, accumulator in fields.items()})
+        for key, fields in groups.values()
+    ]
+
+
+def _project(documents, specification):
+    include_id = specification.get('_id', 1) not in (0, False)
+    fields = {key: value for key, value in specification.items() if key != '_id'}
+    excluding = fields and all(value in (0, False) for value in fields.values())
+    projected = []
+    for document in documents:
+        if excluding:
+            output = {key: value for key, value in document.items() if key not in fields}
+        else:
+            output = {}
+            for key, value in fields.items():
+                if value in (1, True):
+                    values = _lookup(document, key)
+                    if values:
+                        output[key] = values[0]
+                else:
+                    output[key] = evaluate(value, document)
+        if include_id and '_id' in document:
+            output = dict({'_id': evaluate(specification['_id'], document)
+                           if isinstance(specification.get('_id'), (str, dict)) else document['_id']}, **output)
+        elif not include_id:
+            output.pop('_id', None)
+        projected.append(output)
+    return projected
+
+
+def _add_fields(documents, specification):
+    return [dict(document, **{key: evaluate(value, document) for key, value in specification.items()})
+            for document in documents]
+
+
+def _unwind(documents, specification):
+    if isinstance(specification, str):
+        specification = {'path': specification}
+    path = specification['path'][1:]
+    keep_empty = specification.get('preserveNullAndEmptyArrays', False)
+    unwound = []
+    for document in documents:
+        value = _get_path(document, path, None)
+        if isinstance(value, list) and value:
+            for item in value:
+                output = _copy(document)
+                _set_path(output, path, item)
+                unwound.append(output)
+        elif value is not None and not isinstance(value, list):
+            unwound.append(document)
+        elif keep_empty:
+            unwound.append(document)
+    return unwound
+
+
+def _window_fields(documents, specification):
+    """$setWindowFields with the rank operators ($rank, $denseRank, $documentNumber)"""
+    partitions = {}
+    for document in documents:
+        key = evaluate(specification.get('partitionBy'), document)
+        partitions.setdefault(_hash_key(key), []).append(document)
+    sort = _normalize_sort(list(specification.get('sortBy', {}).items()))
+    output = []
+    for members in partitions.values():
+        members = _sort_documents(members, sort) if sort else members
+        previous, rank, dense_rank = None, 0, 0
+        for number, document in enumerate(members, start=1):
+            key = tuple(_sort_key(_first(document, field)) for field, _ in sort or ())
+            if key != previous:
+                rank, dense_rank, previous = number, dense_rank + 1, key
+            values = {'$rank': rank, '$denseRank': dense_rank, '$documentNumber': number}
+            extra = {}
+            for field, window in specification['output'].items():
+                (operator, _), = window.items()
+                if operator not in values:
+                    raise OperationFailure(f'Unsupported window operator {operator}', code=5371601)
+                extra[field] = values[operator]
+            output.append(dict(document, **extra))
+    return output
+
+
+def _merge(collection, documents, specification):
+    target = specification['into'] if isinstance(specification, dict) else specification
+    specification = specification if isinstance(specification, dict) else {}
+    target = collection.database[target] if collection.database is not None else collection
+    on = specification.get('on', '_id')
+    on = [on] if isinstance(on, str) else list(on)
+    when_matched = specification.get('whenMatched', 'merge')
+    when_not_matched = specification.get('whenNotMatched', 'insert')
+    for document in documents:
+        query = {field: document.get(field) for field in on}
+        existing = target.find_one(query)
+        if existing is None:
+            if when_not_matched == 'fail':
+                raise OperationFailure('$merge could not find a matching document in the target collection', code=13113)
+            if when_not_matched == 'insert':
+                target.insert_one(dict(document))
+        elif when_matched == 'fail':
+            raise target._duplicate_key_error(target._indexes['_id_'], (existing['_id'],))
+        elif when_matched == 'replace':
+            target.replace_one({'_id': existing['_id']}, {k: v for k, v in document.items() if k != '_id'})
+        elif when_matched == 'merge':
+            fields = {k: v for k, v in document.items() if k != '_id'}
+            if fields:
+                target.update_one({'_id': existing['_id']}, {'$set': fields})
+    return []
+
+
+def run_pipeline(collection, documents, pipeline):
+    """Run the supported subset of aggregation stages over stored documents"""
+    for stage in pipeline:
+        (name, specification), = stage.items()
+        if name == '$match':
+            matches = compile_query(specification)
+            documents = [document for document in documents if matches(document)]
+        elif name == '$project':
+            documents = _project(documents, specification)
+        elif name in ('$addFields', '$set'):
+            documents = _add_fields(documents, specification)
+        elif name == '$unset':
+            fields = [specification] if isinstance(specification, str) else specification
+            documents = _project(documents, {field: 0 for field in fields})
+        elif name == '$group':
+            documents = _group(documents, specification)
+        elif name == '$sort':
+            documents = _sort_documents(documents, _normalize_sort(list(specification.items())))
+        elif name == '$skip':
+            documents = documents[specification:]
+        elif name == '$limit':
+            documents = documents[:specification]
+        elif name == '$count':
+            documents = [{specification: len(documents)}] if documents else []
+        elif name == '$unwind':
+            documents = _unwind(documents, specification)
+        elif name == '$unionWith':
+            if isinstance(specification, str):
+                specification = {'coll': specification}
+            other = collection.database[specification['coll']] if collection.database is not None else collection
+            with other._lock:
+                other_documents = list(other._documents.values())
+            documents = documents + run_pipeline(other, other_documents, specification.get('pipeline', []))
+        elif name == '$setWindowFields':
+            documents = _window_fields(documents, specification)
+        elif name == '$merge':
+            documents = _merge(collection, documents, specification)
+        else:
+            raise OperationFailure(f"Unrecognized pipeline stage name: '{name}'", code=40324)
+    return documents
@@ -0,0 +1,612 @@
+import asyncio
+import json
+import mmap
+import os
+import struct
+import threading
+import time
+from bisect import bisect_left
+
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+from pymongo import monitoring
+
+# Prometheus metrics (API_METRICS), served in the text exposition format on
+# /metrics without depending on prometheus_client:
+#
+#     octofit_http_requests_total{route,method,status}            counter
+#     octofit_http_request_duration_seconds{route,method}         histogram
+#     octofit_http_requests_in_progress{method}                   gauge
+#     octofit_mongodb_command_duration_seconds{command}           histogram
+#     octofit_mongodb_command_failures_total{command}             counter
+#     octofit_mongodb_pool_checkout_wait_seconds                  histogram
+#     octofit_mongodb_pool_checkout_failures_total{reason}        counter
+#     octofit_cache_lookups_total{resource,result}                counter
+#
+# Routes are URL names, so label sets stay bounded. The cache hit ratio is
+# rate(lookups{result="hit"}) / rate(lookups) on the Prometheus side.
+#
+# Each labelled child holds its own lock, taken only to add to its values;
+# looking a child up is a dict read. By default values live in the process
+# and /metrics reports that process alone. With API_METRICS_MULTIPROCESS_DIR
+# set, every process writes its values to memory-mapped files in that shared
+# directory instead (total_<pid>.db for counters and histograms, live_<pid>.db
+# for gauges), and /metrics sums the files of all processes: counters and
+# histograms of exited workers are kept, gauges only count live processes.
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+POOL_WAIT_BUCKETS = (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0)
+
+
+def enabled():
+    return getattr(settings, 'API_METRICS', False)
+
+
+def multiprocess_dir():
+    return getattr(settings, 'API_METRICS_MULTIPROCESS_DIR', None)
+
+
+# Value storage
+
+class LocalValue:
+    __slots__ = ('value',)
+
+    def __init__(self):
+        self.value = 0.0
+
+    def add(self, amount):
+        self.value += amount
+
+    def set(self, value):
+        self.value = value
+
+    def get(self):
+        return self.value
+
+
+class MmapFile:
+    """
+    Append-only map of sample keys to float64 values in a memory-mapped file,
+    written by one process and read by any. Layout: the number of bytes used
+    (uint32, padded to 8), then per entry the key length (uint32), the UTF-8
+    key padded to 8 bytes and the value.
+    """
+    initial_size = 1 << 16
+    header_size = 8
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._file = open(path, 'a+b')
+        if os.fstat(self._file.fileno()).st_size == 0:
+            self._file.truncate(self.initial_size)
+        self._capacity = os.fstat(self._file.fileno()).st_size
+        self._map = mmap.mmap(self._file.fileno(), self._capacity)
+        self._used = struct.unpack_from('I', self._map, 0)[0] or self.header_size
+        # A pid reused after a crash continues the earlier process's totals
+        self._positions = {key: position for key, position, _ in _entries(self._map, self._used)}
+
+    def position(self, key):
+        """Offset of a key's value, appending the key on first use"""
+        position = self._positions.get(key)
+        if position is not None:
+            return position
+        with self._lock:
+            position = self._positions.get(key)
+            if position is None:
+                position = self._positions[key] = self._append(key)
+        return position
+
+    def _append(self, key):
+        encoded = key.encode('utf-8')
+        position = _value_position(self._used, len(encoded))
+        end = position + 8
+        if end > self._capacity:
+            while end > self._capacity:
+                self._capacity *= 2
+            self._file.truncate(self._capacity)
+            # The old map stays valid for writers still holding it; both map
+            # the same file
+            self._map = mmap.mmap(self._file.fileno(), self._capacity)
+        struct.pack_into(f'I{len(encoded)}s', self._map, self._used, len(encoded), encoded)
+        struct.pack_into('d', self._map, position, 0.0)
+        # Publish the entry to readers last
+        self._used = end
+        struct.pack_into('I', self._map, 0, self._used)
+        return position
+
+    def read(self, position):
+        return struct.unpack_from('d', self._map, position)[0]
+
+    def write(self, position, value):
+        struct.pack_into('d', self._map, position, value)
+
+
+def _value_position(offset, key_length):
+    end = offset + 4 + key_length
+    return end + (-end % 8)
+
+
+def _entries(data, used):
+    offset = MmapFile.header_size
+    while offset < used:
+        length = struct.unpack_from('I', data, offset)[0]
+        key = bytes(data[offset + 4:offset + 4 + length]).decode('utf-8')
+        position = _value_position(offset, length)
+        yield key, position, struct.unpack_from('d', data, position)[0]
+        offset = position + 8
+
+
+def read_file(path):
+    """The (key, value) entries of a metrics file"""
+    with open(path, 'rb') as f:
+        data = f.read()
+    if len(data) < MmapFile.header_size:
+        return []
+    used = struct.unpack_from('I', data, 0)[0]
+    return [(key, value) for key, _, value in _entries(data, used)]
+
+
+class MmapValue:
+    __slots__ = ('file', 'position')
+
+    def __init__(self, file, position):
+        self.file = file
+        self.position = position
+
+    def add(self, amount):
+        self.file.write(self.position, self.file.read(self.position) + amount)
+
+    def set(self, value):
+        self.file.write(self.position, value)
+
+    def get(self):
+        return self.file.read(self.position)
+
+
+class LocalStore:
+    def value(self, key, live=False):
+        return LocalValue()
+
+
+class MmapStore:
+    def __init__(self, directory):
+        self.directory = directory
+        self.pid = os.getpid()
+        self._lock = threading.Lock()
+        self._files = {}
+
+    def value(self, key, live=False):
+        kind = 'live' if live else 'total'
+        with self._lock:
+            file = self._files.get(kind)
+            if file is None:
+                path = os.path.join(self.directory, f'{kind}_{self.pid}.db')
+                if live and os.path.exists(path):
+                    # Left by an earlier process with this pid; its gauges are stale
+                    os.remove(path)
+                file = self._files[kind] = MmapFile(path)
+        return MmapValue(file, file.position(key))
+
+
+def _sample_key(name, suffix, labels):
+    return json.dumps([name, suffix, labels])
+
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+# Metrics
+
+class Metric:
+    type = None
+    live = False
+
+    def __init__(self, registry, name, documentation, labelnames=()):
+        self.registry = registry
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        self._children = {}
+        registry.register(self)
+
+    def labels(self, *values):
+        values = tuple(str(value) for value in values)
+        child = self._children.get(values)
+        if child is None:
+            if len(values) != len(self.labelnames):
+                raise ValueError(f'{self.name} takes labels {self.labelnames}')
+            with self._lock:
+                child = self._children.get(values)
+                if child is None:
+                    child = self._children[values] = self._child(list(zip(self.labelnames, values)))
+        return child
+
+    def _value(self, suffix, labels):
+        return self.registry.store.value(_sample_key(self.name, suffix, labels), self.live)
+
+    def reset(self):
+        self._children = {}
+
+    def samples(self):
+        """(suffix, labels, value) of every child of this process"""
+        for child in list(self._children.values()):
+            yield from child.samples()
+
+
+class _CounterChild:
+    def __init__(self, metric, labels):
+        self._lock = threading.Lock()
+        self._labels = labels
+        self._value = metric._value('', labels)
+
+    def inc(self, amount=1):
+        with self._lock:
+            self._value.add(amount)
+
+    def samples(self):
+        yield '', self._labels, self._value.get()
+
+
+class Counter(Metric):
+    type = 'counter'
+
+    def _child(self, labels):
+        return _CounterChild(self, labels)
+
+
+class _GaugeChild:
+    def __init__(self, metric, labels):
+        self._lock = threading.Lock()
+        self._labels = labels
+        self._value = metric._value('', labels)
+
+    def inc(self, amount=1):
+        with self._lock:
+            self._value.add(amount)
+
+    def dec(self, amount=1):
+        self.inc(-amount)
+
+    def set(self, value):
+        with self._lock:
+            self._value.set(value)
+
+    def samples(self):
+        yield '', self._labels, self._value.get()
+
+
+class Gauge(Metric):
+    """A gauge; across processes the values of the live ones are summed"""
+    type = 'gauge'
+    live = True
+
+    def _child(self, labels):
+        return _GaugeChild(self, labels)
+
+
+class _HistogramChild:
+    def __init__(self, metric, labels):
+        self._lock = threading.Lock()
+        self._labels = labels
+        self._bounds = metric.buckets
+        # Observations per bucket, not cumulative; exposition adds them up
+        self._buckets = [
+            metric._value('_bucket', labels + [['le', _format_bound(bound)]])
+            for bound in metric.buckets + (float('inf'),)
+        ]
+        self._sum = metric._value('_sum', labels)
+
+    def observe(self, value):
+        bucket = self._buckets[bisect_left(self._bounds, value)]
+        with self._lock:
+            bucket.add(1)
+            self._sum.add(value)
+
+    def samples(self):
+        for bound, bucket in zip(self._bounds + (float('inf'),), self._buckets):
+            yield '_bucket', self._labels + [['le', _format_bound(bound)]], bucket.get()
+        yield '_sum', self._labels, self._sum.get()
+
+
+class Histogram(Metric):
+    type = 'histogram'
+
+    def __init__(self, registry, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+        self.buckets = tuple(float(bound) for bound in buckets)
+        super().__init__(registry, name, documentation, labelnames)
+
+    def _child(self, labels):
+        return _HistogramChild(self, labels)
+
+
+def _format_bound(bound):
+    return '+Inf' if bound == float('inf') else repr(bound)
+
+
+def _escape(value):
+    return value.replace('\\', r'\\').replace('\n', r'\n').replace('"', r'\"')
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in labels) + '}'
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value))
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = []
+        self._store = None
+        self._lock = threading.Lock()
+
+    def register(self, metric):
+        self._metrics.append(metric)
+
+    @property
+    def store(self):
+        if self._store is None:
+            with self._lock:
+                if self._store is None:
+                    directory = multiprocess_dir()
+                    self._store = MmapStore(directory) if directory else LocalStore()
+        return self._store
+
+    def reset(self):
+        """Drop every value; the store is rebuilt from settings on next use"""
+        with self._lock:
+            self._store = None
+            for metric in self._metrics:
+                metric.reset()
+
+    def after_fork_in_child(self):
+        # A child starts from zero, in its own files
+        self._lock = threading.Lock()
+        self._store = None
+        for metric in self._metrics:
+            metric._lock = threading.Lock()
+            metric.reset()
+
+    def collect(self):
+        """{(name, suffix, labels): value} of this process, or of all processes in multiprocess mode"""
+        if isinstance(self.store, MmapStore):
+            return self._collect_files(self.store.directory)
+        return {
+            (metric.name, suffix, json.dumps(labels)): value
+            for metric in self._metrics for suffix, labels, value in metric.samples()
+        }
+
+    def _collect_files(self, directory):
+        values = {}
+        for filename in sorted(os.listdir(directory)):
+            kind, _, rest = filename.partition('_')
+            pid = rest[:-len('.db')]
+            if not filename.endswith('.db') or kind not in ('live', 'total') or not pid.isdigit():
+                continue
+            if kind == 'live' and not _pid_alive(int(pid)):
+                continue
+            for key, value in read_file(os.path.join(directory, filename)):
+                name, suffix, labels = json.loads(key)
+                key = (name, suffix, json.dumps(labels))
+                values[key] = values.get(key, 0.0) + value
+        return values
+
+    def exposition(self):
+        """All metrics in the Prometheus text format"""
+        by_metric = {}
+        for (name, suffix, labels), value in self.collect().items():
+            by_metric.setdefault(name, []).append((suffix, json.loads(labels), value))
+        lines = []
+        for metric in self._metrics:
+            lines.append(f'# HELP {metric.name} {metric.documentation}')
+            lines.append(f'# TYPE {metric.name} {metric.type}')
+            samples = sorted(by_metric.get(metric.name, []), key=lambda sample: json.dumps(sample[1]))
+            if metric.type == 'histogram':
+                lines.extend(self._histogram_lines(metric, samples))
+            else:
+                lines.extend(
+                    f'{metric.name}{suffix}{_format_labels(labels)} {_format_value(value)}'
+                    for suffix, labels, value in samples
+                )
+        return '\n'.join(lines) + '\n'
+
+    def _histogram_lines(self, metric, samples):
+        series = {}
+        for suffix, labels, value in samples:
+            if suffix == '_bucket':
+                labels, bound = labels[:-1], labels[-1][1]
+                series.setdefault(json.dumps(labels), {'buckets': {}, 'sum': 0.0})['buckets'][bound] = value
+            else:
+                series.setdefault(json.dumps(labels), {'buckets': {}, 'sum': 0.0})['sum'] = value
+        for key, values in series.items():
+            labels = json.loads(key)
+            count = 0.0
+            for bound in metric.buckets + (float('inf'),):
+                count += values['buckets'].get(_format_bound(bound), 0.0)
+                yield f"{metric.name}_bucket{_format_labels(labels + [['le', _format_bound(bound)]])} {_format_value(count)}"
+            yield f"{metric.name}_sum{_format_labels(labels)} {_format_value(values['sum'])}"
+            yield f"{metric.name}_count{_format_labels(labels)} {_format_value(count)}"
+
+
+# Metrics registry of the current process
+registry = Registry()
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=registry.after_fork_in_child)
+
+http_requests = Counter(
+    registry, 'octofit_http_requests_total', 'HTTP requests by route, method and status',
+    ('route', 'method', 'status'),
+)
+http_request_duration = Histogram(
+    registry, 'octofit_http_request_duration_seconds', 'Latency of HTTP requests by route and method',
+    ('route', 'method'),
+)
+http_requests_in_progress = Gauge(
+    registry, 'octofit_http_requests_in_progress', 'HTTP requests being handled', ('method',),
+)
+mongodb_command_duration = Histogram(
+    registry, 'octofit_mongodb_command_duration_seconds', 'Duration of MongoDB commands by command name',
+    ('command',),
+)
+mongodb_command_failures = Counter(
+    registry, 'octofit_mongodb_command_failures_total', 'Failed MongoDB commands by command name', ('command',),
+)
+mongodb_pool_checkout_wait = Histogram(
+    registry, 'octofit_mongodb_pool_checkout_wait_seconds', 'Time spent waiting for a MongoDB pool connection',
+    buckets=POOL_WAIT_BUCKETS,
+)
+mongodb_pool_checkout_failures = Counter(
+    registry, 'octofit_mongodb_pool_checkout_failures_total', 'MongoDB pool checkouts that failed, by reason',
+    ('reason',),
+)
+cache_lookups = Counter(
+    registry, 'octofit_cache_lookups_total', 'Response cache lookups by resource and result (hit or miss)',
+    ('resource', 'result'),
+)
+
+
+# Collection
+
+class CommandMetricsListener(monitoring.CommandListener):
+    def started(self, event):
+        pass
+
+    def succeeded(self, event):
+        mongodb_command_duration.labels(event.command_name).observe(event.duration_micros / 1e6)
+
+    def failed(self, event):
+        mongodb_command_duration.labels(event.command_name).observe(event.duration_micros / 1e6)
+        mongodb_command_failures.labels(event.command_name).inc()
+
+
+class PoolMetricsListener(monitoring.ConnectionPoolListener):
+    """
+    Times connection checkouts. pymongo publishes the start and the end of a
+    checkout from the thread checking out, so a thread-local start suffices.
+    """
+
+    def __init__(self):
+        self._local = threading.local()
+
+    def connection_check_out_started(self, event):
+        self._local.started = time.perf_counter()
+
+    def connection_checked_out(self, event):
+        self._observe()
+
+    def connection_check_out_failed(self, event):
+        self._observe()
+        mongodb_pool_checkout_failures.labels(event.reason).inc()
+
+    def _observe(self):
+        started = getattr(self._local, 'started', None)
+        if started is not None:
+            self._local.started = None
+            mongodb_pool_checkout_wait.labels().observe(time.perf_counter() - started)
+
+    def pool_created(self, event):
+        pass
+
+    def pool_ready(self, event):
+        pass
+
+    def pool_cleared(self, event):
+        pass
+
+    def pool_closed(self, event):
+        pass
+
+    def connection_created(self, event):
+        pass
+
+    def connection_ready(self, event):
+        pass
+
+    def connection_closed(self, event):
+        pass
+
+    def connection_checked_in(self, event):
+        pass
+
+
+command_listener = CommandMetricsListener()
+pool_listener = PoolMetricsListener()
+
+
+def event_listeners():
+    """The event_listeners option for new MongoClients"""
+    return [command_listener, pool_listener] if enabled() else []
+
+
+# Request methods labelled by name; any other method is counted as 'other',
+# since clients choose it and every label value is a series of its own
+HTTP_METHODS = frozenset(('GET', 'HEAD', 'POST', 'PUT', 'PATCH', 'DELETE', 'OPTIONS', 'TRACE', 'CONNECT'))
+
+
+def method_label(method):
+    return method if method in HTTP_METHODS else 'other'
+
+
+class MetricsMiddleware:
+    """
+    Counts and times every request by route (the URL name) and tracks the
+    requests in progress. Works in both sync and async middleware chains.
+    """
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        if not enabled():
+            raise MiddlewareNotUsed
+        self.get_response = get_response
+        if asyncio.iscoroutinefunction(get_response):
+            # Mark the instance as a coroutine function, as Django's MiddlewareMixin does
+            self._is_coroutine = asyncio.coroutines._is_coroutine
+
+    def __call__(self, request):
+        if asyncio.iscoroutinefunction(self.get_response):
+            return self.__acall__(request)
+        in_progress = http_requests_in_progress.labels(method_label(request.method))
+        in_progress.inc()
+        started = time.perf_counter()
+        try:
+            response = self.get_response(request)
+        finally:
+            in_progress.dec()
+        self.observe(request, response, started)
+        return response
+
+    async def __acall__(self, request):
+        in_progress = http_requests_in_progress.labels(method_label(request.method))
+        in_progress.inc()
+        started = time.perf_counter()
+        try:
+            response = await self.get_response(request)
+        finally:
+            in_progress.dec()
+        self.observe(request, response, started)
+        return response
+
+    def observe(self, request, response, started):
+        match = getattr(request, 'resolver_match', None)
+        route = match.url_name if match is not None and match.url_name else 'unmatched'
+        method = method_label(request.method)
+        http_request_duration.labels(route, method).observe(time.perf_counter() - started)
+        http_requests.labels(route, method, response.status_code).inc()
@@ -1,211 +1,184 @@
 from django.db import models
-from pymongo import MongoClient
-from django.conf import settings
 from bson import ObjectId
+from pymongo import ASCENDING, DESCENDING, IndexModel
 import logging
 
+from .mongo import CollectionProxy
+
 # Set up logging
 logger = logging.getLogger(__name__)
 
-# Try to connect to MongoDB but handle errors gracefully
-try:
-    # Connect to MongoDB
-    client = MongoClient(settings.MONGODB_HOST, settings.MONGODB_PORT, serverSelectionTimeoutMS=5000)
-    # Test the connection
-    client.server_info()
-    db = client[settings.MONGODB_NAME]
-
-    # MongoDB Collections
-    users_collection = db.users
-    teams_collection = db.teams
-    activities_collection = db.activities
-    leaderboard_collection = db.leaderboard
-    workouts_collection = db.workouts
-    
-    logger.info("Successfully connected to MongoDB")
-except Exception as e:
-    logger.error(f"MongoDB connection error: {e}. Using mock collections instead.")
-    # Create mock collections for testing when MongoDB is not available
-    class MockCollection:
-        def __init__(self, name):
-            self.name = name
-            self.data = []
-            
-        def find(self):
-            return self.data
-            
-        def find_one(self, query):
-            if not self.data:
-                return None
-            # Simple mock implementation
-            return self.data[0] if self.data else None
-            
-        def insert_one(self, doc):
-            self.data.append(doc)
-            class Result:
-                @property
-                def inserted_id(self):
-                    return doc.get('_id', ObjectId())
-            return Result()
-            
-        def update_one(self, query, update):
-            pass
-            
-        def delete_one(self, query):
-            class Result:
-                @property
-                def deleted_count(self):
-                    return 1
-            return Result()
-
-    # Initialize mock collections
-    users_collection = MockCollection("users")
-    teams_collection = MockCollection("teams")
-    activities_collection = MockCollection("activities")
-    leaderboard_collection = MockCollection("leaderboard")
-    workouts_collection = MockCollection("workouts")
-
-# Model classes to help with serialization/deserialization
-class User:
-    def __init__(self, _id=None, username='', email='', password='', first_name='', last_name=''):
-        self._id = _id or ObjectId()
-        self.username = username
-        self.email = email
-        self.password = password  # In production, ensure password is hashed
-        self.first_name = first_name
-        self.last_name = last_name
-
-    @staticmethod
-    def from_mongo(mongo_doc):
-        return User(
-            _id=mongo_doc.get('_id'),
-            username=mongo_doc.get('username', ''),
-            email=mongo_doc.get('email', ''),
-            password=mongo_doc.get('password', ''),
-            first_name=mongo_doc.get('first_name', ''),
-            last_name=mongo_doc.get('last_name', '')
-        )
-
-    def to_mongo(self):
-        return {
-            '_id': self._id,
-            'username': self.username,
-            'email': self.email,
-            'password': self.password,
-            'first_name': self.first_name,
-            'last_name': self.last_name
-        }
-
-class Team:
-    def __init__(self, _id=None, name='', description='', members=None):
-        self._id = _id or ObjectId()
-        self.name = name
-        self.description = description
-        self.members = members or []  # List of user IDs
-
-    @staticmethod
-    def from_mongo(mongo_doc):
-        return Team(
-            _id=mongo_doc.get('_id'),
-            name=mongo_doc.get('name', ''),
-            description=mongo_doc.get('description', ''),
-            members=mongo_doc.get('members', [])
-        )
-
-    def to_mongo(self):
-        return {
-            '_id': self._id,
-            'name': self.name,
-            'description': self.description,
-            'members': self.members
-        }
-
-class Activity:
-    def __init__(self, _id=None, user_id=None, activity_type='', duration=0, date=None, calories=0, distance=0):
-        self._id = _id or ObjectId()
-        self.user_id = user_id
-        self.activity_type = activity_type
-        self.duration = duration  # in minutes
-        self.date = date
-        self.calories = calories
-        self.distance = distance  # in meters
+# MongoDB Collections. These are resolved through the connection manager on
+# first use, so importing this module never blocks on the database.
+users_collection = CollectionProxy("users")
+teams_collection = CollectionProxy("teams")
+activities_collection = CollectionProxy("activities")
+leaderboard_collection = CollectionProxy("leaderboard")
+workouts_collection = CollectionProxy("workouts")
+# Daily activity totals per user and activity type (see rollups.py)
+rollups_collection = CollectionProxy("activity_rollups")
+
+# Model classes to help with serialization/deserialization.
+#
+# Models are declared as Field attributes and turned into slotted classes
+# (no per-instance __dict__) by DocumentMeta, which also generates __init__,
+# from_mongo() and to_mongo() once per class as straight-line code: list
+# responses build one model object per document, so these are hot paths.
+
+_UNSET = object()
+
+
+class Field:
+    """
+    A model field. `default` is the constructor default and `missing` the
+    value from_mongo() uses when a document lacks the field (the default
+    unless given). `factory` builds mutable defaults such as lists.
+    """
+    __slots__ = ('default', 'missing', 'factory')
+
+    def __init__(self, default=None, missing=_UNSET, factory=None):
+        self.default = default
+        self.missing = default if missing is _UNSET else missing
+        self.factory = factory
+
+
+def _compile(source, namespace, name):
+    exec(compile(source, f'<generated {name}>', 'exec'), namespace)
+    return namespace[name]
+
+
+class DocumentMeta(type):
+    def __new__(mcs, name, bases, namespace):
+        fields = {key: value for key, value in namespace.items() if isinstance(value, Field)}
+        for key in fields:
+            del namespace[key]
+        namespace['__slots__'] = tuple(fields)
+        cls = super().__new__(mcs, name, bases, namespace)
+        inherited = getattr(cls, '_fields', {})
+        cls._fields = {**inherited, **fields}
+        if fields or not inherited:
+            mcs._generate(cls)
+        return cls
 
     @staticmethod
-    def from_mongo(mongo_doc):
-        return Activity(
-            _id=mongo_doc.get('_id'),
-            user_id=mongo_doc.get('user_id'),
-            activity_type=mongo_doc.get('activity_type', ''),
-            duration=mongo_doc.get('duration', 0),
-            date=mongo_doc.get('date'),
-            calories=mongo_doc.get('calories', 0),
-            distance=mongo_doc.get('distance', 0)
+    def _generate(cls):
+        fields = cls._fields
+        namespace = {'ObjectId': ObjectId, 'new': object.__new__}
+        for key, field in fields.items():
+            namespace[f'default_{key}'] = field.default
+            namespace[f'missing_{key}'] = field.missing
+            namespace[f'factory_{key}'] = field.factory
+
+        def value(key, expression):
+            if key == '_id':
+                return f'{expression} or ObjectId()'
+            if fields[key].factory is not None:
+                return f'{expression} or factory_{key}()'
+            return expression
+
+        parameters = ', '.join(
+            f'{key}=None' if key == '_id' or field.factory is not None else f'{key}=default_{key}'
+            for key, field in fields.items()
         )
-
-    def to_mongo(self):
-        return {
-            '_id': self._id,
-            'user_id': self.user_id,
-            'activity_type': self.activity_type,
-            'duration': self.duration,
-            'date': self.date,
-            'calories': self.calories,
-            'distance': self.distance
-        }
-
-class Leaderboard:
-    def __init__(self, _id=None, user_id=None, score=0, rank=0, category=''):
-        self._id = _id or ObjectId()
-        self.user_id = user_id
-        self.score = score
-        self.rank = rank
-        self.category = category
-
-    @staticmethod
-    def from_mongo(mongo_doc):
-        return Leaderboard(
-            _id=mongo_doc.get('_id'),
-            user_id=mongo_doc.get('user_id'),
-            score=mongo_doc.get('score', 0),
-            rank=mongo_doc.get('rank', 0),
-            category=mongo_doc.get('category', '')
-        )
-
-    def to_mongo(self):
-        return {
-            '_id': self._id,
-            'user_id': self.user_id,
-            'score': self.score,
-            'rank': self.rank,
-            'category': self.category
-        }
-
-class Workout:
-    def __init__(self, _id=None, name='', description='', exercises=None, duration=0, difficulty='medium'):
-        self._id = _id or ObjectId()
-        self.name = name
-        self.description = description
-        self.exercises = exercises or []
-        self.duration = duration  # in minutes
-        self.difficulty = difficulty
-
-    @staticmethod
-    def from_mongo(mongo_doc):
-        return Workout(
-            _id=mongo_doc.get('_id'),
-            name=mongo_doc.get('name', ''),
-            description=mongo_doc.get('description', ''),
-            exercises=mongo_doc.get('exercises', []),
-            duration=mongo_doc.get('duration', 0),
-            difficulty=mongo_doc.get('difficulty', 'medium')
-        )
-
-    def to_mongo(self):
-        return {
-            '_id': self._id,
-            'name': self.name,
-            'description': self.description,
-            'exercises': self.exercises,
-            'duration': self.duration,
-            'difficulty': self.difficulty
-        }
\ No newline at end of file
+        init = [f'def __init__(self, {parameters}):']
+        init += [f'    self.{key} = {value(key, key)}' for key in fields] or ['    pass']
+
+        from_mongo = ['def from_mongo(cls, mongo_doc):', '    self = new(cls)', '    get = mongo_doc.get']
+        for key, field in fields.items():
+            if key == '_id' or field.factory is not None:
+                from_mongo.append(f"    self.{key} = {value(key, f'get({key!r})')}")
+            else:
+                from_mongo.append(f'    self.{key} = get({key!r}, missing_{key})')
+        from_mongo.append('    return self')
+
+        to_mongo = ['def to_mongo(self):', '    return {']
+        to_mongo += [f'        {key!r}: self.{key},' for key in fields]
+        to_mongo.append('    }')
+
+        cls.__init__ = _compile('\n'.join(init), namespace, '__init__')
+        cls.from_mongo = classmethod(_compile('\n'.join(from_mongo), namespace, 'from_mongo'))
+        cls.to_mongo = _compile('\n'.join(to_mongo), namespace, 'to_mongo')
+        cls.__init__.__qualname__ = f'{cls.__qualname__}.__init__'
+        cls.to_mongo.__qualname__ = f'{cls.__qualname__}.to_mongo'
+
+
+class Document(metaclass=DocumentMeta):
+    """Base class of the models; every document has an ObjectId _id"""
+    _id = Field()
+
+    def __repr__(self):
+        return f'{type(self).__name__}(_id={self._id!r})'
+
+
+class User(Document):
+    username = Field('')
+    email = Field('')
+    password = Field('')  # In production, ensure password is hashed
+    first_name = Field('')
+    last_name = Field('')
+    version = Field(1, missing=0)  # bumped by every update, for ETags
+    updated_at = Field()
+
+
+class Team(Document):
+    name = Field('')
+    description = Field('')
+    members = Field(factory=list)  # List of user IDs
+    version = Field(1, missing=0)  # bumped by every update, for ETags
+    updated_at = Field()
+
+
+class Activity(Document):
+    user_id = Field()
+    activity_type = Field('')
+    duration = Field(0)  # in minutes
+    date = Field()
+    calories = Field(0)
+    distance = Field(0)  # in meters
+
+
+class Leaderboard(Document):
+    user_id = Field()
+    score = Field(0)
+    rank = Field(0)
+    category = Field('')
+
+
+class Workout(Document):
+    name = Field('')
+    description = Field('')
+    exercises = Field(factory=list)
+    duration = Field(0)  # in minutes
+    difficulty = Field('medium')
+    version = Field(1, missing=0)  # bumped by every update, for ETags
+    updated_at = Field()
+
+# Index registry: the indexes each collection should have, keyed by collection
+# name. `python manage.py ensure_indexes` creates and reconciles them.
+INDEXES = {
+    'users': [
+        IndexModel([('username', ASCENDING)], name='username_unique', unique=True, background=True),
+        IndexModel([('email', ASCENDING)], name='email_unique', unique=True, background=True),
+    ],
+    'teams': [],
+    'activities': [
+        # Activities for one user, newest first
+        IndexModel([('user_id', ASCENDING), ('date', DESCENDING)], name='user_id_date', background=True),
+        # Keyset pagination order of the activity list
+        IndexModel([('date', DESCENDING), ('_id', DESCENDING)], name='date_id', background=True),
+    ],
+    'leaderboard': [
+        IndexModel([('category', ASCENDING), ('score', DESCENDING)], name='category_score', background=True),
+        # Top-N and rank-around-user reads of the computed leaderboard
+        IndexModel([('category', ASCENDING), ('rank', ASCENDING), ('_id', ASCENDING)], name='category_rank', background=True),
+        # One entry per user and category; the leaderboard rebuild merges on it
+        IndexModel([('user_id', ASCENDING), ('category', ASCENDING)], name='user_category_unique', unique=True, background=True),
+    ],
+    'workouts': [],
+    'activity_rollups': [
+        # One rollup per user, day and activity type; the rollup rebuild merges
+        # on it, and per-user statistics read a range of days from it
+        IndexModel([('user_id', ASCENDING), ('day', ASCENDING), ('activity_type', ASCENDING)],
+                   name='user_day_type_unique', unique=True, background=True),
+    ],
+}
@@ -0,0 +1,181 @@
+import logging
+import os
+import threading
+
+from django.conf import settings
+from pymongo import MongoClient
+
+from . import instrumentation, metrics
+from .memory import MemoryDatabase
+
+# Set up logging
+logger = logging.getLogger(__name__)
+
+# Defaults for the optional MONGODB_* settings, used when settings.py omits them
+DEFAULT_CLIENT_SETTINGS = {
+    'MONGODB_MAX_POOL_SIZE': 100,
+    'MONGODB_MIN_POOL_SIZE': 0,
+    'MONGODB_MAX_IDLE_TIME_MS': None,
+    'MONGODB_WAIT_QUEUE_TIMEOUT_MS': None,
+    'MONGODB_SERVER_SELECTION_TIMEOUT_MS': 5000,
+    'MONGODB_CONNECT_TIMEOUT_MS': 5000,
+    'MONGODB_SOCKET_TIMEOUT_MS': None,
+    'MONGODB_FALLBACK_TO_MOCK': False,
+    'MONGODB_IN_MEMORY': False,
+}
+
+
+def get_setting(name):
+    return getattr(settings, name, DEFAULT_CLIENT_SETTINGS.get(name))
+
+
+class MongoConnectionManager:
+    """
+    Owns the MongoClient for the current process.
+
+    The client is created on first use instead of at import time, so manage.py
+    commands and worker boot never wait on server selection. pymongo clients
+    must not be shared across fork(), so a child process drops the inherited
+    client and builds its own connection pool the first time it needs one.
+
+    Without a server, collections come from a process-local MemoryDatabase
+    that enforces the indexes declared in models.INDEXES.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._reset_state()
+
+    def _reset_state(self):
+        self._pid = None
+        self._client = None
+        self._db = None
+        self._collections = {}
+        self._memory = None
+
+    def _client_options(self):
+        options = {
+            'maxPoolSize': get_setting('MONGODB_MAX_POOL_SIZE'),
+            'minPoolSize': get_setting('MONGODB_MIN_POOL_SIZE'),
+            'maxIdleTimeMS': get_setting('MONGODB_MAX_IDLE_TIME_MS'),
+            'waitQueueTimeoutMS': get_setting('MONGODB_WAIT_QUEUE_TIMEOUT_MS'),
+            'serverSelectionTimeoutMS': get_setting('MONGODB_SERVER_SELECTION_TIMEOUT_MS'),
+            'connectTimeoutMS': get_setting('MONGODB_CONNECT_TIMEOUT_MS'),
+            'socketTimeoutMS': get_setting('MONGODB_SOCKET_TIMEOUT_MS'),
+        }
+        # Leave unset options to pymongo's own defaults
+        options = {key: value for key, value in options.items() if value is not None}
+        listeners = instrumentation.event_listeners() + metrics.event_listeners()
+        if listeners:
+            options['event_listeners'] = listeners
+        return options
+
+    def _connect(self):
+        if get_setting('MONGODB_IN_MEMORY'):
+            logger.info("Using the in-memory document store")
+            return None, None
+        client = MongoClient(
+            settings.MONGODB_HOST,
+            settings.MONGODB_PORT,
+            connect=False,
+            **self._client_options()
+        )
+        if get_setting('MONGODB_FALLBACK_TO_MOCK'):
+            # Only probe the server when we have somewhere else to go
+            try:
+                client.admin.command('ping')
+            except Exception as e:
+                logger.error(f"MongoDB connection error: {e}. Using the in-memory document store instead.")
+                client.close()
+                return None, None
+        logger.info("Successfully connected to MongoDB")
+        return client, client[settings.MONGODB_NAME]
+
+    def _ensure_connected(self):
+        with self._lock:
+            if self._pid != os.getpid():
+                # Never reuse a client created by the parent process
+                self._reset_state()
+                self._client, self._db = self._connect()
+                self._pid = os.getpid()
+
+    @property
+    def client(self):
+        """The process-local MongoClient, or None when running on the in-memory store"""
+        if self._pid != os.getpid():
+            self._ensure_connected()
+        return self._client
+
+    def get_database(self):
+        if self._pid != os.getpid():
+            self._ensure_connected()
+        return self._db
+
+    def get_collection(self, name):
+        if self._pid != os.getpid():
+            self._ensure_connected()
+        collection = self._collections.get(name)
+        if collection is None:
+            if self._db is not None:
+                collection = self._db[name]
+            else:
+                collection = self._memory_collection(name)
+            self._collections[name] = collection
+        return collection
+
+    def _memory_collection(self, name):
+        with self._lock:
+            if self._memory is None:
+                self._memory = MemoryDatabase(settings.MONGODB_NAME)
+            if name in self._memory.list_collection_names():
+                return self._memory[name]
+            # Imported here because models builds its collections from this module
+            from .models import INDEXES
+            collection = self._memory[name]
+            collection.create_indexes(INDEXES.get(name, []))
+            return collection
+
+    def close(self):
+        with self._lock:
+            if self._client is not None and self._pid == os.getpid():
+                self._client.close()
+            self._reset_state()
+
+    def after_fork_in_child(self):
+        # The parent's lock may have been held by another thread during fork()
+        self._lock = threading.Lock()
+        self._reset_state()
+
+
+class CollectionProxy:
+    """
+    Module-level handle for a MongoDB collection.
+
+    Attribute access is forwarded to the collection owned by the connection
+    manager, so importing a proxy never opens a connection.
+    """
+
+    def __init__(self, name, manager=None):
+        self._name = name
+        self._manager = manager
+
+    @property
+    def name(self):
+        return self._name
+
+    @property
+    def collection(self):
+        return (self._manager or connection).get_collection(self._name)
+
+    def __getattr__(self, attr):
+        return getattr(self.collection, attr)
+
+    def __repr__(self):
+        return f"CollectionProxy({self._name!r})"
+
+
+# Process-wide connection manager shared by every collection proxy
+connection = MongoConnectionManager()
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=connection.after_fork_in_child)
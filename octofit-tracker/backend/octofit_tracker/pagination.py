@@ -0,0 +1,128 @@
+import base64
+import binascii
+
+from bson import json_util
+from django.conf import settings
+from pymongo import ASCENDING, DESCENDING
+from rest_framework.exceptions import ParseError
+from rest_framework.response import Response
+from rest_framework.utils.urls import replace_query_param
+
+
+class KeysetPagination:
+    """
+    Keyset (cursor) pagination for the MongoDB-backed list endpoints.
+
+    Pages are read with a range query on the sort keys of the last document
+    of the previous page instead of skip(), so every page costs the same no
+    matter how deep into the collection it is. The list body keeps its plain
+    array shape; the next page is advertised through the Link and
+    X-Next-Cursor response headers.
+    """
+    cursor_query_param = 'cursor'
+    limit_query_param = 'limit'
+
+    def __init__(self, ordering=(('_id', ASCENDING),)):
+        ordering = list(ordering)
+        # _id breaks ties so that the keyset is always unique
+        if ordering[-1][0] != '_id':
+            ordering.append(('_id', ordering[-1][1]))
+        self.ordering = ordering
+        self.next_cursor = None
+        self.request = None
+
+    def get_limit(self, request):
+        default_limit = getattr(settings, 'API_PAGE_SIZE', 100)
+        max_limit = getattr(settings, 'API_MAX_PAGE_SIZE', 1000)
+        limit = request.query_params.get(self.limit_query_param)
+        if limit is None:
+            return default_limit
+        try:
+            limit = int(limit)
+        except ValueError:
+            raise ParseError('Invalid limit')
+        if limit < 1:
+            raise ParseError('Invalid limit')
+        return min(limit, max_limit)
+
+    def encode_cursor(self, document):
+        values = [document.get(field) for field, _ in self.ordering]
+        return base64.urlsafe_b64encode(json_util.dumps(values).encode()).decode()
+
+    def decode_cursor(self, token):
+        try:
+            values = json_util.loads(base64.urlsafe_b64decode(token.encode()))
+        except (binascii.Error, ValueError, TypeError):
+            raise ParseError('Invalid cursor')
+        if not isinstance(values, list) or len(values) != len(self.ordering):
+            raise ParseError('Invalid cursor')
+        return values
+
+    def _after(self, field, direction, value):
+        operator = '$lt' if direction == DESCENDING else '$gt'
+        if field == '_id' or (value is not None and direction == ASCENDING):
+            return {field: {operator: value}}
+        # MongoDB sorts null/missing values before everything else
+        if value is None:
+            return {field: {'$ne': None}} if direction == ASCENDING else None
+        return {'$or': [{field: {'$lt': value}}, {field: None}]}
+
+    def cursor_filter(self, values):
+        """Build the query matching every document sorted after the cursor"""
+        clauses = []
+        for i, (field, direction) in enumerate(self.ordering):
+            after = self._after(field, direction, values[i])
+            if after is None:
+                continue
+            clause = {prefix: values[j] for j, (prefix, _) in enumerate(self.ordering[:i])}
+            if '$or' in after:
+                clause = {'$and': [clause, after]} if clause else after
+            else:
+                clause.update(after)
+            clauses.append(clause)
+        if not clauses:
+            # Nothing sorts after the cursor
+            return {'_id': {'$exists': False}}
+        return {'$or': clauses} if len(clauses) > 1 else clauses[0]
+
+    def prepare_query(self, request, query=None, projection=None):
+        """The query, projection and limit of the page a request asks for"""
+        self.request = request
+        limit = self.get_limit(request)
+        query = dict(query or {})
+        if projection is not None:
+            # The sort keys must be read to build the next cursor
+            projection = dict(projection, **{field: 1 for field, _ in self.ordering})
+        token = request.query_params.get(self.cursor_query_param)
+        if token:
+            cursor_query = self.cursor_filter(self.decode_cursor(token))
+            query = {'$and': [query, cursor_query]} if query else cursor_query
+        return query, projection, limit
+
+    def trim_page(self, documents, limit):
+        """Drop the extra document read past the page and remember the next cursor"""
+        if len(documents) > limit:
+            documents = documents[:limit]
+            self.next_cursor = self.encode_cursor(documents[-1])
+        return documents
+
+    def paginate_collection(self, collection, request, query=None, projection=None):
+        query, projection, limit = self.prepare_query(request, query, projection)
+        # Fetch one extra document to find out whether there is a next page
+        documents = list(collection.find(query, projection, sort=self.ordering, limit=limit + 1))
+        return self.trim_page(documents, limit)
+
+    def get_next_link(self):
+        if self.next_cursor is None:
+            return None
+        url = self.request.build_absolute_uri()
+        return replace_query_param(url, self.cursor_query_param, self.next_cursor)
+
+    def set_link_headers(self, response):
+        if self.next_cursor is not None:
+            response['Link'] = f'<{self.get_next_link()}>; rel="next"'
+            response['X-Next-Cursor'] = self.next_cursor
+        return response
+
+    def get_paginated_response(self, data):
+        return self.set_link_headers(Response(data))
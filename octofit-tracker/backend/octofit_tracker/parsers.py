@@ -0,0 +1,65 @@
+import codecs
+import json
+
+from django.conf import settings
+from rest_framework.exceptions import ParseError
+from rest_framework.parsers import BaseParser, JSONParser
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+def _is_utf8(encoding):
+    try:
+        return codecs.lookup(encoding).name == 'utf-8'
+    except LookupError:
+        return False
+
+
+class FastJSONParser(JSONParser):
+    """
+    JSONParser that decodes with orjson when it is installed and the body is
+    UTF-8, and with the stdlib otherwise. Like the strict stdlib parser it
+    rejects NaN and Infinity.
+    """
+
+    def parse(self, stream, media_type=None, parser_context=None):
+        parser_context = parser_context or {}
+        encoding = parser_context.get('encoding', settings.DEFAULT_CHARSET)
+        if orjson is None or not _is_utf8(encoding):
+            return super().parse(stream, media_type, parser_context)
+        try:
+            return orjson.loads(stream.read())
+        except orjson.JSONDecodeError as exc:
+            raise ParseError('JSON parse error - %s' % str(exc))
+
+
+class NDJSONParser(BaseParser):
+    """
+    Parses newline-delimited JSON (one object per line) into a list, with
+    orjson when it is installed and the body is UTF-8.
+    """
+    media_type = 'application/x-ndjson'
+
+    def parse(self, stream, media_type=None, parser_context=None):
+        parser_context = parser_context or {}
+        encoding = parser_context.get('encoding', settings.DEFAULT_CHARSET)
+        items = []
+        if stream is None:
+            return items
+        if orjson is not None and _is_utf8(encoding):
+            loads = orjson.loads
+        else:
+            def loads(line):
+                return json.loads(line.decode(encoding))
+        for line_number, line in enumerate(iter(stream.readline, b''), start=1):
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                items.append(loads(line))
+            except ValueError as exc:
+                raise ParseError(f'NDJSON parse error on line {line_number} - {exc}')
+        return items
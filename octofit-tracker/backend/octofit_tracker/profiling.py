@@ -0,0 +1,259 @@
+import cProfile
+import hmac
+import json
+import os
+import pstats
+import sys
+import threading
+import time
+import uuid
+from collections import Counter
+
+from django.conf import settings
+from django.http import HttpResponse
+from rest_framework.views import APIView
+
+# On-demand request profiling (API_PROFILING). A request asks to be profiled
+# with the API_PROFILING_HEADER header or the `profile` query parameter, whose
+# value is API_PROFILING_TOKEN; staff users signed in to the admin may pass any
+# value. ProfiledAPIView.dispatch then runs the view under a profiler:
+#
+#     sample    a thread samples the view's stack every API_PROFILING_INTERVAL
+#               seconds; cheap enough for production (the default)
+#     cprofile  cProfile traces every call for exact cumulative times; the
+#               sampler still runs, for the stacks
+#
+# The report holds the sampled stacks in the collapsed format read by
+# flamegraph.pl and speedscope ("frame;frame;frame count", root first) and the
+# API_PROFILING_TOP functions with the most cumulative time. With
+# API_PROFILING_OUTPUT_DIR set, it is written there (<id>.collapsed and
+# <id>.json) and the response keeps its body, with the id in X-Profile-Id;
+# otherwise it replaces the response body.
+#
+# Each process profiles one request at a time and at most
+# API_PROFILING_MAX_PER_MINUTE requests a minute. Requests refused a profile
+# are handled as usual, with the reason in X-Profile-Skipped.
+
+QUERY_PARAM = 'profile'
+MODES = ('sample', 'cprofile')
+
+
+def enabled():
+    return getattr(settings, 'API_PROFILING', False)
+
+
+def get_setting(name, default):
+    return getattr(settings, name, default)
+
+
+class RateLimiter:
+    """Token bucket allowing `per_minute` profiles a minute, in bursts of as many"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._tokens = None
+        self._updated = 0.0
+
+    def acquire(self, per_minute):
+        now = time.monotonic()
+        with self._lock:
+            if self._tokens is None:
+                self._tokens = float(per_minute)
+            else:
+                elapsed = now - self._updated
+                self._tokens = min(float(per_minute), self._tokens + elapsed * per_minute / 60)
+            self._updated = now
+            if self._tokens < 1:
+                return False
+            self._tokens -= 1
+            return True
+
+    def reset(self):
+        with self._lock:
+            self._tokens = None
+
+
+rate_limiter = RateLimiter()
+# Profilers are per process: cProfile refuses to run twice at once, and two
+# samplers would each slow the other's request
+_profiling = threading.Lock()
+
+
+def requested_token(request):
+    """The token of a request asking to be profiled, or None"""
+    header = get_setting('API_PROFILING_HEADER', 'X-Octofit-Profile')
+    token = request.headers.get(header)
+    if token is None:
+        token = request.GET.get(QUERY_PARAM)
+    return token
+
+
+def staff_or_token(request, token, expected):
+    """Whether `token` is the configured token `expected`, or the user is active staff"""
+    if expected and token and hmac.compare_digest(token.encode(), expected.encode()):
+        return True
+    user = getattr(request, 'user', None)
+    return bool(user is not None and user.is_active and user.is_staff)
+
+
+def authorized(request, token):
+    return staff_or_token(request, token, get_setting('API_PROFILING_TOKEN', None))
+
+
+def _frame_name(code):
+    return f'{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})'
+
+
+class StackSampler(threading.Thread):
+    """
+    Samples the stack of one thread, below a root frame, every `interval`
+    seconds and counts the collapsed stacks.
+    """
+
+    def __init__(self, thread_id, root, interval):
+        super().__init__(name='octofit-profile-sampler', daemon=True)
+        self.thread_id = thread_id
+        self.root = root
+        self.interval = interval
+        self.stacks = Counter()
+        self._stopped = threading.Event()
+
+    def run(self):
+        while not self._stopped.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None and frame is not self.root:
+                stack.append(frame.f_code)
+                frame = frame.f_back
+            # Not the samples taken while the profiled thread stops the sampler
+            if stack and stack[-1] is not StackSampler.stop.__code__:
+                self.stacks[';'.join(_frame_name(code) for code in reversed(stack))] += 1
+
+    def stop(self):
+        self._stopped.set()
+        self.join()
+
+    def collapsed(self):
+        return ''.join(f'{stack} {count}\n' for stack, count in self.stacks.most_common())
+
+    def top(self, limit):
+        """The functions on the most samples, with the time they represent"""
+        cumulative = Counter()
+        for stack, count in self.stacks.items():
+            for frame in set(stack.split(';')):
+                cumulative[frame] += count
+        return [
+            {'function': frame, 'samples': count, 'cumulative_ms': round(count * self.interval * 1000, 3)}
+            for frame, count in cumulative.most_common(limit)
+        ]
+
+
+def _cprofile_top(profile, limit):
+    stats = pstats.Stats(profile)
+    rows = [
+        (cumulative, calls, total, f'{name} ({os.path.basename(filename)}:{line})')
+        for (filename, line, name), (_, calls, total, cumulative, _) in stats.stats.items()
+    ]
+    rows.sort(reverse=True)
+    return [
+        {'function': function, 'calls': calls,
+         'cumulative_ms': round(cumulative * 1000, 3), 'total_ms': round(total * 1000, 3)}
+        for cumulative, calls, total, function in rows[:limit]
+    ]
+
+
+class Profile:
+    """A profile of one request"""
+
+    def __init__(self, request, mode, interval):
+        self.id = f'{time.strftime("%Y%m%dT%H%M%S")}-{os.getpid()}-{uuid.uuid4().hex[:8]}'
+        self.method = request.method
+        self.path = request.path
+        self.mode = mode
+        self.interval = interval
+        self.profile = cProfile.Profile() if mode == 'cprofile' else None
+
+    def run(self, function, *args, **kwargs):
+        self.sampler = StackSampler(threading.get_ident(), sys._getframe(), self.interval)
+        started = time.perf_counter()
+        self.sampler.start()
+        try:
+            if self.profile is not None:
+                return self.profile.runcall(function, *args, **kwargs)
+            return function(*args, **kwargs)
+        finally:
+            self.duration = time.perf_counter() - started
+            self.sampler.stop()
+
+    def report(self, status_code, limit):
+        if self.profile is not None:
+            top = _cprofile_top(self.profile, limit)
+        else:
+            top = self.sampler.top(limit)
+        return {
+            'id': self.id,
+            'method': self.method,
+            'path': self.path,
+            'status': status_code,
+            'mode': self.mode,
+            'duration_ms': round(self.duration * 1000, 3),
+            'interval_ms': self.interval * 1000,
+            'samples': sum(self.sampler.stacks.values()),
+            'top': top,
+            'collapsed': self.sampler.collapsed(),
+        }
+
+
+def skipped(response, reason):
+    response['X-Profile-Skipped'] = reason
+    return response
+
+
+def _dispatch_and_render(dispatch, request, *args, **kwargs):
+    response = dispatch(request, *args, **kwargs)
+    # DRF responses are otherwise rendered after dispatch returns
+    if hasattr(response, 'render'):
+        response.render()
+    return response
+
+
+def profiled_dispatch(dispatch, request, *args, **kwargs):
+    """Run `dispatch` under a profiler if the request asks for one and may have it"""
+    token = requested_token(request)
+    if token is None:
+        return dispatch(request, *args, **kwargs)
+    if not authorized(request, token):
+        return skipped(dispatch(request, *args, **kwargs), 'forbidden')
+    if not _profiling.acquire(blocking=False):
+        return skipped(dispatch(request, *args, **kwargs), 'busy')
+    try:
+        if not rate_limiter.acquire(get_setting('API_PROFILING_MAX_PER_MINUTE', 6)):
+            return skipped(dispatch(request, *args, **kwargs), 'rate-limited')
+        mode = get_setting('API_PROFILING_MODE', 'sample')
+        if mode not in MODES:
+            raise ValueError(f'API_PROFILING_MODE must be one of {MODES}')
+        profile = Profile(request, mode, get_setting('API_PROFILING_INTERVAL', 0.001))
+        response = profile.run(_dispatch_and_render, dispatch, request, *args, **kwargs)
+    finally:
+        _profiling.release()
+    # Streamed responses are profiled up to their first byte
+    report = profile.report(response.status_code, get_setting('API_PROFILING_TOP', 25))
+    directory = get_setting('API_PROFILING_OUTPUT_DIR', None)
+    if directory is None:
+        return HttpResponse(json.dumps(report), content_type='application/json')
+    os.makedirs(directory, exist_ok=True)
+    with open(os.path.join(directory, f'{profile.id}.collapsed'), 'w') as f:
+        f.write(report.pop('collapsed'))
+    with open(os.path.join(directory, f'{profile.id}.json'), 'w') as f:
+        json.dump(report, f, indent=2)
+    response['X-Profile-Id'] = profile.id
+    return response
+
+
+class ProfiledAPIView(APIView):
+    """APIView whose requests can ask to be profiled (see API_PROFILING)"""
+
+    def dispatch(self, request, *args, **kwargs):
+        if not enabled():
+            return super().dispatch(request, *args, **kwargs)
+        return profiled_dispatch(super().dispatch, request, *args, **kwargs)
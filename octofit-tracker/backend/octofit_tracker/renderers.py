@@ -0,0 +1,115 @@
+import csv
+import io
+
+from bson import ObjectId
+from rest_framework.renderers import BaseRenderer, JSONRenderer
+from rest_framework.utils.encoders import JSONEncoder
+
+from . import instrumentation
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+class MongoJSONEncoder(JSONEncoder):
+    """DRF's JSON encoder, plus ObjectIds as their hex string"""
+
+    def default(self, obj):
+        if isinstance(obj, ObjectId):
+            return str(obj)
+        return super().default(obj)
+
+
+class FastJSONRenderer(JSONRenderer):
+    """
+    JSONRenderer that encodes with orjson when it is installed. ObjectId,
+    datetime and Decimal values are encoded natively, with the same output
+    as DRF's encoder (ISO 8601 with a Z for UTC, Decimals as numbers).
+
+    Falls back to the stdlib encoder when orjson is missing, when an indented
+    response is asked for (e.g. `Accept: application/json; indent=4`), and
+    for data orjson can't encode such as non-string keys or huge integers.
+    """
+    encoder_class = MongoJSONEncoder
+    # datetimes go through default() so that UTC gets DRF's Z suffix
+    orjson_options = orjson.OPT_PASSTHROUGH_DATETIME if orjson is not None else 0
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        with instrumentation.measure('render'):
+            return self._render(data, accepted_media_type, renderer_context)
+
+    def _render(self, data, accepted_media_type=None, renderer_context=None):
+        if orjson is None or data is None or self.ensure_ascii or not self.compact:
+            return super().render(data, accepted_media_type, renderer_context)
+        if self.get_indent(accepted_media_type, renderer_context or {}) is not None:
+            return super().render(data, accepted_media_type, renderer_context)
+        try:
+            ret = orjson.dumps(data, default=self.encoder_class().default, option=self.orjson_options)
+        except orjson.JSONEncodeError:
+            return super().render(data, accepted_media_type, renderer_context)
+        # Escape U+2028 and U+2029 like JSONRenderer, for a strict JavaScript subset
+        return ret.replace(b'\xe2\x80\xa8', b'\\u2028').replace(b'\xe2\x80\xa9', b'\\u2029')
+
+
+class NDJSONRenderer(BaseRenderer):
+    """
+    Renders a list of objects as newline-delimited JSON, one object per line.
+    iter_lines() encodes row by row for streaming responses, with orjson
+    when it is installed.
+    """
+    media_type = 'application/x-ndjson'
+    format = 'ndjson'
+    charset = 'utf-8'
+
+    def iter_lines(self, rows):
+        encoder = MongoJSONEncoder(ensure_ascii=False, separators=(',', ':'))
+        if orjson is None:
+            for row in rows:
+                yield (encoder.encode(row) + '\n').encode(self.charset)
+            return
+        options = FastJSONRenderer.orjson_options | orjson.OPT_APPEND_NEWLINE
+        for row in rows:
+            try:
+                yield orjson.dumps(row, default=encoder.default, option=options)
+            except orjson.JSONEncodeError:
+                yield (encoder.encode(row) + '\n').encode(self.charset)
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if data is None:
+            return b''
+        rows = data if isinstance(data, list) else [data]
+        return b''.join(self.iter_lines(rows))
+
+
+class CSVRenderer(BaseRenderer):
+    """
+    Renders a list of flat objects as CSV with a header row. The columns are
+    the given header, or the keys of the first row.
+    """
+    media_type = 'text/csv'
+    format = 'csv'
+    charset = 'utf-8'
+
+    def iter_lines(self, rows, header=None):
+        buffer = io.StringIO()
+        writer = None
+        for row in rows:
+            if writer is None:
+                writer = csv.DictWriter(buffer, fieldnames=header or list(row), extrasaction='ignore')
+                writer.writeheader()
+            writer.writerow(row)
+            yield buffer.getvalue().encode(self.charset)
+            buffer.seek(0)
+            buffer.truncate()
+        if writer is None and header:
+            # An empty export still gets its header row
+            csv.writer(buffer).writerow(header)
+            yield buffer.getvalue().encode(self.charset)
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if data is None:
+            return b''
+        rows = data if isinstance(data, list) else [data]
+        return b''.join(self.iter_lines(rows))
@@ -0,0 +1,199 @@
+import logging
+from collections import defaultdict
+from datetime import datetime, timedelta, timezone
+
+from django.conf import settings
+from pymongo import ASCENDING, UpdateOne
+
+from .leaderboard import activity_category
+from .models import activities_collection, rollups_collection
+
+# Pre-aggregated activity totals. One rollup document is kept per user, UTC
+# day and activity type:
+#
+#     {user_id, day, activity_type, count, duration, calories, distance}
+#
+# Every activity write $incs the rollups it touches (the same write sites that
+# update the leaderboard), and rebuild() recomputes them from activities with
+# an aggregation pipeline ($dateTrunc needs MongoDB 5.0 or later). Per-user
+# statistics are read from the rollups of the requested range and summed into
+# day, week or month buckets, so their cost grows with the number of buckets
+# rather than the number of activities.
+
+logger = logging.getLogger(__name__)
+
+# Activity fields summed by the rollups, besides the activity count
+TOTAL_FIELDS = ('duration', 'calories', 'distance')
+
+# Weeks start on Monday (ISO 8601)
+GRANULARITIES = ('day', 'week', 'month')
+
+
+def as_utc(date):
+    """A datetime as naive UTC, as MongoDB stores it"""
+    if date.tzinfo is not None:
+        date = date.astimezone(timezone.utc).replace(tzinfo=None)
+    return date
+
+
+def day_of(date):
+    """Start of the UTC day of a datetime"""
+    date = as_utc(date)
+    return datetime(date.year, date.month, date.day)
+
+
+def bucket_start(day, granularity):
+    if granularity == 'week':
+        return day - timedelta(days=day.weekday())
+    if granularity == 'month':
+        return day.replace(day=1)
+    return day
+
+
+def next_bucket(start, granularity):
+    if granularity == 'week':
+        return start + timedelta(days=7)
+    if granularity == 'month':
+        return datetime(start.year + start.month // 12, start.month % 12 + 1, 1)
+    return start + timedelta(days=1)
+
+
+def _empty_totals():
+    return dict.fromkeys(('count',) + TOTAL_FIELDS, 0)
+
+
+def rollup_deltas(removed=(), added=()):
+    """Change of every (user_id, day, activity_type) rollup touched by the given activities"""
+    deltas = defaultdict(_empty_totals)
+    for activities, sign in ((removed, -1), (added, 1)):
+        for activity in activities:
+            if activity.get('user_id') is None or not isinstance(activity.get('date'), datetime):
+                continue
+            delta = deltas[(activity['user_id'], day_of(activity['date']), activity_category(activity))]
+            delta['count'] += sign
+            for field in TOTAL_FIELDS:
+                delta[field] += sign * (activity.get(field) or 0)
+    return {key: delta for key, delta in deltas.items() if any(delta.values())}
+
+
+def apply_rollup_deltas(deltas):
+    """$inc the rollups by the given deltas in one bulk write and drop the emptied ones"""
+    if not deltas:
+        return
+    keys = [
+        {'user_id': user_id, 'day': day, 'activity_type': activity_type}
+        for user_id, day, activity_type in deltas
+    ]
+    now = datetime.utcnow()
+    rollups_collection.bulk_write([
+        # A concurrent rebuild() keeps rollups created after it started
+        UpdateOne(key, {'$inc': delta, '$setOnInsert': {'computed_at': now}}, upsert=True)
+        for key, delta in zip(keys, deltas.values())
+    ], ordered=False)
+    rollups_collection.delete_many({'$or': keys, 'count': {'$lte': 0}})
+
+
+def record_activity_changes(removed=(), added=()):
+    """
+    Apply the rollup changes of written activities. A failure here is logged
+    rather than raised: the activity itself is already stored, and
+    `manage.py rebuild_rollups` repairs any drift.
+    """
+    if not getattr(settings, 'ACTIVITY_ROLLUP_INCREMENTAL_UPDATES', True):
+        return
+    try:
+        apply_rollup_deltas(rollup_deltas(removed, added))
+    except Exception:
+        logger.exception("Failed to apply activity rollup changes")
+
+
+def rollup_pipeline(computed_at, match=None):
+    """Aggregation over activities producing the daily rollups"""
+    return [
+        {'$match': {'$and': [match or {}, {'user_id': {'$ne': None}, 'date': {'$ne': None}}]}},
+        {'$group': dict({
+            '_id': {
+                'user_id': '$user_id',
+                'day': {'$dateTrunc': {'date': '$date', 'unit': 'day'}},
+                'activity_type': {'$toUpper': '$activity_type'},
+            },
+            'count': {'$sum': 1},
+        }, **{field: {'$sum': f'${field}'} for field in TOTAL_FIELDS})},
+        {'$project': dict({
+            '_id': 0,
+            'user_id': '$_id.user_id',
+            'day': '$_id.day',
+            'activity_type': '$_id.activity_type',
+            'count': 1,
+            'computed_at': {'$literal': computed_at},
+        }, **{field: 1 for field in TOTAL_FIELDS})},
+        # Relies on the unique (user_id, day, activity_type) index from
+        # models.INDEXES
+        {'$merge': {
+            'into': rollups_collection.name,
+            'on': ['user_id', 'day', 'activity_type'],
+            'whenMatched': 'replace',
+            'whenNotMatched': 'insert',
+        }},
+    ]
+
+
+def rebuild(user_id=None):
+    """
+    Recompute the rollups of every user, or of one user, from activities.
+
+    Returns the number of rollup documents of the rebuilt scope. Rollups the
+    run did not produce (days with no activities left) are removed, except
+    those upserted by activity writes during the run: these are stamped with
+    a later computed_at. An activity written while the pipeline runs may
+    still be counted twice or not at all; rebuilding again repairs that.
+    """
+    # MongoDB stores milliseconds; whole seconds compare equal after the round trip
+    computed_at = datetime.utcnow().replace(microsecond=0)
+    match = {'user_id': user_id} if user_id is not None else {}
+    activities_collection.aggregate(rollup_pipeline(computed_at, match), allowDiskUse=True)
+    rollups_collection.delete_many(dict(match, **{'$or': [
+        {'computed_at': {'$lt': computed_at}},
+        {'computed_at': {'$exists': False}},
+    ]}))
+    return rollups_collection.count_documents(match)
+
+
+def user_stats(user_id, granularity='day', start=None, end=None):
+    """
+    Totals of a user's activities per bucket of the given granularity, from
+    `start` (inclusive) to `end` (exclusive), both widened to whole buckets.
+    Only buckets with activities are returned, oldest first, each with its
+    totals per activity type.
+    """
+    query = {'user_id': user_id}
+    if start is not None:
+        start = bucket_start(day_of(start), granularity)
+        query.setdefault('day', {})['$gte'] = start
+    if end is not None:
+        # The bucket holding the last instant before `end` is the last one
+        last = bucket_start(day_of(as_utc(end) - timedelta(microseconds=1)), granularity)
+        end = next_bucket(last, granularity)
+        query.setdefault('day', {})['$lt'] = end
+
+    buckets = {}
+    totals = _empty_totals()
+    projection = dict({'_id': 0, 'day': 1, 'activity_type': 1, 'count': 1}, **{field: 1 for field in TOTAL_FIELDS})
+    for rollup in rollups_collection.find(query, projection, sort=[('day', ASCENDING)]):
+        key = bucket_start(rollup['day'], granularity)
+        bucket = buckets.get(key)
+        if bucket is None:
+            bucket = buckets[key] = {'start': key, **_empty_totals(), 'activity_types': {}}
+        by_type = bucket['activity_types'].setdefault(rollup['activity_type'], _empty_totals())
+        for field in ('count',) + TOTAL_FIELDS:
+            value = rollup.get(field) or 0
+            bucket[field] += value
+            by_type[field] += value
+            totals[field] += value
+    return {
+        'granularity': granularity,
+        'from': start,
+        'to': end,
+        'totals': totals,
+        'buckets': list(buckets.values()),
+    }
@@ -1,5 +1,12 @@
+from datetime import datetime, timedelta
+
 from rest_framework import serializers
+from rest_framework.exceptions import ParseError
+from rest_framework.fields import ISO_8601
+from rest_framework.settings import api_settings
 from bson import ObjectId
+from bson.errors import InvalidId
+from . import instrumentation
 from .models import User, Team, Activity, Leaderboard, Workout
 
 class ObjectIdField(serializers.Field):
@@ -13,10 +20,176 @@ class ObjectIdField(serializers.Field):
     def to_internal_value(self, data):
         try:
             return ObjectId(str(data))
-        except (ValueError, TypeError, AttributeError):
+        except (InvalidId, ValueError, TypeError, AttributeError):
             raise serializers.ValidationError("Invalid ObjectId format")
 
-class UserSerializer(serializers.Serializer):
+class PartialListSerializer(serializers.ListSerializer):
+    """
+    List serializer for bulk writes that keeps the valid items when others fail.
+
+    After is_valid(), validated_data holds the valid items, valid_indexes their
+    positions in the input and item_errors the errors of every rejected item.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.valid_indexes = []
+        self.item_errors = []
+
+    def to_internal_value(self, data):
+        if not isinstance(data, list) or not data:
+            return super().to_internal_value(data)
+        if self.max_length is not None and len(data) > self.max_length:
+            message = self.error_messages['max_length'].format(max_length=self.max_length)
+            raise serializers.ValidationError({
+                api_settings.NON_FIELD_ERRORS_KEY: [message]
+            }, code='max_length')
+
+        ret = []
+        self.valid_indexes = []
+        self.item_errors = []
+        for index, item in enumerate(data):
+            try:
+                validated = self.child.run_validation(item)
+            except serializers.ValidationError as exc:
+                self.item_errors.append({'index': index, 'errors': exc.detail})
+            else:
+                ret.append(validated)
+                self.valid_indexes.append(index)
+        return ret
+
+class SparseFieldsetMixin:
+    """
+    Lets a serializer render only the fields a client asked for with ?fields=.
+
+    The same field list is turned into a MongoDB projection by
+    get_projection(), so unused fields are never read from the database.
+    """
+    fields_query_param = 'fields'
+
+    def __init__(self, *args, fields=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        if fields is not None:
+            for name in set(self.fields) - set(fields):
+                self.fields.pop(name)
+
+    @classmethod
+    def readable_fields(cls):
+        return [name for name, field in cls._declared_fields.items() if not field.write_only]
+
+    @classmethod
+    def fields_from_request(cls, request):
+        """Return the requested field names, or None when ?fields= is absent"""
+        value = request.query_params.get(cls.fields_query_param)
+        if not value:
+            return None
+        requested = [name.strip() for name in value.split(',') if name.strip()]
+        readable = cls.readable_fields()
+        unknown = [name for name in requested if name not in readable]
+        if unknown:
+            raise ParseError(f"Unknown field(s): {', '.join(unknown)}")
+        return requested
+
+    @classmethod
+    def get_projection(cls, fields):
+        if fields is None:
+            return None
+        # _id is always returned by MongoDB and is needed for pagination cursors
+        return {name: 1 for name in fields}
+
+class CompiledRepresentationMixin:
+    """
+    Read-only fast path from MongoDB documents to the serializer's output.
+
+    represent() and represent_many() return what serializing
+    `Meta.model.from_mongo(document)` would, but with a function generated
+    once per (serializer, field subset) from the declared fields. It reads
+    the document directly and converts each value inline, so no model
+    objects are built and no per-field to_representation() calls are made.
+    Fields without an inline conversion call their to_representation().
+    Serializers remain the only way to validate writes.
+    """
+    _representers = {}
+
+    @classmethod
+    def representation_fields(cls, fields=None):
+        """Names of the output fields, in declaration order"""
+        readable = cls.readable_fields()
+        return readable if fields is None else [name for name in readable if name in fields]
+
+    @classmethod
+    def represent(cls, document, fields=None):
+        with instrumentation.measure('serialize'):
+            return cls.representer(fields)(document)
+
+    @classmethod
+    def represent_many(cls, documents, fields=None):
+        represent = cls.representer(fields)
+        with instrumentation.measure('serialize'):
+            return [represent(document) for document in documents]
+
+    @classmethod
+    def representer(cls, fields=None):
+        """The compiled document -> dict function for a field subset"""
+        key = (cls, None if fields is None else frozenset(fields))
+        represent = cls._representers.get(key)
+        if represent is None:
+            # Two threads may both compile on a miss; either result is fine
+            represent = cls._representers[key] = cls._compile_representation(fields)
+        return represent
+
+    @classmethod
+    def _compile_representation(cls, fields):
+        model_fields = cls.Meta.model._fields
+        declared = cls().fields
+        namespace = {'ObjectId': ObjectId, 'datetime': datetime}
+        lines = ['def represent(document):', '    get = document.get', '    ret = {}']
+        for index, name in enumerate(cls.representation_fields(fields)):
+            field = declared[name]
+            source = field.source
+            model_field = model_fields.get(source)
+            # Value as Model.from_mongo() would set it
+            if source == '_id':
+                lines.append("    value = get('_id') or ObjectId()")
+            elif model_field is not None and model_field.factory is not None:
+                namespace[f'factory_{index}'] = model_field.factory
+                lines.append(f'    value = get({source!r}) or factory_{index}()')
+            else:
+                namespace[f'missing_{index}'] = model_field.missing if model_field is not None else None
+                lines.append(f'    value = get({source!r}, missing_{index})')
+            lines.append(f'    ret[{name!r}] = None if value is None else {cls._conversion(field, index, namespace)}')
+        lines.append('    return ret')
+        source_code = '\n'.join(lines)
+        exec(compile(source_code, f'<{cls.__name__} representation>', 'exec'), namespace)
+        return namespace['represent']
+
+    @staticmethod
+    def _conversion(field, index, namespace, value='value'):
+        """Expression converting a non-None `value` like field.to_representation()"""
+        field_type = type(field)
+        if field_type is ObjectIdField:
+            return f'str({value})'
+        if field_type in (serializers.CharField, serializers.EmailField):
+            return f'str({value})'
+        if field_type is serializers.IntegerField:
+            return f'int({value})'
+        if field_type is serializers.FloatField:
+            return f'float({value})'
+        if field_type is serializers.ListField and type(field.child) is ObjectIdField:
+            return f'[None if item is None else str(item) for item in {value}]'
+        if field_type is serializers.DateTimeField:
+            output_format = getattr(field, 'format', api_settings.DATETIME_FORMAT)
+            field_timezone = field.timezone if hasattr(field, 'timezone') else field.default_timezone()
+            if output_format is not None and output_format.lower() == ISO_8601 and field_timezone is not None \
+                    and field_timezone.utcoffset(None) == timedelta(0):
+                # Naive datetimes from MongoDB are UTC
+                namespace[f'to_representation_{index}'] = field.to_representation
+                return (f"{value}.isoformat() + 'Z' if type({value}) is datetime and {value}.tzinfo is None "
+                        f"else to_representation_{index}({value})")
+        namespace[f'to_representation_{index}'] = field.to_representation
+        return f'to_representation_{index}({value})'
+
+class UserSerializer(CompiledRepresentationMixin, SparseFieldsetMixin, serializers.Serializer):
     _id = ObjectIdField(read_only=True)
     username = serializers.CharField(max_length=100)
     email = serializers.EmailField()
@@ -24,6 +197,9 @@ class UserSerializer(serializers.Serializer):
     first_name = serializers.CharField(max_length=100, required=False, allow_blank=True)
     last_name = serializers.CharField(max_length=100, required=False, allow_blank=True)
     
+    class Meta:
+        model = User
+
     def create(self, validated_data):
         return User(**validated_data)
     
@@ -35,12 +211,15 @@ class UserSerializer(serializers.Serializer):
         instance.last_name = validated_data.get('last_name', instance.last_name)
         return instance
 
-class TeamSerializer(serializers.Serializer):
+class TeamSerializer(CompiledRepresentationMixin, SparseFieldsetMixin, serializers.Serializer):
     _id = ObjectIdField(read_only=True)
     name = serializers.CharField(max_length=100)
     description = serializers.CharField(required=False, allow_blank=True)
     members = serializers.ListField(child=ObjectIdField(), required=False)
     
+    class Meta:
+        model = Team
+
     def create(self, validated_data):
         return Team(**validated_data)
     
@@ -50,7 +229,7 @@ class TeamSerializer(serializers.Serializer):
         instance.members = validated_data.get('members', instance.members)
         return instance
 
-class ActivitySerializer(serializers.Serializer):
+class ActivitySerializer(CompiledRepresentationMixin, SparseFieldsetMixin, serializers.Serializer):
     _id = ObjectIdField(read_only=True)
     user_id = ObjectIdField()
     activity_type = serializers.CharField(max_length=100)
@@ -58,6 +237,11 @@ class ActivitySerializer(serializers.Serializer):
     date = serializers.DateTimeField(required=False)
     calories = serializers.IntegerField(min_value=0, required=False)
     distance = serializers.FloatField(min_value=0, required=False)  # in meters
+
+    class Meta:
+        model = Activity
+        # Bulk uploads keep the valid activities of a partly invalid batch
+        list_serializer_class = PartialListSerializer
     
     def create(self, validated_data):
         return Activity(**validated_data)
@@ -71,13 +255,16 @@ class ActivitySerializer(serializers.Serializer):
         instance.distance = validated_data.get('distance', instance.distance)
         return instance
 
-class LeaderboardSerializer(serializers.Serializer):
+class LeaderboardSerializer(CompiledRepresentationMixin, SparseFieldsetMixin, serializers.Serializer):
     _id = ObjectIdField(read_only=True)
     user_id = ObjectIdField()
     score = serializers.IntegerField(min_value=0)
     rank = serializers.IntegerField(min_value=0)
     category = serializers.CharField(max_length=100, required=False)
     
+    class Meta:
+        model = Leaderboard
+
     def create(self, validated_data):
         return Leaderboard(**validated_data)
     
@@ -88,7 +275,7 @@ class LeaderboardSerializer(serializers.Serializer):
         instance.category = validated_data.get('category', instance.category)
         return instance
 
-class WorkoutSerializer(serializers.Serializer):
+class WorkoutSerializer(CompiledRepresentationMixin, SparseFieldsetMixin, serializers.Serializer):
     _id = ObjectIdField(read_only=True)
     name = serializers.CharField(max_length=100)
     description = serializers.CharField(required=False, allow_blank=True)
@@ -96,6 +283,9 @@ class WorkoutSerializer(serializers.Serializer):
     duration = serializers.IntegerField(min_value=0, required=False)  # in minutes
     difficulty = serializers.ChoiceField(choices=['easy', 'medium', 'hard'], default='medium')
     
+    class Meta:
+        model = Workout
+
     def create(self, validated_data):
         return Workout(**validated_data)
     
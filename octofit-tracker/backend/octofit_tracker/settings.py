@@ -29,6 +29,9 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    # Outermost, so its total covers every other middleware (see API_REQUEST_TIMING)
+    'octofit_tracker.instrumentation.RequestTimingMiddleware',
+    'octofit_tracker.metrics.MetricsMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'corsheaders.middleware.CorsMiddleware',  # CORS middleware
@@ -72,6 +75,80 @@ MONGODB_HOST = 'localhost'
 MONGODB_PORT = 27017
 MONGODB_NAME = 'octofit_db'
 
+# MongoDB client settings. The client is created lazily in each process (and
+# again in each worker after fork), so pool sizes apply per worker process.
+MONGODB_MAX_POOL_SIZE = 100
+MONGODB_MIN_POOL_SIZE = 0
+MONGODB_MAX_IDLE_TIME_MS = 60000
+MONGODB_WAIT_QUEUE_TIMEOUT_MS = 2000
+MONGODB_SERVER_SELECTION_TIMEOUT_MS = 5000
+MONGODB_CONNECT_TIMEOUT_MS = 5000
+MONGODB_SOCKET_TIMEOUT_MS = None
+# Fall back to the in-process document store (octofit_tracker.memory) when
+# MongoDB can't be reached. Only in development: otherwise an unreachable
+# server raises instead of serving a process-local store that loses its writes
+MONGODB_FALLBACK_TO_MOCK = DEBUG
+# Always use the in-process document store and never connect, for tests and
+# benchmarks. Data lives in each process's memory only.
+MONGODB_IN_MEMORY = os.environ.get('OCTOFIT_MONGODB_IN_MEMORY') == '1'
+# Check the declared MongoDB indexes on every startup instead of only with
+# `manage.py check --database default`
+MONGODB_CHECK_INDEXES_ON_STARTUP = False
+
+# Per-request timings (octofit_tracker.instrumentation): the number, total and
+# longest duration of the MongoDB commands of each request, the documents they
+# returned and the time spent serializing and rendering, sent in a
+# Server-Timing header and logged on the octofit_tracker.instrumentation
+# logger. When off, the middleware removes itself and no command listener is
+# attached to the MongoClient.
+API_REQUEST_TIMING = os.environ.get('OCTOFIT_REQUEST_TIMING') == '1'
+
+# Prometheus metrics (octofit_tracker.metrics) on /metrics: request counts,
+# latency histograms and requests in progress per route, MongoDB command
+# durations and pool checkout waits, and response cache lookups. Off by
+# default: /metrics is unauthenticated, so when turning it on keep it
+# reachable from the scraper only (e.g. at the load balancer). When off,
+# /metrics answers 404 and nothing is recorded.
+API_METRICS = os.environ.get('OCTOFIT_METRICS') == '1'
+# Directory shared by the worker processes of a prefork server (e.g. gunicorn
+# --workers), for /metrics to report all of them rather than the worker that
+# answered. Each process writes its values to memory-mapped files there; empty
+# the directory before the server starts.
+API_METRICS_MULTIPROCESS_DIR = os.environ.get('OCTOFIT_METRICS_DIR')
+
+# On-demand profiling of the API views (octofit_tracker.profiling). A request
+# carrying API_PROFILING_TOKEN in the API_PROFILING_HEADER header or the
+# `profile` query parameter (any value for staff users) is profiled and gets
+# collapsed stacks and the top cumulative functions, in the response body or,
+# with API_PROFILING_OUTPUT_DIR set, in files there. Each process profiles one
+# request at a time and at most API_PROFILING_MAX_PER_MINUTE a minute.
+API_PROFILING = os.environ.get('OCTOFIT_PROFILING') == '1'
+API_PROFILING_TOKEN = os.environ.get('OCTOFIT_PROFILING_TOKEN')
+API_PROFILING_HEADER = 'X-Octofit-Profile'
+# 'sample' (a stack sampler, cheap) or 'cprofile' (exact, slows the request)
+API_PROFILING_MODE = 'sample'
+# Seconds between stack samples
+API_PROFILING_INTERVAL = 0.001
+API_PROFILING_TOP = 25
+API_PROFILING_MAX_PER_MINUTE = 6
+API_PROFILING_OUTPUT_DIR = os.environ.get('OCTOFIT_PROFILING_DIR')
+
+LOGGING = {
+    'version': 1,
+    'disable_existing_loggers': False,
+    'handlers': {
+        'console': {
+            'class': 'logging.StreamHandler',
+        },
+    },
+    'loggers': {
+        'octofit_tracker.instrumentation': {
+            'handlers': ['console'],
+            'level': 'INFO',
+        },
+    },
+}
+
 # Password validation
 # https://docs.djangoproject.com/en/4.1/ref/settings/#auth-password-validators
 AUTH_PASSWORD_VALIDATORS = [
@@ -121,17 +198,91 @@ CORS_ALLOW_HEADERS = [
     'authorization',
     'content-type',
     'dnt',
+    'if-match',
+    'if-modified-since',
+    'if-none-match',
     'origin',
     'user-agent',
     'x-csrftoken',
     'x-requested-with',
 ]
+# Let browser clients read the pagination and cache validator headers
+CORS_EXPOSE_HEADERS = [
+    'etag',
+    'last-modified',
+    'link',
+    'server-timing',
+    'x-next-cursor',
+]
 
 # REST Framework settings
+# JSON is encoded and decoded with orjson when it is installed
+# (pip install orjson); without it these behave as DRF's stdlib JSON classes.
 REST_FRAMEWORK = {
     'DEFAULT_PERMISSION_CLASSES': [
         'rest_framework.permissions.AllowAny',
     ],
+    'DEFAULT_RENDERER_CLASSES': [
+        'octofit_tracker.renderers.FastJSONRenderer',
+        'rest_framework.renderers.BrowsableAPIRenderer',
+    ],
+    'DEFAULT_PARSER_CLASSES': [
+        'octofit_tracker.parsers.FastJSONParser',
+        'rest_framework.parsers.FormParser',
+        'rest_framework.parsers.MultiPartParser',
+    ],
     'DEFAULT_PAGINATION_CLASS': 'rest_framework.pagination.PageNumberPagination',
     'PAGE_SIZE': 10
-}
\ No newline at end of file
+}
+
+# Keyset pagination for the MongoDB list endpoints (?limit= and ?cursor=)
+API_PAGE_SIZE = 100
+API_MAX_PAGE_SIZE = 1000
+
+# Multi-get by id (?ids= on the users, teams and workouts lists, or POST to
+# their /batch/ endpoints): most distinct ids per request
+API_MAX_BATCH_IDS = 1000
+
+# Response cache for the GET endpoints of rarely written resources. The
+# backend is 'locmem' (per process, LRU with API_CACHE_MAX_ENTRIES) or the
+# alias of a cache in CACHES to share entries between worker processes.
+# API_CACHE_RESOURCES may name any of 'users', 'teams' and 'workouts'.
+API_CACHE_BACKEND = 'locmem'
+API_CACHE_TIMEOUT = 30
+API_CACHE_MAX_ENTRIES = 1000
+API_CACHE_RESOURCES = ['users', 'teams', 'workouts']
+# /api/cache/stats/ answers staff users signed in to the admin and requests
+# carrying API_CACHE_STATS_TOKEN in the API_CACHE_STATS_HEADER header
+API_CACHE_STATS_TOKEN = os.environ.get('OCTOFIT_CACHE_STATS_TOKEN')
+API_CACHE_STATS_HEADER = 'X-Octofit-Cache-Stats'
+
+# Bulk activity uploads (/api/activities/bulk/): largest accepted batch and
+# the number of documents sent to MongoDB per insert_many call
+ACTIVITY_BULK_MAX_ITEMS = 10000
+ACTIVITY_BULK_CHUNK_SIZE = 1000
+# Write-behind for single activity POSTs (octofit_tracker.writebehind): each
+# activity is validated, queued and written by a background flusher with
+# insert_many, in batches of up to ACTIVITY_WRITE_BEHIND_BATCH_SIZE documents
+# at least every ACTIVITY_WRITE_BEHIND_FLUSH_MS milliseconds. The queue is
+# flushed when the process exits.
+ACTIVITY_WRITE_BEHIND = os.environ.get('OCTOFIT_ACTIVITY_WRITE_BEHIND') == '1'
+ACTIVITY_WRITE_BEHIND_BATCH_SIZE = 500
+ACTIVITY_WRITE_BEHIND_FLUSH_MS = 50
+# Queued documents beyond which POSTs get 503 with Retry-After (in seconds)
+ACTIVITY_WRITE_BEHIND_MAX_QUEUE = 10000
+ACTIVITY_WRITE_BEHIND_RETRY_AFTER = 1
+# 'enqueue' answers 202 once queued, and a crash loses what is queued; 'flush'
+# answers 201 once written, or 202 if that takes over
+# ACTIVITY_WRITE_BEHIND_ACK_TIMEOUT seconds
+ACTIVITY_WRITE_BEHIND_ACK = os.environ.get('OCTOFIT_ACTIVITY_WRITE_BEHIND_ACK', 'enqueue')
+ACTIVITY_WRITE_BEHIND_ACK_TIMEOUT = 5
+# Documents fetched per round trip by /api/activities/export/
+ACTIVITY_EXPORT_BATCH_SIZE = 1000
+
+# Apply each activity write's score change to the leaderboard with $inc
+LEADERBOARD_INCREMENTAL_UPDATES = True
+# Apply each activity write to the daily activity rollups with $inc
+ACTIVITY_ROLLUP_INCREMENTAL_UPDATES = True
+# How often each process reloads its in-memory leaderboard rankings to pick up
+# writes made by other worker processes (None: never)
+LEADERBOARD_RANKING_REFRESH_SECONDS = 60
\ No newline at end of file
@@ -0,0 +1,144 @@
+import hashlib
+import math
+import random
+from collections import defaultdict
+from datetime import datetime, timedelta
+
+from bson import ObjectId
+
+# Synthetic data generation for load tests, benchmarks and capacity planning.
+# Everything is derived from (seed, user index), so a dataset can be generated
+# in shards by separate worker processes and still come out identical.
+
+FIRST_NAMES = [
+    'Ada', 'Alan', 'Grace', 'Linus', 'Margaret', 'Dennis', 'Barbara', 'Ken',
+    'Radia', 'Guido', 'Frances', 'Tim', 'Hedy', 'Donald', 'Katherine', 'John',
+]
+LAST_NAMES = [
+    'Lovelace', 'Turing', 'Hopper', 'Torvalds', 'Hamilton', 'Ritchie', 'Liskov',
+    'Thompson', 'Perlman', 'Rossum', 'Allen', 'Berners-Lee', 'Lamarr', 'Knuth',
+]
+
+# activity type: (share of activities, mean minutes, stddev minutes,
+#                 kcal per minute, metres per minute)
+ACTIVITY_PROFILES = {
+    'RUNNING': (0.30, 40, 15, 11.0, 170),
+    'CYCLING': (0.20, 60, 25, 8.5, 380),
+    'WEIGHTLIFTING': (0.20, 50, 15, 6.0, 0),
+    'YOGA': (0.15, 35, 10, 3.5, 0),
+    'SWIMMING': (0.15, 40, 15, 9.0, 35),
+}
+ACTIVITY_TYPES = list(ACTIVITY_PROFILES)
+ACTIVITY_WEIGHTS = [profile[0] for profile in ACTIVITY_PROFILES.values()]
+
+# Most workouts happen before school or in the early evening
+START_HOURS = list(range(5, 23))
+START_HOUR_WEIGHTS = [2, 4, 5, 3, 1, 1, 1, 1, 1, 1, 2, 3, 5, 6, 5, 3, 2, 1]
+
+
+def make_object_id(seed, kind, index, when):
+    """Deterministic ObjectId whose timestamp part is `when`"""
+    digest = hashlib.blake2b(f'{seed}:{kind}:{index}'.encode(), digest_size=8).digest()
+    timestamp = int((when - datetime(1970, 1, 1)).total_seconds())
+    return ObjectId(timestamp.to_bytes(4, 'big') + digest)
+
+
+def user_id_for(seed, index, start):
+    return make_object_id(seed, 'user', index, start)
+
+
+def user_rng(seed, index):
+    return random.Random(f'{seed}:{index}')
+
+
+def generate_user(seed, index, start):
+    rng = user_rng(seed, index)
+    first_name = rng.choice(FIRST_NAMES)
+    last_name = rng.choice(LAST_NAMES)
+    return {
+        '_id': user_id_for(seed, index, start),
+        'username': f'user{index:07d}',
+        'email': f'user{index:07d}@mhigh.edu',
+        'password': f'password{index}',
+        'first_name': first_name,
+        'last_name': last_name,
+    }
+
+
+def activity_count(rng, mean):
+    """Heavy-tailed activity count per user (a few users log far more than most)"""
+    if mean <= 0:
+        return 0
+    sigma = 0.75
+    return int(rng.lognormvariate(math.log(mean) - sigma * sigma / 2, sigma))
+
+
+def generate_activities(seed, index, user_id, mean_count, start, days):
+    rng = user_rng(seed, f'activities:{index}')
+    for n in range(activity_count(rng, mean_count)):
+        activity_type = rng.choices(ACTIVITY_TYPES, ACTIVITY_WEIGHTS)[0]
+        _, mean_minutes, stddev_minutes, kcal_per_minute, metres_per_minute = ACTIVITY_PROFILES[activity_type]
+        duration = max(5, int(rng.gauss(mean_minutes, stddev_minutes)))
+        date = start + timedelta(
+            days=rng.randrange(days),
+            hours=rng.choices(START_HOURS, START_HOUR_WEIGHTS)[0],
+            minutes=rng.randrange(60),
+        )
+        yield {
+            '_id': make_object_id(seed, f'activity:{index}', n, date),
+            'user_id': user_id,
+            'activity_type': activity_type,
+            'duration': duration,
+            'date': date,
+            'calories': int(duration * kcal_per_minute * rng.uniform(0.8, 1.2)),
+            'distance': round(duration * metres_per_minute * rng.uniform(0.85, 1.15), 1),
+        }
+
+
+def populate_shard(seed, first, last, activities_per_user, start, days, batch_size):
+    """
+    Generate and insert users [first, last) and their activities.
+
+    Runs inside a worker process. Returns the number of users and activities
+    written and the per-user calorie totals by activity type.
+    """
+    from .models import activities_collection, users_collection
+
+    users, activities = [], []
+    user_count = activity_total = 0
+    totals = {}
+    for index in range(first, last):
+        user = generate_user(seed, index, start)
+        users.append(user)
+        user_totals = defaultdict(int)
+        for activity in generate_activities(seed, index, user['_id'], activities_per_user, start, days):
+            activities.append(activity)
+            user_totals[activity['activity_type']] += activity['calories']
+            if len(activities) >= batch_size:
+                activities_collection.insert_many(activities, ordered=False)
+                activity_total += len(activities)
+                activities = []
+        totals[index] = dict(user_totals)
+        if len(users) >= batch_size:
+            users_collection.insert_many(users, ordered=False)
+            user_count += len(users)
+            users = []
+    if users:
+        users_collection.insert_many(users, ordered=False)
+        user_count += len(users)
+    if activities:
+        activities_collection.insert_many(activities, ordered=False)
+        activity_total += len(activities)
+    return user_count, activity_total, totals
+
+
+def sample_activities(count, seed=42, start=datetime(2024, 1, 1), days=365):
+    """The first `count` synthetic activity documents, without a database"""
+    documents = []
+    index = 0
+    while len(documents) < count:
+        user_id = user_id_for(seed, index, start)
+        documents.extend(generate_activities(seed, index, user_id, 50, start, days))
+        index += 1
+    del documents[count:]
+    return documents
@@ -6,6 +6,7 @@ import json
 from bson import ObjectId
 import pytest
 from pymongo import MongoClient
+from pymongo.errors import PyMongoError
 from django.conf import settings
 
 # We'll use pytest for testing with MongoDB
@@ -13,7 +14,12 @@ from django.conf import settings
 @pytest.fixture
 def mongodb_client():
     """Create a MongoDB client for testing"""
-    client = MongoClient(settings.MONGODB_HOST, settings.MONGODB_PORT)
+    client = MongoClient(settings.MONGODB_HOST, settings.MONGODB_PORT, serverSelectionTimeoutMS=1000)
+    try:
+        client.admin.command('ping')
+    except PyMongoError as e:
+        client.close()
+        pytest.skip(f'MongoDB is not reachable: {e}')
     db = client['octofit_test_db']  # Use a test database
     yield db
     # Clean up after tests
@@ -148,7 +154,7 @@ class LeaderboardAPITests:
     """Test cases for Leaderboard API endpoints"""
     
     def test_create_leaderboard_entry(self, mongodb_client):
-        """Test creating a new leaderboard entry"""
+        """Test that leaderboard entries cannot be created directly"""
         # First create a test user
         user_id = ObjectId()
         mongodb_client.users.insert_one({
@@ -167,8 +173,9 @@ class LeaderboardAPITests:
             'category': 'Running'
         }
         response = client.post(url, data, format='json')
-        assert response.status_code == status.HTTP_201_CREATED
-        assert mongodb_client.leaderboard.count_documents({}) == 1
+        # Entries are computed from activities; the endpoints are read-only
+        assert response.status_code == status.HTTP_405_METHOD_NOT_ALLOWED
+        assert mongodb_client.leaderboard.count_documents({}) == 0
         
     def test_get_leaderboard_list(self, mongodb_client):
         """Test retrieving leaderboard list"""
@@ -230,4 +237,1229 @@ class WorkoutAPITests:
         url = reverse('workout-list')
         response = client.get(url)
         assert response.status_code == status.HTTP_200_OK
-        assert len(response.data) == 1
\ No newline at end of file
+        assert len(response.data) == 1
+
+class ConnectionManagerTests:
+    """Test cases for the lazy MongoDB connection manager"""
+
+    def test_manager_does_not_connect_until_used(self):
+        """Test that creating a manager and proxy opens no client"""
+        from octofit_tracker.mongo import CollectionProxy, MongoConnectionManager
+        manager = MongoConnectionManager()
+        proxy = CollectionProxy('users', manager=manager)
+        assert repr(proxy) == "CollectionProxy('users')"
+        assert manager._client is None
+
+    def test_client_is_recreated_in_forked_child(self):
+        """Test that a client inherited from another process is not reused"""
+        from django.test import override_settings
+        from octofit_tracker.mongo import MongoConnectionManager
+        manager = MongoConnectionManager()
+        with override_settings(MONGODB_FALLBACK_TO_MOCK=False, MONGODB_MAX_POOL_SIZE=7):
+            parent_client = manager.client
+            assert parent_client.options.pool_options.max_pool_size == 7
+            manager.after_fork_in_child()
+            assert manager.client is not parent_client
+        manager.close()
+
+    def test_unreachable_server_raises_without_fallback(self):
+        """Test that an unreachable server is not replaced by the in-memory store by default"""
+        import pytest
+        from django.conf import settings
+        from django.test import override_settings
+        from pymongo.errors import ServerSelectionTimeoutError
+        from octofit_tracker.mongo import MongoConnectionManager
+        manager = MongoConnectionManager()
+        with override_settings(MONGODB_PORT=1, MONGODB_SERVER_SELECTION_TIMEOUT_MS=100):
+            # Settings that omit MONGODB_FALLBACK_TO_MOCK get no fallback
+            del settings.MONGODB_FALLBACK_TO_MOCK
+            assert manager.client is not None
+            with pytest.raises(ServerSelectionTimeoutError):
+                manager.get_collection('users').find_one()
+        manager.close()
+
+
+class KeysetPaginationTests:
+    """Test cases for keyset pagination cursors"""
+
+    def test_cursor_round_trip(self):
+        """Test that a cursor decodes back to the sort key values"""
+        from datetime import datetime
+        from octofit_tracker.views import ACTIVITY_ORDERING
+        from octofit_tracker.pagination import KeysetPagination
+        paginator = KeysetPagination(ordering=ACTIVITY_ORDERING)
+        doc = {'_id': ObjectId(), 'date': datetime(2024, 5, 1, 7, 30)}
+        assert paginator.decode_cursor(paginator.encode_cursor(doc)) == [doc['date'], doc['_id']]
+
+    def test_descending_cursor_filter_includes_null_dates(self):
+        """Test that documents without a date are reached after dated ones"""
+        from datetime import datetime
+        from pymongo import DESCENDING
+        from octofit_tracker.pagination import KeysetPagination
+        paginator = KeysetPagination(ordering=(('date', DESCENDING),))
+        last_id = ObjectId()
+        date = datetime(2024, 5, 1)
+        assert paginator.cursor_filter([date, last_id]) == {'$or': [
+            {'$or': [{'date': {'$lt': date}}, {'date': None}]},
+            {'date': date, '_id': {'$lt': last_id}},
+        ]}
+        assert paginator.cursor_filter([None, last_id]) == {'date': None, '_id': {'$lt': last_id}}
+
+
+class SparseFieldsetTests:
+    """Test cases for ?fields= sparse fieldsets"""
+
+    def test_projection_and_output_are_limited(self):
+        """Test that requested fields become a projection and limit the output"""
+        from octofit_tracker.models import User
+        from octofit_tracker.serializers import UserSerializer
+        assert UserSerializer.get_projection(['username', 'email']) == {'username': 1, 'email': 1}
+        user = User(username='testuser', email='test@example.com', first_name='Test')
+        assert set(UserSerializer(user, fields=['username']).data) == {'username'}
+
+    def test_write_only_fields_cannot_be_requested(self):
+        """Test that the password is not a selectable field"""
+        from octofit_tracker.serializers import UserSerializer
+        assert 'password' not in UserSerializer.readable_fields()
+
+
+class IndexRegistryTests:
+    """Test cases for declared index drift detection"""
+
+    def test_index_drift(self):
+        """Test that missing, mismatched and undeclared indexes are reported"""
+        from pymongo import ASCENDING, IndexModel
+        from octofit_tracker.indexes import index_drift
+
+        class FakeCollection:
+            name = 'users'
+
+            def index_information(self):
+                return {
+                    '_id_': {'key': [('_id', 1)], 'v': 2},
+                    'username_unique': {'key': [('username', 1)], 'v': 2},
+                    'legacy': {'key': [('team_id', 1)], 'v': 2},
+                }
+
+        declared = [
+            IndexModel([('username', ASCENDING)], name='username_unique', unique=True),
+            IndexModel([('email', ASCENDING)], name='email_unique', unique=True),
+        ]
+        drift = index_drift(FakeCollection(), declared)
+        assert [model.document['name'] for model in drift.missing] == ['email_unique']
+        assert [model.document['name'] for model in drift.mismatched] == ['username_unique']
+        assert drift.unknown == ['legacy']
+
+
+class ActivityBulkTests:
+    """Test cases for bulk activity validation and parsing"""
+
+    def test_invalid_items_are_reported_by_index(self):
+        """Test that valid items survive a partly invalid batch"""
+        from octofit_tracker.serializers import ActivitySerializer
+        user_id = str(ObjectId())
+        serializer = ActivitySerializer(data=[
+            {'user_id': user_id, 'activity_type': 'Running', 'duration': 30},
+            {'user_id': 'not-an-id', 'activity_type': 'Running', 'duration': 30},
+            {'user_id': user_id, 'activity_type': 'Yoga', 'duration': -5},
+        ], many=True)
+        assert serializer.is_valid()
+        assert serializer.valid_indexes == [0]
+        assert [error['index'] for error in serializer.item_errors] == [1, 2]
+
+    def test_ndjson_parser(self):
+        """Test that NDJSON bodies parse into a list and skip blank lines"""
+        import io
+        from octofit_tracker.parsers import NDJSONParser
+        stream = io.BytesIO(b'{"duration": 30}\n\n{"duration": 45}\n')
+        assert NDJSONParser().parse(stream) == [{'duration': 30}, {'duration': 45}]
+
+
+class SyntheticDataTests:
+    """Test cases for the synthetic data generator used by populate_db"""
+
+    def test_same_seed_generates_same_activities(self):
+        """Test that generation is deterministic per seed and user index"""
+        from datetime import datetime
+        from octofit_tracker import synthetic
+        start = datetime(2024, 1, 1)
+        user_id = synthetic.user_id_for(42, 7, start)
+        first = list(synthetic.generate_activities(42, 7, user_id, 20, start, 30))
+        second = list(synthetic.generate_activities(42, 7, user_id, 20, start, 30))
+        assert first == second
+        assert all(start <= activity['date'] for activity in first)
+        assert synthetic.generate_user(43, 7, start)['_id'] != user_id
+
+    def test_leaderboard_skips_zero_scores(self, memory_store):
+        """Test that the synthetic leaderboard, like the pipeline, has no score-0 entries"""
+        import io
+        from datetime import datetime
+        from octofit_tracker import synthetic
+        from octofit_tracker.management.commands.populate_db import Command
+        from octofit_tracker.models import leaderboard_collection
+        start = datetime(2024, 1, 1)
+        totals = {0: {'running': 300, 'yoga': 0}, 1: {'running': 300}, 2: {'yoga': 0}, 3: {}}
+        Command(stdout=io.StringIO()).create_synthetic_leaderboard(42, totals, start, batch_size=2)
+        entries = {(entry['category'], entry['user_id']): entry for entry in leaderboard_collection.find()}
+        first, second = synthetic.user_id_for(42, 0, start), synthetic.user_id_for(42, 1, start)
+        assert set(entries) == {('OVERALL', first), ('OVERALL', second), ('running', first), ('running', second)}
+        assert all(entry['score'] == 300 and entry['rank'] == 1 for entry in entries.values())
+
+
+class PopulateDemoTests:
+    """Test cases for the demo dataset of populate_db"""
+
+    def test_rollups_and_leaderboard_are_rebuilt(self, memory_store, monkeypatch):
+        """Test that repopulating computes the rollups and leaderboard of the new activities"""
+        import io
+        from datetime import datetime
+        from django.core.management import call_command
+        from octofit_tracker import rollups
+        from octofit_tracker.models import activities_collection, leaderboard_collection, rollups_collection
+        stale_user = ObjectId()
+        rollups.record_activity_changes(added=[{'user_id': stale_user, 'activity_type': 'yoga',
+                                                'date': datetime(2024, 1, 1), 'calories': 99}])
+        # populate_db refuses the in-memory store, which only lives in this process
+        monkeypatch.setattr(memory_store, 'get_database', lambda: memory_store.get_collection('users').database)
+        call_command('populate_db', stdout=io.StringIO())
+        assert rollups_collection.count_documents({'user_id': stale_user}) == 0
+        for activity in activities_collection.find():
+            assert rollups.user_stats(activity['user_id'])['totals']['calories'] == activity['calories']
+        # The demo leaderboard is computed from the demo activities
+        entries = list(leaderboard_collection.find({'category': 'OVERALL'}))
+        assert len(entries) == activities_collection.count_documents({})
+        for entry in entries:
+            assert entry['score'] == activities_collection.find_one({'user_id': entry['user_id']})['calories']
+            assert 'leaderboard_id' not in entry
+
+
+class LeaderboardEngineTests:
+    """Test cases for the server-computed leaderboard"""
+
+    def test_pipeline_ranks_per_category_and_merges(self):
+        """Test that the pipeline dense-ranks each category and merges by user and category"""
+        from datetime import datetime
+        from octofit_tracker.leaderboard import leaderboard_pipeline
+        pipeline = leaderboard_pipeline(datetime(2024, 1, 1), into='leaderboard')
+        window = next(stage['$setWindowFields'] for stage in pipeline if '$setWindowFields' in stage)
+        assert window['partitionBy'] == '$_id.category'
+        assert window['output'] == {'rank': {'$denseRank': {}}}
+        assert pipeline[-1]['$merge']['on'] == ['user_id', 'category']
+
+
+class LeaderboardRankingTests:
+    """Test cases for the incrementally maintained leaderboard rankings"""
+
+    def _ranking(self, scores):
+        from octofit_tracker.leaderboard import CategoryRanking
+        ranking = CategoryRanking('RUNNING')
+        for user_id, score in scores.items():
+            ranking.set_score(user_id, score)
+        return ranking
+
+    def test_dense_ranks(self):
+        """Test that equal scores share a rank and the next score takes the next rank"""
+        ranking = self._ranking({'a': 300, 'b': 500, 'c': 300, 'd': 100})
+        assert [ranking.rank(user) for user in 'abcd'] == [2, 1, 2, 3]
+        assert ranking.rank('missing') is None
+
+    def test_set_score_and_remove_rerank(self):
+        """Test that score changes and removals move users and close rank gaps"""
+        ranking = self._ranking({'a': 300, 'b': 500, 'c': 100})
+        ranking.set_score('c', 600)
+        assert [ranking.rank(user) for user in 'abc'] == [3, 2, 1]
+        ranking.remove('b')
+        assert [ranking.rank(user) for user in 'ac'] == [2, 1]
+        assert len(ranking) == 2
+
+    def test_page_resumes_after_key(self):
+        """Test that pages are best first and continue after a (score, user_id) key"""
+        ranking = self._ranking({'a': 300, 'b': 500, 'c': 300, 'd': 100})
+        first = ranking.page(2)
+        assert [entry['user_id'] for entry in first] == ['b', 'a']
+        rest = ranking.page(10, after=(first[-1]['score'], first[-1]['user_id']))
+        assert [(entry['user_id'], entry['rank']) for entry in rest] == [('c', 2), ('d', 3)]
+
+    def test_around(self):
+        """Test that around returns the user's neighbours within the window"""
+        ranking = self._ranking({'a': 400, 'b': 500, 'c': 300, 'd': 100})
+        assert [entry['user_id'] for entry in ranking.around('a', 1)] == ['b', 'a', 'c']
+        assert [entry['user_id'] for entry in ranking.around('b', 1)] == ['b', 'a']
+        assert ranking.around('missing', 1) is None
+
+    def test_score_deltas(self):
+        """Test that an edited activity moves its calories between categories"""
+        from octofit_tracker.leaderboard import OVERALL, score_deltas
+        before = {'user_id': 'u', 'activity_type': 'running', 'calories': 300}
+        after = {'user_id': 'u', 'activity_type': 'cycling', 'calories': 250}
+        assert score_deltas(removed=[before], added=[after]) == {
+            ('u', 'RUNNING'): -300,
+            ('u', 'CYCLING'): 250,
+            ('u', OVERALL): -50,
+        }
+        assert score_deltas(removed=[before], added=[before]) == {}
+
+    def test_entries_are_read_only(self, memory_store):
+        """Test that entries cannot be written directly, only through activities"""
+        client = APIClient()
+        user_id = str(ObjectId())
+        client.post(reverse('activity-list'), {'user_id': user_id, 'activity_type': 'Running', 'duration': 30,
+                                               'calories': 10}, format='json')
+        entry = client.get(reverse('leaderboard-list'), {'category': 'OVERALL'}).data[0]
+        data = {'user_id': user_id, 'score': 500, 'rank': 1, 'category': 'OVERALL'}
+        assert client.post(reverse('leaderboard-list'), data, format='json').status_code == status.HTTP_405_METHOD_NOT_ALLOWED
+        detail = reverse('leaderboard-detail', args=[entry['_id']])
+        assert client.put(detail, {'score': 500}, format='json').status_code == status.HTTP_405_METHOD_NOT_ALLOWED
+        assert client.delete(detail).status_code == status.HTTP_405_METHOD_NOT_ALLOWED
+        assert client.get(detail).data['score'] == 10
+
+    def test_reload_is_single_flight(self, memory_store, monkeypatch):
+        """Test that one request reloads an expired category while the others serve the stale ranking"""
+        import threading
+        import time
+        from django.test import override_settings
+        from octofit_tracker.leaderboard import LeaderboardRankings
+        rankings = LeaderboardRankings()
+        stale = rankings.category('RUNNING')
+        release, loads = threading.Event(), []
+        load = rankings._load
+
+        def slow_load(category):
+            loads.append(category)
+            release.wait(5)
+            return load(category)
+
+        monkeypatch.setattr(rankings, '_load', slow_load)
+        with override_settings(LEADERBOARD_RANKING_REFRESH_SECONDS=0):
+            reloader = threading.Thread(target=rankings.category, args=['RUNNING'])
+            reloader.start()
+            while not loads:
+                time.sleep(0.001)
+            assert [rankings.category('RUNNING') for _ in range(3)] == [stale] * 3
+            release.set()
+            reloader.join()
+        assert loads == ['RUNNING']
+        assert rankings.category('RUNNING') is not stale
+
+    def test_rebuild_keeps_entries_written_during_the_run(self, memory_store, monkeypatch):
+        """Test that a rebuild does not delete entries upserted by writes while it runs"""
+        from octofit_tracker import leaderboard
+        from octofit_tracker.models import activities_collection, leaderboard_collection
+        user_id = ObjectId()
+        activities_collection.insert_one({'user_id': ObjectId(), 'activity_type': 'yoga', 'calories': 10})
+        # Patch the store's collection: patching the proxy would outlive the store
+        activities = activities_collection.collection
+        aggregate = activities.aggregate
+
+        def aggregate_then_write(pipeline, **kwargs):
+            result = aggregate(pipeline, **kwargs)
+            leaderboard.record_activity_changes(added=[{'user_id': user_id, 'activity_type': 'running', 'calories': 40}])
+            return result
+
+        monkeypatch.setattr(activities, 'aggregate', aggregate_then_write)
+        leaderboard_collection.insert_one({'user_id': ObjectId(), 'category': 'OVERALL', 'score': 5})
+        assert leaderboard.rebuild() == 4
+        assert leaderboard_collection.find_one({'user_id': user_id, 'category': 'OVERALL'})['score'] == 40
+
+
+class ActivityExportTests:
+    """Test cases for the streaming activity export"""
+
+    def test_ndjson_renderer_streams_one_line_per_row(self):
+        """Test that NDJSON rows are encoded one line at a time"""
+        from octofit_tracker.renderers import NDJSONRenderer
+        lines = list(NDJSONRenderer().iter_lines(iter([{'a': 1}, {'a': 'é'}])))
+        assert lines == [b'{"a":1}\n', '{"a":"é"}\n'.encode()]
+
+    def test_csv_renderer_header(self):
+        """Test that CSV output starts with a header, even when there are no rows"""
+        from octofit_tracker.renderers import CSVRenderer
+        renderer = CSVRenderer()
+        lines = list(renderer.iter_lines(iter([{'a': 1, 'b': 'x,y'}]), header=['a', 'b']))
+        assert lines == [b'a,b\r\n1,"x,y"\r\n']
+        assert list(renderer.iter_lines(iter([]), header=['a', 'b'])) == [b'a,b\r\n']
+
+    def test_export_date_params(self):
+        """Test that since/until accept datetimes and plain dates and reject anything else"""
+        import pytest
+        from datetime import datetime
+        from rest_framework.exceptions import ParseError
+        from octofit_tracker.views import ActivityExportView
+        assert ActivityExportView.parse_date_param('since', '2024-03-01') == datetime(2024, 3, 1)
+        assert ActivityExportView.parse_date_param('since', '2024-03-01T10:30:00').hour == 10
+        with pytest.raises(ParseError):
+            ActivityExportView.parse_date_param('until', '2024-13-01')
+
+
+class ResponseCacheTests:
+    """Test cases for the read-through response cache"""
+
+    def test_locmem_lru_and_expiry(self):
+        """Test that the local-memory backend evicts least recently used and expired entries"""
+        import time
+        from octofit_tracker.cache import LocMemBackend
+        backend = LocMemBackend(max_entries=2)
+        backend.set('a', 1)
+        backend.set('b', 2)
+        assert backend.get('a') == 1
+        backend.set('c', 3)
+        assert backend.get('b') is None
+        assert backend.get('a') == 1 and backend.evictions == 1
+        backend.set('d', 4, timeout=0.01)
+        time.sleep(0.02)
+        assert backend.get('d', 'gone') == 'gone'
+
+    def test_writes_invalidate_lists_and_one_object(self):
+        """Test that invalidation covers every list variant but only the written object"""
+        from django.http import QueryDict
+        from django.test import override_settings
+        from octofit_tracker.cache import ResponseCache
+        with override_settings(API_CACHE_BACKEND='locmem', API_CACHE_RESOURCES=['users']):
+            cache = ResponseCache()
+            list_key = cache.make_key('users', None, QueryDict('limit=5&fields=username'))
+            assert list_key == cache.make_key('users', None, QueryDict('fields=username&limit=5'))
+            first_key = cache.make_key('users', 'u1', QueryDict())
+            second_key = cache.make_key('users', 'u2', QueryDict())
+            for key in (list_key, first_key, second_key):
+                cache.backend.set(key, ([], {}))
+            cache.invalidate('users', 'u1')
+            assert cache.make_key('users', None, QueryDict('limit=5&fields=username')) != list_key
+            assert cache.make_key('users', 'u1', QueryDict()) != first_key
+            assert cache.make_key('users', 'u2', QueryDict()) == second_key
+            assert cache.get(second_key) == ([], {})
+            assert cache.stats()['hits'] == 1
+
+    def test_stats_need_staff_or_token(self):
+        """Test that the cache stats are only shown to staff users and requests with the token"""
+        from django.contrib.auth.models import User as AuthUser
+        from django.test import override_settings
+        url = reverse('cache-stats')
+        with override_settings(API_CACHE_STATS_TOKEN='secret'):
+            client = APIClient()
+            assert client.get(url).status_code == status.HTTP_403_FORBIDDEN
+            assert client.get(url, HTTP_X_OCTOFIT_CACHE_STATS='wrong').status_code == status.HTTP_403_FORBIDDEN
+            assert 'hits' in client.get(url, HTTP_X_OCTOFIT_CACHE_STATS='secret').json()
+            client.force_authenticate(user=AuthUser(username='ops', is_staff=True))
+            assert client.get(url).status_code == status.HTTP_200_OK
+        with override_settings(API_CACHE_STATS_TOKEN=None):
+            assert APIClient().get(url, HTTP_X_OCTOFIT_CACHE_STATS='').status_code == status.HTTP_403_FORBIDDEN
+
+
+class ConditionalGetTests:
+    """Test cases for ETag and Last-Modified support"""
+
+    def test_etag_follows_versions_and_fields(self):
+        """Test that the ETag changes with a document's version and the requested fields"""
+        from octofit_tracker.conditional import make_etag
+        document = {'_id': ObjectId(), 'version': 1}
+        etag = make_etag([document])
+        assert etag == make_etag([dict(document)])
+        assert etag != make_etag([dict(document, version=2)])
+        assert etag != make_etag([document], fields=['name'])
+        assert make_etag([document], fields=['a', 'b']) == make_etag([document], fields=['b', 'a'])
+
+    def test_versioned_update_bumps_version(self):
+        """Test that updates $inc the version instead of overwriting it"""
+        from octofit_tracker.conditional import versioned_update
+        update = versioned_update({'name': 'Blue', 'version': 3})
+        assert update['$inc'] == {'version': 1}
+        assert 'version' not in update['$set']
+        assert update['$set']['updated_at'].microsecond == 0
+
+    def test_not_modified(self):
+        """Test that a matching If-None-Match or If-Modified-Since gets a 304"""
+        from datetime import datetime
+        from django.test import RequestFactory
+        from octofit_tracker.conditional import not_modified, validators
+        etag, modified = validators([{'_id': 1, 'version': 2, 'updated_at': datetime(2024, 1, 1)}])
+        factory = RequestFactory()
+        assert not_modified(factory.get('/', HTTP_IF_NONE_MATCH=etag), etag, modified).status_code == 304
+        assert not_modified(factory.get('/', HTTP_IF_NONE_MATCH='"other"'), etag, modified) is None
+        since = 'Mon, 01 Jan 2024 00:00:00 GMT'
+        assert not_modified(factory.get('/', HTTP_IF_MODIFIED_SINCE=since), etag, modified).status_code == 304
+        assert not_modified(factory.get('/'), etag, modified) is None
+
+    def test_page_etag_follows_next_page(self, memory_store):
+        """Test that a page's ETag changes once a next page appears after it"""
+        client = APIClient()
+        for name in ('Plank', 'Squat'):
+            client.post('/api/workouts/', {'name': name, 'description': name, 'duration': 10, 'difficulty': 'easy'},
+                        format='json')
+        response = client.get('/api/workouts/', {'limit': 2})
+        assert 'Link' not in response
+        etag = response['ETag']
+        client.post('/api/workouts/', {'name': 'Lunge', 'description': 'Lunge', 'duration': 10, 'difficulty': 'easy'},
+                    format='json')
+        response = client.get('/api/workouts/', {'limit': 2}, HTTP_IF_NONE_MATCH=etag)
+        assert response.status_code == status.HTTP_200_OK
+        assert len(response.json()) == 2 and 'X-Next-Cursor' in response
+        assert client.get('/api/workouts/', {'limit': 2}, HTTP_IF_NONE_MATCH=response['ETag']).status_code == 304
+
+
+class DocumentModelTests:
+    """Test cases for the generated model classes"""
+
+    def test_round_trip_and_defaults(self):
+        """Test from_mongo/to_mongo round trips and the defaults of missing fields"""
+        from octofit_tracker.models import Activity, Team, User
+        document = {'_id': ObjectId(), 'user_id': ObjectId(), 'activity_type': 'running',
+                    'duration': 30, 'date': None, 'calories': 300, 'distance': 5000.0}
+        assert Activity.from_mongo(document).to_mongo() == document
+        user = User.from_mongo({'username': 'testuser'})
+        assert isinstance(user._id, ObjectId)
+        assert (user.email, user.version, User().version) == ('', 0, 1)
+        assert Team.from_mongo({'members': None}).members == []
+        assert Team().members is not Team().members
+
+    def test_models_are_slotted(self):
+        """Test that model objects have no __dict__ and reject unknown attributes"""
+        from octofit_tracker.models import Workout
+        workout = Workout(name='Plank')
+        assert not hasattr(workout, '__dict__')
+        with pytest.raises(AttributeError):
+            workout.nickname = 'core'
+
+
+class CompiledRepresentationTests:
+    """Parity of the compiled read path with the DRF serializers"""
+
+    def _documents(self):
+        from datetime import datetime, timedelta, timezone
+        user_id = ObjectId()
+        return {
+            'UserSerializer': [
+                {'_id': ObjectId(), 'username': 'testuser', 'email': 'test@example.com', 'password': 'secret',
+                 'first_name': 'Test', 'last_name': 'User', 'version': 3, 'updated_at': datetime(2024, 1, 1)},
+                {'_id': ObjectId(), 'username': 'sparse'},
+                {'_id': ObjectId(), 'username': None, 'email': 'ünïcode@example.com', 'first_name': 7},
+            ],
+            'TeamSerializer': [
+                {'_id': ObjectId(), 'name': 'Blue Team', 'description': 'Blue', 'members': [user_id, None]},
+                {'_id': ObjectId(), 'name': 'Empty', 'members': None},
+                {'_id': ObjectId()},
+            ],
+            'ActivitySerializer': [
+                {'_id': ObjectId(), 'user_id': user_id, 'activity_type': 'running', 'duration': 30,
+                 'date': datetime(2024, 5, 1, 7, 30, 15, 250000), 'calories': 300, 'distance': 5000},
+                {'_id': ObjectId(), 'user_id': user_id, 'activity_type': 'yoga', 'duration': 45.0,
+                 'date': datetime(2024, 5, 1, 9, tzinfo=timezone(timedelta(hours=2))), 'calories': None},
+                {'_id': ObjectId(), 'user_id': None, 'date': '2024-05-01'},
+            ],
+            'LeaderboardSerializer': [
+                {'_id': ObjectId(), 'user_id': user_id, 'score': 1200, 'rank': 1, 'category': 'OVERALL'},
+                {'_id': ObjectId(), 'user_id': user_id},
+            ],
+            'WorkoutSerializer': [
+                {'_id': ObjectId(), 'name': 'Core', 'description': 'Abs', 'duration': 20, 'difficulty': 'hard',
+                 'exercises': [{'name': 'Plank', 'sets': 3, 'notes': None}]},
+                {'_id': ObjectId(), 'name': 'Default', 'difficulty': None, 'exercises': None},
+            ],
+        }
+
+    def test_parity_with_serializers(self):
+        """Test that represent() matches serializing the model object, for every field subset"""
+        from octofit_tracker import serializers
+        for name, documents in self._documents().items():
+            serializer_class = getattr(serializers, name)
+            readable = serializer_class.readable_fields()
+            subsets = [None, readable[:1], readable[1:3], readable[-1:]]
+            for fields in subsets:
+                expected = [
+                    serializer_class(serializer_class.Meta.model.from_mongo(document), fields=fields).data
+                    for document in documents
+                ]
+                assert serializer_class.represent_many(documents, fields) == expected, (name, fields)
+                assert [list(row) for row in serializer_class.represent_many(documents, fields)] == \
+                    [list(row) for row in expected]
+
+    def test_representation_fields(self):
+        """Test that output fields keep declaration order and leave out write-only fields"""
+        from octofit_tracker.serializers import UserSerializer
+        assert UserSerializer.representation_fields(['email', 'username']) == ['username', 'email']
+        assert 'password' not in UserSerializer.representation_fields()
+
+
+class FastJSONTests:
+    """Test cases for the orjson-backed renderer and parser"""
+
+    def _data(self):
+        from collections import OrderedDict
+        from datetime import datetime, timezone
+        from decimal import Decimal
+        return [OrderedDict([
+            ('_id', ObjectId('65a000000000000000000001')),
+            ('naive', datetime(2024, 5, 1, 7, 30, 15, 250000)),
+            ('utc', datetime(2024, 5, 1, 7, 30, tzinfo=timezone.utc)),
+            ('price', Decimal('9.50')),
+            ('text', 'line\u2028separator ünïcode'),
+            ('nested', {'list': [1, 2.5, None, True]}),
+        ])]
+
+    def _expected(self, data):
+        from octofit_tracker.renderers import MongoJSONEncoder
+        from rest_framework.renderers import JSONRenderer
+
+        class StdlibRenderer(JSONRenderer):
+            encoder_class = MongoJSONEncoder
+        return StdlibRenderer().render(data)
+
+    def test_renderer_matches_stdlib(self):
+        """Test that orjson output matches DRF's encoder, with and without orjson"""
+        from octofit_tracker import renderers
+        data = self._data()
+        assert renderers.FastJSONRenderer().render(data) == self._expected(data)
+        assert renderers.FastJSONRenderer().render({1: 'non-string key'}) == b'{"1":"non-string key"}'
+        indented = renderers.FastJSONRenderer().render(data, 'application/json; indent=2')
+        assert indented.startswith(b'[\n  {')
+
+    def test_stdlib_fallback(self, monkeypatch):
+        """Test that the fast classes work without orjson installed"""
+        import io
+        from octofit_tracker import parsers, renderers
+        monkeypatch.setattr(renderers, 'orjson', None)
+        monkeypatch.setattr(parsers, 'orjson', None)
+        data = self._data()
+        assert renderers.FastJSONRenderer().render(data) == self._expected(data)
+        assert parsers.FastJSONParser().parse(io.BytesIO(b'{"a": [1]}')) == {'a': [1]}
+
+    def test_parser(self):
+        """Test parsing and parse errors"""
+        import io
+        from octofit_tracker.parsers import FastJSONParser
+        from rest_framework.exceptions import ParseError
+        assert FastJSONParser().parse(io.BytesIO('{"name": "Ünï", "n": 1.5}'.encode())) == {'name': 'Ünï', 'n': 1.5}
+        for body in (b'{"a": ', b'{"a": NaN}'):
+            with pytest.raises(ParseError):
+                FastJSONParser().parse(io.BytesIO(body))
+        latin1 = FastJSONParser().parse(io.BytesIO('{"a": "é"}'.encode('latin-1')), None, {'encoding': 'latin-1'})
+        assert latin1 == {'a': 'é'}
+
+
+@pytest.fixture
+def memory_store():
+    """Run the API on a fresh in-memory document store"""
+    from django.test import override_settings
+    from octofit_tracker.cache import response_cache
+    from octofit_tracker.leaderboard import rankings
+    from octofit_tracker.mongo import connection
+    with override_settings(MONGODB_IN_MEMORY=True):
+        connection.close()
+        response_cache.reset()
+        rankings.reset()
+        yield connection
+        connection.close()
+        response_cache.reset()
+        rankings.reset()
+
+
+class MemoryCollectionTests:
+    """Test cases for the in-memory document store"""
+
+    def _collection(self):
+        from pymongo import IndexModel
+        from octofit_tracker.memory import MemoryDatabase
+        collection = MemoryDatabase('test').users
+        collection.create_indexes([
+            IndexModel([('username', 1)], name='username_unique', unique=True),
+            IndexModel([('age', 1), ('_id', 1)], name='age_id'),
+        ])
+        collection.insert_many([
+            {'username': f'user{i}', 'age': i % 4, 'tags': ['a', 'b'] if i % 2 else ['c']} for i in range(10)
+        ])
+        return collection
+
+    def test_query_operators(self):
+        """Test equality, range, $in, array and logical operators"""
+        collection = self._collection()
+        assert collection.find_one({'username': 'user3'})['age'] == 3
+        assert collection.count_documents({'age': {'$gte': 2, '$lt': 3}}) == 2
+        assert collection.count_documents({'age': {'$in': [0, 3]}}) == 5
+        assert collection.count_documents({'tags': 'a'}) == 5
+        assert collection.count_documents({'$or': [{'age': 1}, {'username': {'$regex': '^user[89]$'}}]}) == 4
+        assert collection.count_documents({'missing': None}) == 10
+        assert collection.count_documents({'age': {'$gt': 'a'}}) == 0
+
+    def test_sort_limit_projection(self):
+        """Test that sorted, limited and projected reads match MongoDB's"""
+        from pymongo import DESCENDING
+        collection = self._collection()
+        documents = list(collection.find({'age': {'$gte': 2}}, {'username': 1, '_id': 0},
+                                         sort=[('age', DESCENDING), ('username', DESCENDING)], limit=3))
+        assert documents == [{'username': 'user7'}, {'username': 'user3'}, {'username': 'user6'}]
+
+    def test_unique_index_and_updates(self):
+        """Test $set/$inc updates, upserts and unique index violations"""
+        from pymongo import ReturnDocument
+        from pymongo.errors import BulkWriteError, DuplicateKeyError
+        collection = self._collection()
+        with pytest.raises(DuplicateKeyError):
+            collection.insert_one({'username': 'user1'})
+        with pytest.raises(DuplicateKeyError):
+            collection.update_one({'username': 'user0'}, {'$set': {'username': 'user1'}})
+        assert collection.count_documents({'username': 'user0'}) == 1
+        with pytest.raises(BulkWriteError) as error:
+            collection.insert_many([{'username': 'new1'}, {'username': 'user2'}, {'username': 'new2'}], ordered=False)
+        assert error.value.details['nInserted'] == 2
+        updated = collection.find_one_and_update(
+            {'username': 'user0'}, {'$inc': {'age': 5}, '$set': {'name': 'Zero'}},
+            return_document=ReturnDocument.AFTER)
+        assert (updated['age'], updated['name']) == (5, 'Zero')
+        result = collection.update_one({'username': 'user10'}, {'$inc': {'score': 3}}, upsert=True)
+        assert collection.find_one({'_id': result.upserted_id})['score'] == 3
+
+    def test_returned_documents_are_copies(self):
+        """Test that changing a returned document doesn't change the stored one"""
+        collection = self._collection()
+        document = collection.find_one({'username': 'user1'})
+        document['tags'].append('z')
+        assert collection.find_one({'username': 'user1'})['tags'] == ['a', 'b']
+
+    def test_aggregation_subset(self):
+        """Test that the leaderboard pipeline runs on the in-memory store"""
+        from datetime import datetime
+        from octofit_tracker.leaderboard import OVERALL, leaderboard_pipeline
+        from octofit_tracker.memory import MemoryDatabase
+        db = MemoryDatabase('test')
+        db.activities.insert_many([
+            {'user_id': 1, 'activity_type': 'running', 'calories': 300},
+            {'user_id': 2, 'activity_type': 'running', 'calories': 300},
+            {'user_id': 2, 'activity_type': 'yoga', 'calories': 100},
+        ])
+        pipeline = leaderboard_pipeline(datetime(2024, 1, 1), into='leaderboard')
+        pipeline[1]['$unionWith']['coll'] = 'activities'
+        list(db.activities.aggregate(pipeline))
+        ranks = {(entry['user_id'], entry['category']): entry['rank'] for entry in db.leaderboard.find()}
+        assert ranks == {(1, 'RUNNING'): 1, (2, 'RUNNING'): 1, (2, 'YOGA'): 1, (2, OVERALL): 1, (1, OVERALL): 2}
+
+    def test_api_on_memory_store(self, memory_store):
+        """Test that the API round-trips a user through the in-memory store"""
+        client = APIClient()
+        data = {'username': 'memory', 'email': 'memory@example.com', 'password': 'password123'}
+        assert client.post(reverse('user-list'), data, format='json').status_code == status.HTTP_201_CREATED
+        assert client.post(reverse('user-list'), data, format='json').status_code == status.HTTP_400_BAD_REQUEST
+        user_id = client.get(reverse('user-list')).data[0]['_id']
+        response = client.put(reverse('user-detail', args=[user_id]), {'first_name': 'Mem'}, format='json')
+        assert response.status_code == status.HTTP_200_OK
+        assert client.get(reverse('user-detail', args=[user_id])).data['first_name'] == 'Mem'
+        assert client.delete(reverse('user-detail', args=[user_id])).status_code == status.HTTP_204_NO_CONTENT
+        assert client.get(reverse('user-detail', args=[user_id])).status_code == status.HTTP_404_NOT_FOUND
+
+
+class AsyncViewTests:
+    """Test cases for the async views under /api/async/"""
+
+    def test_parity_with_drf_views(self, memory_store):
+        """Test that async GETs return the same bodies and headers as the DRF views"""
+        from octofit_tracker.cache import response_cache
+        client = APIClient()
+        for index in range(3):
+            data = {'username': f'user{index}', 'email': f'user{index}@example.com', 'password': 'password123'}
+            assert client.post('/api/async/users/', data, format='json').status_code == status.HTTP_201_CREATED
+        for path in ('users/?limit=2', 'users/?fields=email', 'activities/', 'leaderboard/', 'teams/'):
+            response_cache.reset()
+            expected = client.get(f'/api/{path}')
+            response_cache.reset()
+            response = client.get(f'/api/async/{path}')
+            assert response.status_code == expected.status_code == status.HTTP_200_OK
+            assert response.content == expected.content
+            for header in ('ETag', 'Last-Modified', 'X-Next-Cursor'):
+                assert response.get(header) == expected.get(header)
+        assert client.get('/api/async/teams/')['X-Cache'] == 'HIT'
+
+        user = client.get('/api/async/users/').json()[0]
+        response = client.get(f"/api/async/users/{user['_id']}/")
+        assert response.json() == user
+        assert client.get(f"/api/async/users/{user['_id']}/", HTTP_IF_NONE_MATCH=response['ETag']).status_code == 304
+        assert client.get(f'/api/async/users/{ObjectId()}/').status_code == status.HTTP_404_NOT_FOUND
+        assert client.get('/api/async/users/invalid/').status_code == status.HTTP_400_BAD_REQUEST
+        assert client.get('/api/async/users/?fields=password').status_code == status.HTTP_400_BAD_REQUEST
+
+    def test_lifespan(self, memory_store):
+        """Test that the lifespan wrapper answers startup and shutdown"""
+        import asyncio
+        from octofit_tracker.async_mongo import ThreadedCollection, async_connection, lifespan
+
+        async def run():
+            messages = [{'type': 'lifespan.startup'}, {'type': 'lifespan.shutdown'}]
+            replies = []
+
+            async def receive():
+                return messages.pop(0)
+
+            async def send(message):
+                replies.append(message['type'])
+                if message['type'] == 'lifespan.startup.complete':
+                    assert isinstance(async_connection.get_collection('users'), ThreadedCollection)
+            await lifespan(None)({'type': 'lifespan'}, receive, send)
+            return replies
+        assert asyncio.run(run()) == ['lifespan.startup.complete', 'lifespan.shutdown.complete']
+
+
+class ConditionalWriteTests:
+    """Test cases for single round-trip, optionally version-checked updates"""
+
+    def test_update_document(self):
+        """Test that only the changed fields are $set and version mismatches fail"""
+        from octofit_tracker.conditional import PreconditionFailed, update_document
+        from octofit_tracker.memory import MemoryDatabase
+        collection = MemoryDatabase('test').users
+        object_id = collection.insert_one({'username': 'testuser', 'password': 'secret', 'version': 1}).inserted_id
+        updated = update_document(collection, object_id, {'username': 'renamed'}, versions=[1])
+        assert (updated['username'], updated['password'], updated['version']) == ('renamed', 'secret', 2)
+        with pytest.raises(PreconditionFailed):
+            update_document(collection, object_id, {'username': 'stale'}, versions=[1])
+        assert update_document(collection, ObjectId(), {'username': 'missing'}, versions=[1]) is None
+        assert update_document(collection, object_id, {})['version'] == 2
+
+    def test_etag_version(self):
+        """Test that single-document ETags carry the version"""
+        from octofit_tracker.conditional import etag_version, make_etag
+        etag = make_etag([{'_id': ObjectId(), 'version': 7}], fields=['email'])
+        assert etag_version(etag) == etag_version(f'W/{etag}') == 7
+        assert etag_version(make_etag([{'_id': 1, 'version': 1}, {'_id': 2, 'version': 1}])) is None
+
+    def test_put_with_if_match(self, memory_store):
+        """Test that a PUT with a stale ETag gets a 412 and a fresh one applies"""
+        client = APIClient()
+        data = {'username': 'testuser', 'email': 'test@example.com', 'password': 'password123'}
+        client.post(reverse('user-list'), data, format='json')
+        user_id = client.get(reverse('user-list')).data[0]['_id']
+        etag = client.get(reverse('user-detail', args=[user_id]))['ETag']
+        url = reverse('user-detail', args=[user_id])
+        response = client.put(url, {'first_name': 'Test'}, format='json', HTTP_IF_MATCH=etag)
+        assert response.status_code == status.HTTP_200_OK
+        assert response.data['first_name'] == 'Test'
+        assert response['ETag'] != etag
+        response = client.put(url, {'first_name': 'Lost'}, format='json', HTTP_IF_MATCH=etag)
+        assert response.status_code == status.HTTP_412_PRECONDITION_FAILED
+        assert client.put(url, {'last_name': 'User', 'version': 2}, format='json').status_code == status.HTTP_200_OK
+        stored = memory_store.get_collection('users').find_one({'_id': ObjectId(user_id)})
+        assert (stored['first_name'], stored['last_name'], stored['password'], stored['version']) == \
+            ('Test', 'User', 'password123', 3)
+
+class BatchGetTests:
+    """Test cases for fetching many documents by id"""
+
+    def test_in_request_order(self):
+        """Test that documents come back in the order asked for with the missing ids"""
+        from octofit_tracker.batch import in_request_order, parse_ids
+        first, second, absent = ObjectId(), ObjectId(), ObjectId()
+        object_ids = parse_ids([str(second), str(absent), str(first), str(second)])
+        assert object_ids == [second, absent, first]
+        found, missing = in_request_order([{'_id': first}, {'_id': second}], object_ids)
+        assert [document['_id'] for document in found] == [second, first]
+        assert missing == [str(absent)]
+
+    def test_get_and_post_by_ids(self, memory_store):
+        """Test ?ids= on a list endpoint and the POST variant"""
+        client = APIClient()
+        for name in ('alpha', 'beta', 'gamma'):
+            client.post(reverse('team-list'), {'name': name}, format='json')
+        teams = {team['name']: team['_id'] for team in client.get(reverse('team-list')).data}
+        absent = str(ObjectId())
+        ids = [teams['gamma'], absent, teams['alpha']]
+        response = client.get(reverse('team-list'), {'ids': ','.join(ids), 'fields': 'name'})
+        assert response.status_code == status.HTTP_200_OK
+        assert [team['name'] for team in response.data['results']] == ['gamma', 'alpha']
+        assert response.data['missing'] == [absent]
+        response = client.post(reverse('team-batch') + '?fields=name', {'ids': ids}, format='json')
+        assert [team['name'] for team in response.data['results']] == ['gamma', 'alpha']
+        assert client.get(reverse('team-list'), {'ids': 'nope'}).status_code == status.HTTP_400_BAD_REQUEST
+        assert client.post(reverse('team-batch'), {'ids': 'nope'}, format='json').status_code == \
+            status.HTTP_400_BAD_REQUEST
+        response = client.get(reverse('async-team-list'), {'ids': ','.join(ids), 'fields': 'name'})
+        assert response.json() == {'results': [{'name': 'gamma'}, {'name': 'alpha'}], 'missing': [absent]}
+
+class ExpansionTests:
+    """Test cases for ?expand= on teams and leaderboard entries"""
+
+    def test_expand_members_and_user(self, memory_store):
+        """Test that references are embedded with one query per page and change the ETag"""
+        client = APIClient()
+        for index in range(2):
+            data = {'username': f'user{index}', 'email': f'user{index}@example.com', 'password': 'password123'}
+            client.post(reverse('user-list'), data, format='json')
+        user_ids = [user['_id'] for user in client.get(reverse('user-list')).data]
+        client.post(reverse('team-list'), {'name': 'team', 'members': user_ids[::-1] + [str(ObjectId())]}, format='json')
+        client.post(reverse('activity-list'), {'user_id': user_ids[0], 'activity_type': 'Running', 'duration': 30,
+                                               'calories': 10}, format='json')
+
+        users = memory_store.get_collection('users')
+        calls = []
+        find = users.find
+        users.find = lambda *args, **kwargs: calls.append(args) or find(*args, **kwargs)
+        response = client.get(reverse('team-list'), {'expand': 'members', 'fields': 'name'})
+        assert response.status_code == status.HTTP_200_OK
+        team = response.data[0]
+        assert [member['username'] for member in team['members']] == ['user1', 'user0']
+        assert 'password' not in team['members'][0]
+        assert len(calls) == 1
+        etag = response['ETag']
+        assert etag != client.get(reverse('team-list'), {'fields': 'name'})['ETag']
+        client.put(reverse('user-detail', args=[user_ids[1]]), {'first_name': 'Renamed'}, format='json')
+        response = client.get(reverse('team-list'), {'expand': 'members', 'fields': 'name'}, HTTP_IF_NONE_MATCH=etag)
+        assert response.status_code == status.HTTP_200_OK
+        assert response.data[0]['members'][0]['first_name'] == 'Renamed'
+
+        for params in ({'expand': 'user'}, {'expand': 'user', 'category': 'overall'}):
+            entry = client.get(reverse('leaderboard-list'), params).data[0]
+            assert entry['user']['username'] == 'user0'
+        assert client.get('/api/async/leaderboard/', {'expand': 'user'}).json()[0]['user']['_id'] == user_ids[0]
+        assert client.get(reverse('team-list'), {'expand': 'owner'}).status_code == status.HTTP_400_BAD_REQUEST
+
+class ActivityRollupTests:
+    """Test cases for the daily activity rollups and per-user statistics"""
+
+    def test_stats_follow_writes_and_match_rebuild(self, memory_store):
+        """Test that writes keep the rollups current and a rebuild reproduces them"""
+        from octofit_tracker import rollups
+        client = APIClient()
+        client.post(reverse('user-list'), {'username': 'testuser', 'email': 'test@example.com',
+                                           'password': 'password123'}, format='json')
+        user_id = client.get(reverse('user-list')).data[0]['_id']
+        for date, activity_type, calories in (
+            ('2024-01-01T10:00:00Z', 'running', 100),
+            ('2024-01-01T23:30:00-02:00', 'running', 50),
+            ('2024-01-03T08:00:00Z', 'cycling', 70),
+            ('2024-02-10T08:00:00Z', 'running', 30),
+        ):
+            data = {'user_id': user_id, 'activity_type': activity_type, 'duration': 30, 'calories': calories, 'date': date}
+            client.post(reverse('activity-list'), data, format='json')
+
+        stats = client.get(reverse('user-stats', args=[user_id]), {'granularity': 'week'}).data
+        assert stats['totals'] == {'count': 4, 'duration': 120, 'calories': 250, 'distance': 0}
+        assert [(bucket['start'], bucket['calories']) for bucket in stats['buckets']] == \
+            [('2024-01-01T00:00:00Z', 220), ('2024-02-05T00:00:00Z', 30)]
+        assert stats['buckets'][0]['activity_types']['CYCLING']['count'] == 1
+
+        oldest = client.get(reverse('activity-list')).data[-1]['_id']
+        client.put(reverse('activity-detail', args=[oldest]), {'calories': 10}, format='json')
+        stats = client.get(reverse('user-stats', args=[user_id]), {'from': '2024-01-01', 'to': '2024-01-02'}).data
+        assert [(bucket['start'], bucket['calories']) for bucket in stats['buckets']] == [('2024-01-01T00:00:00Z', 10)]
+
+        collection = memory_store.get_collection('activity_rollups')
+        incremental = sorted((doc['day'], doc['activity_type'], doc['count'], doc['calories']) for doc in collection.find())
+        assert rollups.rebuild() == len(incremental)
+        assert sorted((doc['day'], doc['activity_type'], doc['count'], doc['calories'])
+                      for doc in collection.find()) == incremental
+        assert client.get(reverse('user-stats', args=[user_id]), {'granularity': 'year'}).status_code == \
+            status.HTTP_400_BAD_REQUEST
+        assert client.get(reverse('user-stats', args=[str(ObjectId())])).status_code == status.HTTP_404_NOT_FOUND
+
+    def test_single_user_rebuild(self, memory_store):
+        """Test that rebuilding one user's rollups leaves the other users' rollups alone"""
+        from datetime import datetime
+        from octofit_tracker import rollups
+        from octofit_tracker.models import activities_collection
+        rebuilt, other = ObjectId(), ObjectId()
+        for user_id in (rebuilt, other):
+            activities_collection.insert_one({'user_id': user_id, 'activity_type': 'running',
+                                              'date': datetime(2024, 1, 1, 10), 'calories': 40})
+        # Drift of the other user's rollups that only a rebuild of that user repairs
+        rollups.record_activity_changes(added=[{'user_id': other, 'activity_type': 'yoga',
+                                                'date': datetime(2024, 1, 2), 'calories': 5}])
+        assert rollups.rebuild(rebuilt) == 1
+        assert rollups.user_stats(rebuilt)['totals']['calories'] == 40
+        assert rollups.user_stats(other)['totals']['calories'] == 5
+
+    def test_rebuild_keeps_rollups_written_during_the_run(self, memory_store, monkeypatch):
+        """Test that a rebuild does not delete rollups upserted by writes while it runs"""
+        from datetime import datetime
+        from octofit_tracker import rollups
+        from octofit_tracker.models import activities_collection
+        user_id = ObjectId()
+        activity = {'user_id': user_id, 'activity_type': 'running', 'date': datetime(2024, 1, 1, 10), 'calories': 40}
+        # Patch the store's collection: patching the proxy would outlive the store
+        activities = activities_collection.collection
+        aggregate = activities.aggregate
+
+        def aggregate_then_write(pipeline, **kwargs):
+            result = aggregate(pipeline, **kwargs)
+            rollups.record_activity_changes(added=[activity])
+            return result
+
+        monkeypatch.setattr(activities, 'aggregate', aggregate_then_write)
+        assert rollups.rebuild() == 1
+        assert rollups.user_stats(user_id)['totals']['calories'] == 40
+
+class EndpointBenchmarkTests:
+    """Test cases for the endpoint benchmark harness"""
+
+    def test_every_route_and_baseline_check(self, tmp_path):
+        """Test that every scenario runs and that a slower run fails against its baseline"""
+        from io import StringIO
+        from django.core.management import CommandError, call_command
+        output = tmp_path / 'baseline.json'
+        options = dict(scales='200', requests=2, rounds=1, warmup=0, stdout=StringIO())
+        call_command('benchmark_endpoints', output=str(output), **options)
+        baseline = json.loads(output.read_text())
+        endpoints = baseline['scales']['200']['endpoints']
+        assert 'user-detail DELETE delete' in endpoints and 'activity-bulk POST create' in endpoints
+        for metrics in endpoints.values():
+            metrics.update(p50_ms=metrics['p50_ms'] / 100, throughput=metrics['throughput'] * 100)
+        output.write_text(json.dumps(baseline))
+        with pytest.raises(CommandError, match='regression'):
+            call_command('benchmark_endpoints', baseline=str(output), routes='api-root', min_delta_ms=0, **options)
+
+
+class RequestTimingTests:
+    """Test cases for the per-request timings middleware and command listener"""
+
+    def test_server_timing_and_log_line(self, memory_store, caplog):
+        """Test that timed requests get a Server-Timing header and a log line, and untimed ones neither"""
+        import asyncio
+        import logging
+        import re
+        from django.test import AsyncClient, override_settings
+        client = APIClient()
+        client.post('/api/users/', {'username': 'timed', 'email': 'timed@example.com', 'password': 'password123'}, format='json')
+        assert 'Server-Timing' not in client.get('/api/users/')
+
+        with override_settings(API_REQUEST_TIMING=True), caplog.at_level(logging.INFO, 'octofit_tracker.instrumentation'):
+            response = APIClient().get('/api/users/')
+            assert response.status_code == status.HTTP_200_OK
+            metrics = re.findall(r'(?:^|, )([\w-]+);', response['Server-Timing'])
+            assert metrics == ['db', 'db-max', 'serialize', 'render', 'total']
+            assert '0 commands' in response['Server-Timing']
+            record = caplog.records[-1]
+            assert 'path=/api/users/' in record.getMessage()
+            assert record.timings['status'] == 200 and record.timings['serialize_ms'] >= 0
+
+            response = asyncio.run(AsyncClient().get('/api/async/users/'))
+            assert response.status_code == status.HTTP_200_OK
+            assert response['Server-Timing'].startswith('db;')
+
+    def test_command_listener(self):
+        """Test that the listener adds commands only to the request being timed"""
+        from types import SimpleNamespace
+        from octofit_tracker import instrumentation
+        listener = instrumentation.command_listener
+        find = SimpleNamespace(duration_micros=1500, reply={'cursor': {'firstBatch': [{}, {}, {}], 'id': 0}})
+        listener.succeeded(find)
+
+        timings = instrumentation.RequestTimings()
+        token = instrumentation._current.set(timings)
+        try:
+            listener.succeeded(find)
+            listener.succeeded(SimpleNamespace(duration_micros=500, reply={'cursor': {'nextBatch': [{}], 'id': 0}}))
+            listener.failed(SimpleNamespace(duration_micros=4000))
+            with instrumentation.measure('serialize'):
+                pass
+        finally:
+            instrumentation._current.reset(token)
+        assert (timings.db_commands, timings.db_documents) == (3, 4)
+        assert timings.db_seconds == pytest.approx(0.006)
+        assert timings.db_max_seconds == pytest.approx(0.004)
+        assert timings.phases['serialize'] > 0
+        assert 'db;dur=6.000;desc="3 commands, 4 documents"' in timings.server_timing(0.01)
+        assert instrumentation.measure('serialize') is instrumentation.measure('render')
+
+
+class MetricsTests:
+    """Test cases for the Prometheus metrics on /metrics"""
+
+    def test_request_and_cache_metrics(self, memory_store):
+        """Test that requests, latencies and cache lookups are exposed per route, and only when enabled"""
+        from django.test import override_settings
+        from octofit_tracker.metrics import registry
+        registry.reset()
+        assert APIClient().get('/metrics').status_code == status.HTTP_404_NOT_FOUND
+        with override_settings(API_METRICS=True):
+            client = APIClient()
+            client.post('/api/users/', {'username': 'scraped', 'email': 'scraped@example.com', 'password': 'password123'}, format='json')
+            client.get('/api/users/')
+            client.get('/api/users/')
+            response = client.get('/metrics')
+            assert response.status_code == status.HTTP_200_OK
+            assert response['Content-Type'].startswith('text/plain; version=0.0.4')
+            lines = response.content.decode().splitlines()
+            assert 'octofit_http_requests_total{route="user-list",method="GET",status="200"} 2.0' in lines
+            assert 'octofit_http_request_duration_seconds_count{route="user-list",method="POST"} 1.0' in lines
+            assert 'octofit_http_request_duration_seconds_bucket{route="user-list",method="GET",le="+Inf"} 2.0' in lines
+            assert 'octofit_cache_lookups_total{resource="users",result="hit"} 1.0' in lines
+            assert 'octofit_cache_lookups_total{resource="users",result="miss"} 1.0' in lines
+            assert '# TYPE octofit_mongodb_pool_checkout_wait_seconds histogram' in lines
+            assert client.post('/metrics').status_code == status.HTTP_405_METHOD_NOT_ALLOWED
+
+    def test_unknown_methods_share_a_label(self, memory_store):
+        """Test that request methods outside the standard ones are counted as 'other'"""
+        from django.test import override_settings
+        from octofit_tracker.metrics import registry
+        registry.reset()
+        with override_settings(API_METRICS=True):
+            client = APIClient()
+            for method in ('FOO', 'BAR'):
+                client.generic(method, '/api/users/')
+            lines = client.get('/metrics').content.decode().splitlines()
+        assert 'octofit_http_requests_total{route="user-list",method="other",status="405"} 2.0' in lines
+        assert 'octofit_http_requests_in_progress{method="other"} 0.0' in lines
+        assert not any('FOO' in line or 'BAR' in line for line in lines)
+
+    def test_multiprocess_aggregation(self, tmp_path):
+        """Test that multiprocess mode sums the files of all processes and drops exited gauges"""
+        import os
+        from django.test import override_settings
+        from octofit_tracker import metrics
+        with override_settings(API_METRICS_MULTIPROCESS_DIR=str(tmp_path)):
+            metrics.registry.reset()
+            try:
+                metrics.cache_lookups.labels('teams', 'hit').inc()
+                metrics.http_requests_in_progress.labels('GET').inc()
+                pid = os.fork()
+                if pid == 0:
+                    metrics.cache_lookups.labels('teams', 'hit').inc(2)
+                    metrics.http_requests_in_progress.labels('GET').inc(5)
+                    metrics.mongodb_pool_checkout_wait.labels().observe(0.002)
+                    os._exit(0)
+                os.waitpid(pid, 0)
+                assert sorted(name.split('_')[0] for name in os.listdir(tmp_path)) == ['live', 'live', 'total', 'total']
+                lines = metrics.registry.exposition().splitlines()
+            finally:
+                metrics.registry.reset()
+        assert 'octofit_cache_lookups_total{resource="teams",result="hit"} 3.0' in lines
+        assert 'octofit_http_requests_in_progress{method="GET"} 1.0' in lines
+        assert 'octofit_mongodb_pool_checkout_wait_seconds_bucket{le="0.001"} 0.0' in lines
+        assert 'octofit_mongodb_pool_checkout_wait_seconds_bucket{le="0.005"} 1.0' in lines
+        assert 'octofit_mongodb_pool_checkout_wait_seconds_count 1.0' in lines
+
+    def test_mmap_file_grows(self, tmp_path):
+        """Test that a metrics file keeps its values when it outgrows its initial size"""
+        from octofit_tracker.metrics import MmapFile, read_file
+        file = MmapFile(str(tmp_path / 'total_1.db'))
+        for index in range(3000):
+            file.write(file.position(f'key{index}'), index)
+        entries = dict(read_file(str(tmp_path / 'total_1.db')))
+        assert len(entries) == 3000 and entries['key2999'] == 2999.0
+        assert MmapFile(str(tmp_path / 'total_1.db')).position('key10') == file.position('key10')
+
+
+class ProfilingTests:
+    """Test cases for on-demand request profiling"""
+
+    def test_profiled_request(self, memory_store, tmp_path):
+        """Test that authorized requests are profiled, within the rate limit, and others are not"""
+        from django.test import override_settings
+        from octofit_tracker import profiling
+        client = APIClient()
+        client.post('/api/users/', {'username': 'profiled', 'email': 'profiled@example.com', 'password': 'password123'}, format='json')
+        assert 'X-Profile-Skipped' not in client.get('/api/users/?profile=secret')
+
+        profiling.rate_limiter.reset()
+        with override_settings(API_PROFILING=True, API_PROFILING_TOKEN='secret', API_PROFILING_INTERVAL=0.0001,
+                               API_PROFILING_MAX_PER_MINUTE=2):
+            response = client.get('/api/users/?profile=secret')
+            assert response.status_code == status.HTTP_200_OK
+            report = response.json()
+            assert (report['path'], report['status'], report['mode']) == ('/api/users/', 200, 'sample')
+            counts = []
+            for line in report['collapsed'].splitlines():
+                stack, count = line.rsplit(' ', 1)
+                assert stack.startswith('_dispatch_and_render (profiling.py:')
+                counts.append(int(count))
+            assert report['samples'] == sum(counts)
+            assert len(report['top']) <= 25
+
+            response = client.get('/api/users/', HTTP_X_OCTOFIT_PROFILE='wrong')
+            assert response['X-Profile-Skipped'] == 'forbidden' and isinstance(response.json(), list)
+
+            with override_settings(API_PROFILING_MODE='cprofile', API_PROFILING_OUTPUT_DIR=str(tmp_path)):
+                response = client.get('/api/activities/', HTTP_X_OCTOFIT_PROFILE='secret')
+            assert response.status_code == status.HTTP_200_OK
+            profile_id = response['X-Profile-Id']
+            report = json.loads((tmp_path / f'{profile_id}.json').read_text())
+            assert report['mode'] == 'cprofile' and 'collapsed' not in report
+            assert any(row['function'].startswith('get (views.py:') for row in report['top'])
+            assert (tmp_path / f'{profile_id}.collapsed').exists()
+
+            response = client.get('/api/users/?profile=secret')
+            assert response['X-Profile-Skipped'] == 'rate-limited' and isinstance(response.json(), list)
+        profiling.rate_limiter.reset()
+
+    def test_rate_limiter_refills(self, monkeypatch):
+        """Test that the rate limiter allows a burst and refills over time"""
+        from octofit_tracker import profiling
+        now = [1000.0]
+        monkeypatch.setattr(profiling.time, 'monotonic', lambda: now[0])
+        limiter = profiling.RateLimiter()
+        assert [limiter.acquire(3) for _ in range(4)] == [True, True, True, False]
+        now[0] += 20
+        assert [limiter.acquire(3) for _ in range(2)] == [True, False]
+
+
+class WriteBehindTests:
+    """Test cases for write-behind activity ingestion"""
+
+    def test_batches_and_backpressure(self, memory_store):
+        """Test that queued activities are written in batches, refused when full and flushed on close"""
+        from django.test import override_settings
+        from octofit_tracker.memory import MemoryDatabase
+        from octofit_tracker.writebehind import BufferFull, WriteBehindBuffer, WriteFailed
+        collection = MemoryDatabase('test').activities
+        user_id = ObjectId()
+        with override_settings(ACTIVITY_WRITE_BEHIND_BATCH_SIZE=2, ACTIVITY_WRITE_BEHIND_FLUSH_MS=10000):
+            buffer = WriteBehindBuffer(collection)
+            duplicate_id = ObjectId()
+            first = buffer.enqueue({'_id': duplicate_id, 'user_id': user_id, 'calories': 10})
+            second = buffer.enqueue({'_id': duplicate_id, 'user_id': user_id, 'calories': 20})
+            # A full batch is written without waiting for the flush interval
+            assert first.wait(5)
+            with pytest.raises(WriteFailed):
+                second.wait(5)
+            buffer.close()
+        assert buffer.stats() == {'queued': 0, 'written': 1, 'failed': 1}
+        with pytest.raises(BufferFull):
+            buffer.enqueue({'user_id': user_id})
+
+        with override_settings(ACTIVITY_WRITE_BEHIND_FLUSH_MS=10000, ACTIVITY_WRITE_BEHIND_MAX_QUEUE=3):
+            buffer = WriteBehindBuffer(collection)
+            queued = [buffer.enqueue({'user_id': user_id, 'calories': 5}) for _ in range(3)]
+            with pytest.raises(BufferFull):
+                buffer.enqueue({'user_id': user_id, 'calories': 5})
+            assert not queued[0].wait(0)
+            buffer.close()
+        assert all(pending.wait(0) for pending in queued)
+        assert collection.count_documents({}) == 4
+
+    def test_flusher_wakes_after_draining(self, memory_store):
+        """Test that a document queued after the flusher drained the queue is written on time"""
+        import time
+        from django.test import override_settings
+        from octofit_tracker.memory import MemoryDatabase
+        from octofit_tracker.writebehind import WriteBehindBuffer
+        collection = MemoryDatabase('test').activities
+        with override_settings(ACTIVITY_WRITE_BEHIND_FLUSH_MS=20):
+            buffer = WriteBehindBuffer(collection)
+            try:
+                for calories in (10, 20, 30):
+                    assert buffer.enqueue({'user_id': ObjectId(), 'calories': calories}).wait(2)
+                    # Let the flusher go back to sleep on the empty queue
+                    time.sleep(0.05)
+            finally:
+                buffer.close()
+        assert buffer.stats() == {'queued': 0, 'written': 3, 'failed': 0}
+
+    def test_activity_post(self, memory_store):
+        """Test that write-behind POSTs answer by the ack mode and 503 when the queue is full"""
+        from django.test import override_settings
+        from octofit_tracker.models import activities_collection
+        from octofit_tracker.writebehind import activity_buffer
+        client = APIClient()
+        data = {'user_id': str(ObjectId()), 'activity_type': 'Running', 'duration': 30, 'calories': 300}
+        with override_settings(ACTIVITY_WRITE_BEHIND=True, ACTIVITY_WRITE_BEHIND_FLUSH_MS=1):
+            with override_settings(ACTIVITY_WRITE_BEHIND_ACK='flush'):
+                response = client.post('/api/activities/', data, format='json')
+                assert response.status_code == status.HTTP_201_CREATED
+                assert activities_collection.find_one({'_id': ObjectId(response.json()['_id'])})['calories'] == 300
+
+            with override_settings(ACTIVITY_WRITE_BEHIND_MAX_QUEUE=0, ACTIVITY_WRITE_BEHIND_RETRY_AFTER=2):
+                response = client.post('/api/activities/', data, format='json')
+                assert response.status_code == status.HTTP_503_SERVICE_UNAVAILABLE
+                assert response['Retry-After'] == '2'
+
+            response = client.post('/api/activities/', data, format='json')
+            assert response.status_code == status.HTTP_202_ACCEPTED
+            queued_id = ObjectId(response.json()['_id'])
+            assert client.post('/api/activities/', {'duration': -1}, format='json').status_code == status.HTTP_400_BAD_REQUEST
+            activity_buffer.flush()
+        assert activities_collection.count_documents({}) == 2
+        assert activities_collection.find_one({'_id': queued_id}) is not None
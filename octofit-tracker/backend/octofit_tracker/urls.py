@@ -1,22 +1,43 @@
 from django.contrib import admin
 from django.urls import path, include
 from rest_framework.urlpatterns import format_suffix_patterns
-from . import views
+from . import async_views, views
 
 urlpatterns = [
     path('admin/', admin.site.urls),
     path('', views.api_root, name='api-root'),  # Root API endpoint
+    path('api/cache/stats/', views.cache_stats, name='cache-stats'),
     path('api/users/', views.UserViewSet.as_view(), name='user-list'),
+    path('api/users/batch/', views.UserBatchView.as_view(), name='user-batch'),
     path('api/users/<str:user_id>/', views.UserViewSet.as_view(), name='user-detail'),
+    path('api/users/<str:user_id>/stats/', views.UserStatsView.as_view(), name='user-stats'),
     path('api/teams/', views.TeamViewSet.as_view(), name='team-list'),
+    path('api/teams/batch/', views.TeamBatchView.as_view(), name='team-batch'),
     path('api/teams/<str:team_id>/', views.TeamViewSet.as_view(), name='team-detail'),
     path('api/activities/', views.ActivityViewSet.as_view(), name='activity-list'),
+    path('api/activities/bulk/', views.ActivityBulkView.as_view(), name='activity-bulk'),
+    path('api/activities/export/', views.ActivityExportView.as_view(), name='activity-export'),
     path('api/activities/<str:activity_id>/', views.ActivityViewSet.as_view(), name='activity-detail'),
     path('api/leaderboard/', views.LeaderboardViewSet.as_view(), name='leaderboard-list'),
     path('api/leaderboard/<str:entry_id>/', views.LeaderboardViewSet.as_view(), name='leaderboard-detail'),
     path('api/workouts/', views.WorkoutViewSet.as_view(), name='workout-list'),
+    path('api/workouts/batch/', views.WorkoutBatchView.as_view(), name='workout-batch'),
     path('api/workouts/<str:workout_id>/', views.WorkoutViewSet.as_view(), name='workout-detail'),
+    # Native async views of the same resources, for ASGI workers
+    path('api/async/users/', async_views.users.as_view(), name='async-user-list'),
+    path('api/async/users/<str:user_id>/', async_views.users.as_view(), name='async-user-detail'),
+    path('api/async/teams/', async_views.teams.as_view(), name='async-team-list'),
+    path('api/async/teams/<str:team_id>/', async_views.teams.as_view(), name='async-team-detail'),
+    path('api/async/activities/', async_views.activities.as_view(), name='async-activity-list'),
+    path('api/async/activities/<str:activity_id>/', async_views.activities.as_view(), name='async-activity-detail'),
+    path('api/async/leaderboard/', async_views.leaderboard_entries.as_view(), name='async-leaderboard-list'),
+    path('api/async/leaderboard/<str:entry_id>/', async_views.leaderboard_entries.as_view(), name='async-leaderboard-detail'),
+    path('api/async/workouts/', async_views.workouts.as_view(), name='async-workout-list'),
+    path('api/async/workouts/<str:workout_id>/', async_views.workouts.as_view(), name='async-workout-detail'),
 ]
 
 # Add format suffix patterns for API responses
-urlpatterns = format_suffix_patterns(urlpatterns)
\ No newline at end of file
+urlpatterns = format_suffix_patterns(urlpatterns)
+
+# Where Prometheus scrapes by default; plain text only, so no format suffixes
+urlpatterns.append(path('metrics', views.prometheus_metrics, name='metrics'))
\ No newline at end of file
@@ -1,20 +1,40 @@
-from rest_framework import status
+from rest_framework import serializers, status
 from rest_framework.decorators import api_view
 from rest_framework.response import Response
-from rest_framework.views import APIView
 from bson import ObjectId
 from bson.errors import InvalidId
+from pymongo import ASCENDING, DESCENDING, ReturnDocument
+from pymongo.errors import BulkWriteError, DuplicateKeyError
+from datetime import datetime, time
+from django.conf import settings
+from django.http import Http404, HttpResponse, StreamingHttpResponse
+from django.utils.dateparse import parse_date, parse_datetime
+from django.views.decorators.http import require_GET
+from rest_framework.exceptions import ParseError, PermissionDenied
 
 from .models import (
     User, Team, Activity, Leaderboard, Workout,
     users_collection, teams_collection, activities_collection, 
     leaderboard_collection, workouts_collection
 )
+from . import batch, conditional, expand, leaderboard, metrics, rollups, writebehind
+from .cache import cached_response, response_cache
+from .pagination import KeysetPagination
+from .parsers import FastJSONParser, NDJSONParser
+from .profiling import ProfiledAPIView, staff_or_token
+from .renderers import CSVRenderer, NDJSONRenderer
 from .serializers import (
     UserSerializer, TeamSerializer, ActivitySerializer,
     LeaderboardSerializer, WorkoutSerializer
 )
 
+# Activities are listed newest first
+ACTIVITY_ORDERING = (('date', DESCENDING), ('_id', DESCENDING))
+# Exports are written oldest first
+ACTIVITY_EXPORT_ORDERING = (('date', ASCENDING), ('_id', ASCENDING))
+# Order of the in-memory leaderboard rankings, best first
+RANKING_ORDERING = (('score', DESCENDING), ('user_id', ASCENDING))
+
 @api_view(['GET'])
 def api_root(request, format=None):
     """
@@ -30,272 +50,554 @@ def api_root(request, format=None):
         'workouts': f"{base_url}/api/workouts/"
     })
 
-class UserViewSet(APIView):
+@api_view(['GET'])
+def cache_stats(request, format=None):
+    """
+    Hit/miss counters of this worker process's response cache, for staff
+    users and requests carrying API_CACHE_STATS_TOKEN
+    """
+    token = request.headers.get(getattr(settings, 'API_CACHE_STATS_HEADER', 'X-Octofit-Cache-Stats'))
+    if not staff_or_token(request, token, getattr(settings, 'API_CACHE_STATS_TOKEN', None)):
+        raise PermissionDenied()
+    return Response(response_cache.stats())
+
+@require_GET
+def prometheus_metrics(request):
+    """
+    Metrics in the Prometheus text format, of this worker process or, in
+    multiprocess mode, of all of them
+    """
+    if not metrics.enabled():
+        raise Http404
+    return HttpResponse(metrics.registry.exposition(), content_type=metrics.CONTENT_TYPE)
+
+class UserViewSet(ProfiledAPIView):
+    @cached_response('users', 'user_id')
     def get(self, request, user_id=None):
+        fields = UserSerializer.fields_from_request(request)
+        projection = conditional.with_validator_fields(UserSerializer.get_projection(fields))
         if user_id:
             try:
-                user_data = users_collection.find_one({"_id": ObjectId(user_id)})
+                user_data = users_collection.find_one({"_id": ObjectId(user_id)}, projection)
                 if user_data:
-                    user = User.from_mongo(user_data)
-                    serializer = UserSerializer(user)
-                    return Response(serializer.data)
+                    etag, modified = conditional.validators([user_data], fields)
+                    response = conditional.not_modified(request, etag, modified)
+                    if response is None:
+                        response = Response(UserSerializer.represent(user_data, fields))
+                    return conditional.set_validators(response, etag, modified)
                 return Response({"detail": "User not found"}, status=status.HTTP_404_NOT_FOUND)
             except InvalidId:
                 return Response({"detail": "Invalid ID format"}, status=status.HTTP_400_BAD_REQUEST)
+        elif 'ids' in request.query_params:
+            return batch.get_response(request, users_collection, UserSerializer, batch.ids_from_query(request))
         else:
-            users_data = list(users_collection.find())
-            users = [User.from_mongo(user_data) for user_data in users_data]
-            serializer = UserSerializer(users, many=True)
-            return Response(serializer.data)
+            paginator = KeysetPagination()
+            users_data = paginator.paginate_collection(users_collection, request, projection=projection)
+            etag, modified = conditional.validators(users_data, fields, next_cursor=paginator.next_cursor)
+            response = conditional.not_modified(request, etag, modified)
+            if response is None:
+                response = paginator.get_paginated_response(UserSerializer.represent_many(users_data, fields))
+            return conditional.set_validators(response, etag, modified)
 
     def post(self, request):
         serializer = UserSerializer(data=request.data)
         if serializer.is_valid():
             user = serializer.create(serializer.validated_data)
-            users_collection.insert_one(user.to_mongo())
+            user.updated_at = conditional.now()
+            try:
+                users_collection.insert_one(user.to_mongo())
+            except DuplicateKeyError:
+                return Response({"detail": "Username or email already in use"}, status=status.HTTP_400_BAD_REQUEST)
+            response_cache.invalidate('users')
             return Response(serializer.data, status=status.HTTP_201_CREATED)
         return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
 
     def put(self, request, user_id):
         try:
-            user_data = users_collection.find_one({"_id": ObjectId(user_id)})
-            if not user_data:
-                return Response({"detail": "User not found"}, status=status.HTTP_404_NOT_FOUND)
-            
-            user = User.from_mongo(user_data)
-            serializer = UserSerializer(user, data=request.data, partial=True)
-            if serializer.is_valid():
-                updated_user = serializer.update(user, serializer.validated_data)
-                users_collection.update_one(
-                    {"_id": ObjectId(user_id)},
-                    {"$set": updated_user.to_mongo()}
-                )
-                return Response(serializer.data)
-            return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+            object_id = ObjectId(user_id)
         except InvalidId:
             return Response({"detail": "Invalid ID format"}, status=status.HTTP_400_BAD_REQUEST)
+        serializer = UserSerializer(data=request.data, partial=True)
+        if not serializer.is_valid():
+            return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+        try:
+            user_data = conditional.update_document(
+                users_collection, object_id, serializer.validated_data, conditional.expected_versions(request)
+            )
+        except DuplicateKeyError:
+            return Response({"detail": "Username or email already in use"}, status=status.HTTP_400_BAD_REQUEST)
+        if not user_data:
+            return Response({"detail": "User not found"}, status=status.HTTP_404_NOT_FOUND)
+        response_cache.invalidate('users', user_id)
+        response = Response(UserSerializer.represent(user_data))
+        return conditional.set_validators(response, *conditional.validators([user_data]))
 
     def delete(self, request, user_id):
         try:
             result = users_collection.delete_one({"_id": ObjectId(user_id)})
             if result.deleted_count:
+                response_cache.invalidate('users', user_id)
                 return Response(status=status.HTTP_204_NO_CONTENT)
             return Response({"detail": "User not found"}, status=status.HTTP_404_NOT_FOUND)
         except InvalidId:
             return Response({"detail": "Invalid ID format"}, status=status.HTTP_400_BAD_REQUEST)
 
-class TeamViewSet(APIView):
+class UserStatsView(ProfiledAPIView):
+    """
+    A user's activity totals per day, week or month
+    (?granularity=day|week|month&from=&to=), read from the daily rollups
+    """
+    date_field = serializers.DateTimeField()
+
+    def get(self, request, user_id):
+        try:
+            object_id = ObjectId(user_id)
+        except InvalidId:
+            return Response({"detail": "Invalid ID format"}, status=status.HTTP_400_BAD_REQUEST)
+        granularity = request.query_params.get('granularity', 'day')
+        if granularity not in rollups.GRANULARITIES:
+            return Response({"detail": f"Invalid granularity; use one of: {', '.join(rollups.GRANULARITIES)}"},
+                            status=status.HTTP_400_BAD_REQUEST)
+        start, end = (
+            rollups.as_utc(ActivityExportView.parse_date_param(param, request.query_params[param]))
+            if request.query_params.get(param) else None
+            for param in ('from', 'to')
+        )
+        if start is not None and end is not None and start >= end:
+            return Response({"detail": "from must be before to"}, status=status.HTTP_400_BAD_REQUEST)
+        if not users_collection.find_one({"_id": object_id}, {"_id": 1}):
+            return Response({"detail": "User not found"}, status=status.HTTP_404_NOT_FOUND)
+
+        stats = rollups.user_stats(object_id, granularity, start, end)
+        for name in ('from', 'to'):
+            if stats[name] is not None:
+                stats[name] = self.date_field.to_representation(stats[name])
+        for bucket in stats['buckets']:
+            bucket['start'] = self.date_field.to_representation(bucket['start'])
+        return Response(dict(user_id=user_id, **stats))
+
+class BatchGetView(ProfiledAPIView):
+    """
+    POST {"ids": [...]} to fetch many documents by id, for id lists too long
+    for the ?ids= parameter of the list endpoints
+    """
+    collection = None
+    serializer_class = None
+
+    def post(self, request):
+        return batch.get_response(request, self.collection, self.serializer_class, batch.ids_from_body(request))
+
+class TeamViewSet(ProfiledAPIView):
+    @cached_response('teams', 'team_id', uncached_params=('expand',))
     def get(self, request, team_id=None):
+        fields = TeamSerializer.fields_from_request(request)
+        expansions = expand.from_request(request, expand.TEAM_EXPANSIONS)
+        projection = conditional.with_validator_fields(
+            expand.with_reference_fields(TeamSerializer.get_projection(fields), expansions)
+        )
         if team_id:
             try:
-                team_data = teams_collection.find_one({"_id": ObjectId(team_id)})
+                team_data = teams_collection.find_one({"_id": ObjectId(team_id)}, projection)
                 if team_data:
-                    team = Team.from_mongo(team_data)
-                    serializer = TeamSerializer(team)
-                    return Response(serializer.data)
+                    fetched = expand.fetch([team_data], expansions)
+                    etag, modified = conditional.validators([team_data], fields, expand.related(fetched))
+                    response = conditional.not_modified(request, etag, modified)
+                    if response is None:
+                        data = TeamSerializer.represent(team_data, fields)
+                        response = Response(expand.embed([team_data], data, fetched))
+                    return conditional.set_validators(response, etag, modified)
                 return Response({"detail": "Team not found"}, status=status.HTTP_404_NOT_FOUND)
             except InvalidId:
                 return Response({"detail": "Invalid ID format"}, status=status.HTTP_400_BAD_REQUEST)
+        elif 'ids' in request.query_params:
+            return batch.get_response(request, teams_collection, TeamSerializer, batch.ids_from_query(request))
         else:
-            teams_data = list(teams_collection.find())
-            teams = [Team.from_mongo(team_data) for team_data in teams_data]
-            serializer = TeamSerializer(teams, many=True)
-            return Response(serializer.data)
+            paginator = KeysetPagination()
+            teams_data = paginator.paginate_collection(teams_collection, request, projection=projection)
+            fetched = expand.fetch(teams_data, expansions)
+            etag, modified = conditional.validators(teams_data, fields, expand.related(fetched), paginator.next_cursor)
+            response = conditional.not_modified(request, etag, modified)
+            if response is None:
+                data = TeamSerializer.represent_many(teams_data, fields)
+                response = paginator.get_paginated_response(expand.embed(teams_data, data, fetched))
+            return conditional.set_validators(response, etag, modified)
 
     def post(self, request):
         serializer = TeamSerializer(data=request.data)
         if serializer.is_valid():
             team = serializer.create(serializer.validated_data)
+            team.updated_at = conditional.now()
             teams_collection.insert_one(team.to_mongo())
+            response_cache.invalidate('teams')
             return Response(serializer.data, status=status.HTTP_201_CREATED)
         return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
 
     def put(self, request, team_id):
         try:
-            team_data = teams_collection.find_one({"_id": ObjectId(team_id)})
-            if not team_data:
-                return Response({"detail": "Team not found"}, status=status.HTTP_404_NOT_FOUND)
-            
-            team = Team.from_mongo(team_data)
-            serializer = TeamSerializer(team, data=request.data, partial=True)
-            if serializer.is_valid():
-                updated_team = serializer.update(team, serializer.validated_data)
-                teams_collection.update_one(
-                    {"_id": ObjectId(team_id)},
-                    {"$set": updated_team.to_mongo()}
-                )
-                return Response(serializer.data)
-            return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+            object_id = ObjectId(team_id)
         except InvalidId:
             return Response({"detail": "Invalid ID format"}, status=status.HTTP_400_BAD_REQUEST)
+        serializer = TeamSerializer(data=request.data, partial=True)
+        if not serializer.is_valid():
+            return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+        team_data = conditional.update_document(
+            teams_collection, object_id, serializer.validated_data, conditional.expected_versions(request)
+        )
+        if not team_data:
+            return Response({"detail": "Team not found"}, status=status.HTTP_404_NOT_FOUND)
+        response_cache.invalidate('teams', team_id)
+        response = Response(TeamSerializer.represent(team_data))
+        return conditional.set_validators(response, *conditional.validators([team_data]))
 
     def delete(self, request, team_id):
         try:
             result = teams_collection.delete_one({"_id": ObjectId(team_id)})
             if result.deleted_count:
+                response_cache.invalidate('teams', team_id)
                 return Response(status=status.HTTP_204_NO_CONTENT)
             return Response({"detail": "Team not found"}, status=status.HTTP_404_NOT_FOUND)
         except InvalidId:
             return Response({"detail": "Invalid ID format"}, status=status.HTTP_400_BAD_REQUEST)
 
-class ActivityViewSet(APIView):
+class ActivityViewSet(ProfiledAPIView):
     def get(self, request, activity_id=None):
+        fields = ActivitySerializer.fields_from_request(request)
+        projection = ActivitySerializer.get_projection(fields)
         if activity_id:
             try:
-                activity_data = activities_collection.find_one({"_id": ObjectId(activity_id)})
+                activity_data = activities_collection.find_one({"_id": ObjectId(activity_id)}, projection)
                 if activity_data:
-                    activity = Activity.from_mongo(activity_data)
-                    serializer = ActivitySerializer(activity)
-                    return Response(serializer.data)
+                    return Response(ActivitySerializer.represent(activity_data, fields))
                 return Response({"detail": "Activity not found"}, status=status.HTTP_404_NOT_FOUND)
             except InvalidId:
                 return Response({"detail": "Invalid ID format"}, status=status.HTTP_400_BAD_REQUEST)
         else:
-            activities_data = list(activities_collection.find())
-            activities = [Activity.from_mongo(activity_data) for activity_data in activities_data]
-            serializer = ActivitySerializer(activities, many=True)
-            return Response(serializer.data)
+            paginator = KeysetPagination(ordering=ACTIVITY_ORDERING)
+            activities_data = paginator.paginate_collection(activities_collection, request, projection=projection)
+            return paginator.get_paginated_response(ActivitySerializer.represent_many(activities_data, fields))
 
     def post(self, request):
         serializer = ActivitySerializer(data=request.data)
         if serializer.is_valid():
             activity = serializer.create(serializer.validated_data)
-            activities_collection.insert_one(activity.to_mongo())
+            activity_doc = activity.to_mongo()
+            if writebehind.enabled():
+                return self.post_write_behind(activity_doc)
+            activities_collection.insert_one(activity_doc)
+            leaderboard.record_activity_changes(added=[activity_doc])
+            rollups.record_activity_changes(added=[activity_doc])
             return Response(serializer.data, status=status.HTTP_201_CREATED)
         return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
 
+    def post_write_behind(self, activity_doc):
+        """
+        Queue the activity for a batched insert_many. Answers 201 once it is
+        written, or 202 while it is still queued (see ACTIVITY_WRITE_BEHIND_ACK).
+        """
+        try:
+            pending = writebehind.activity_buffer.enqueue(activity_doc)
+        except writebehind.BufferFull as exc:
+            return Response(
+                {"detail": str(exc)}, status=status.HTTP_503_SERVICE_UNAVAILABLE,
+                headers={'Retry-After': str(getattr(settings, 'ACTIVITY_WRITE_BEHIND_RETRY_AFTER', 1))}
+            )
+        if getattr(settings, 'ACTIVITY_WRITE_BEHIND_ACK', 'enqueue') == 'flush':
+            try:
+                if pending.wait(getattr(settings, 'ACTIVITY_WRITE_BEHIND_ACK_TIMEOUT', 5)):
+                    return Response(ActivitySerializer.represent(activity_doc), status=status.HTTP_201_CREATED)
+            except writebehind.WriteFailed as exc:
+                return Response({"detail": f"Activity was not written: {exc}"}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+        # The document's _id is assigned already, so a queued activity has its id too
+        return Response(ActivitySerializer.represent(activity_doc), status=status.HTTP_202_ACCEPTED)
+
     def put(self, request, activity_id):
         try:
-            activity_data = activities_collection.find_one({"_id": ObjectId(activity_id)})
-            if not activity_data:
-                return Response({"detail": "Activity not found"}, status=status.HTTP_404_NOT_FOUND)
-            
-            activity = Activity.from_mongo(activity_data)
-            serializer = ActivitySerializer(activity, data=request.data, partial=True)
-            if serializer.is_valid():
-                updated_activity = serializer.update(activity, serializer.validated_data)
-                activities_collection.update_one(
-                    {"_id": ObjectId(activity_id)},
-                    {"$set": updated_activity.to_mongo()}
-                )
-                return Response(serializer.data)
-            return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+            object_id = ObjectId(activity_id)
         except InvalidId:
             return Response({"detail": "Invalid ID format"}, status=status.HTTP_400_BAD_REQUEST)
+        serializer = ActivitySerializer(data=request.data, partial=True)
+        if not serializer.is_valid():
+            return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+        # The pre-image is needed to move the activity's score on the
+        # leaderboard; the post-image is the pre-image with the $set applied
+        activity_data = conditional.update_document(
+            activities_collection, object_id, serializer.validated_data,
+            versioned=False, return_document=ReturnDocument.BEFORE
+        )
+        if not activity_data:
+            return Response({"detail": "Activity not found"}, status=status.HTTP_404_NOT_FOUND)
+        updated_doc = dict(activity_data, **serializer.validated_data)
+        leaderboard.record_activity_changes(removed=[activity_data], added=[updated_doc])
+        rollups.record_activity_changes(removed=[activity_data], added=[updated_doc])
+        return Response(ActivitySerializer.represent(updated_doc))
 
     def delete(self, request, activity_id):
         try:
-            result = activities_collection.delete_one({"_id": ObjectId(activity_id)})
-            if result.deleted_count:
+            # The deleted document is needed to take its score off the leaderboard
+            activity_data = activities_collection.find_one_and_delete({"_id": ObjectId(activity_id)})
+            if activity_data:
+                leaderboard.record_activity_changes(removed=[activity_data])
+                rollups.record_activity_changes(removed=[activity_data])
                 return Response(status=status.HTTP_204_NO_CONTENT)
             return Response({"detail": "Activity not found"}, status=status.HTTP_404_NOT_FOUND)
         except InvalidId:
             return Response({"detail": "Invalid ID format"}, status=status.HTTP_400_BAD_REQUEST)
 
-class LeaderboardViewSet(APIView):
+class ActivityBulkView(ProfiledAPIView):
+    """
+    Bulk activity upload. Takes a JSON array or NDJSON body, validates every
+    item in one pass and writes the valid ones with unordered insert_many.
+    """
+    parser_classes = [FastJSONParser, NDJSONParser]
+
+    def post(self, request):
+        serializer = ActivitySerializer(
+            data=request.data, many=True, allow_empty=False,
+            max_length=getattr(settings, 'ACTIVITY_BULK_MAX_ITEMS', 10000)
+        )
+        if not serializer.is_valid():
+            return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+
+        errors = list(serializer.item_errors)
+        documents = [Activity(**item).to_mongo() for item in serializer.validated_data]
+        indexes = serializer.valid_indexes
+        failed = set()
+        chunk_size = getattr(settings, 'ACTIVITY_BULK_CHUNK_SIZE', 1000)
+        for start in range(0, len(documents), chunk_size):
+            try:
+                activities_collection.insert_many(documents[start:start + chunk_size], ordered=False)
+            except BulkWriteError as exc:
+                for write_error in exc.details.get('writeErrors', []):
+                    position = start + write_error['index']
+                    failed.add(position)
+                    errors.append({'index': indexes[position], 'errors': {'detail': write_error.get('errmsg', '')}})
+
+        inserted = [doc for position, doc in enumerate(documents) if position not in failed]
+        leaderboard.record_activity_changes(added=inserted)
+        rollups.record_activity_changes(added=inserted)
+        inserted_ids = [str(doc['_id']) for doc in inserted]
+        errors.sort(key=lambda error: error['index'])
+        if not errors:
+            response_status = status.HTTP_201_CREATED
+        elif inserted_ids:
+            response_status = status.HTTP_207_MULTI_STATUS
+        else:
+            response_status = status.HTTP_400_BAD_REQUEST
+        return Response({
+            'inserted': len(inserted_ids),
+            'inserted_ids': inserted_ids,
+            'errors': errors,
+        }, status=response_status)
+
+class ActivityExportView(ProfiledAPIView):
+    """
+    Streams activities as NDJSON (default) or CSV (?format=csv or an Accept
+    header), optionally filtered by ?user_id=, ?since= and ?until=.
+
+    Documents are read from the cursor in batches and encoded one at a time,
+    so memory use does not grow with the size of the export.
+    """
+    renderer_classes = [NDJSONRenderer, CSVRenderer]
+
+    def get(self, request, format=None):
+        fields = ActivitySerializer.fields_from_request(request)
+        projection = ActivitySerializer.get_projection(fields)
+        query = self.get_query(request)
+        cursor = activities_collection.find(
+            query, projection,
+            sort=ACTIVITY_EXPORT_ORDERING,
+            batch_size=getattr(settings, 'ACTIVITY_EXPORT_BATCH_SIZE', 1000),
+        )
+        renderer = request.accepted_renderer
+        rows = self.iter_rows(cursor, fields)
+        if isinstance(renderer, CSVRenderer):
+            lines = renderer.iter_lines(rows, header=ActivitySerializer.representation_fields(fields))
+        else:
+            lines = renderer.iter_lines(rows)
+        response = StreamingHttpResponse(lines, content_type=f'{renderer.media_type}; charset={renderer.charset}')
+        response['Content-Disposition'] = f'attachment; filename="activities.{renderer.format}"'
+        return response
+
+    def iter_rows(self, cursor, fields):
+        represent = ActivitySerializer.representer(fields)
+        try:
+            for activity_data in cursor:
+                yield represent(activity_data)
+        finally:
+            # Also runs when the client disconnects and the response is closed early
+            if hasattr(cursor, 'close'):
+                cursor.close()
+
+    def get_query(self, request):
+        query = {}
+        user_id = request.query_params.get('user_id')
+        if user_id:
+            try:
+                query['user_id'] = ObjectId(user_id)
+            except InvalidId:
+                raise ParseError('Invalid user_id')
+        date_range = {}
+        for param, operator in (('since', '$gte'), ('until', '$lt')):
+            value = request.query_params.get(param)
+            if value:
+                date_range[operator] = self.parse_date_param(param, value)
+        if date_range:
+            query['date'] = date_range
+        return query
+
+    @staticmethod
+    def parse_date_param(param, value):
+        """Accept an ISO 8601 datetime or a plain date (midnight UTC)"""
+        try:
+            parsed = parse_datetime(value)
+            if parsed is None:
+                day = parse_date(value)
+                parsed = datetime.combine(day, time.min) if day else None
+        except ValueError:
+            parsed = None
+        if parsed is None:
+            raise ParseError(f'Invalid {param} date')
+        return parsed
+
+class LeaderboardViewSet(ProfiledAPIView):
+    """
+    Read-only: scores are computed from activities (see
+    octofit_tracker.leaderboard), so writes answer 405. Scores are corrected
+    by editing activities or with `manage.py reconcile_leaderboard --fix`.
+    """
     def get(self, request, entry_id=None):
+        fields = LeaderboardSerializer.fields_from_request(request)
+        expansions = expand.from_request(request, expand.LEADERBOARD_EXPANSIONS)
+        projection = expand.with_reference_fields(LeaderboardSerializer.get_projection(fields), expansions)
+        if projection is not None:
+            # Needed to look up the live rank
+            projection.update(score=1, category=1)
         if entry_id:
             try:
-                entry_data = leaderboard_collection.find_one({"_id": ObjectId(entry_id)})
+                entry_data = leaderboard_collection.find_one({"_id": ObjectId(entry_id)}, projection)
                 if entry_data:
-                    entry = Leaderboard.from_mongo(entry_data)
-                    serializer = LeaderboardSerializer(entry)
-                    return Response(serializer.data)
+                    entry_data = leaderboard.with_live_rank(entry_data)
+                    return Response(self.represent([entry_data], fields, expansions)[0])
                 return Response({"detail": "Leaderboard entry not found"}, status=status.HTTP_404_NOT_FOUND)
             except InvalidId:
                 return Response({"detail": "Invalid ID format"}, status=status.HTTP_400_BAD_REQUEST)
         else:
-            entries_data = list(leaderboard_collection.find())
-            entries = [Leaderboard.from_mongo(entry_data) for entry_data in entries_data]
-            serializer = LeaderboardSerializer(entries, many=True)
-            return Response(serializer.data)
+            category = request.query_params.get('category')
+            if request.query_params.get('around'):
+                return self.get_around(request, (category or leaderboard.OVERALL).upper(), fields, expansions)
+            if category:
+                return self.get_ranked(request, category.upper(), fields, expansions)
+            paginator = KeysetPagination()
+            entries_data = paginator.paginate_collection(leaderboard_collection, request, projection=projection)
+            entries_data = [leaderboard.with_live_rank(entry_data) for entry_data in entries_data]
+            return paginator.get_paginated_response(self.represent(entries_data, fields, expansions))
 
-    def post(self, request):
-        serializer = LeaderboardSerializer(data=request.data)
-        if serializer.is_valid():
-            entry = serializer.create(serializer.validated_data)
-            leaderboard_collection.insert_one(entry.to_mongo())
-            return Response(serializer.data, status=status.HTTP_201_CREATED)
-        return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+    def represent(self, entries_data, fields, expansions):
+        """Represent entries with the users of ?expand=user embedded"""
+        data = LeaderboardSerializer.represent_many(entries_data, fields)
+        return expand.embed(entries_data, data, expand.fetch(entries_data, expansions))
+
+    def get_ranked(self, request, category, fields, expansions):
+        """A category best first, from the in-memory ranking (?category=X&limit=N)"""
+        paginator = KeysetPagination(ordering=RANKING_ORDERING)
+        paginator.request = request
+        limit = paginator.get_limit(request)
+        cursor = request.query_params.get(paginator.cursor_query_param)
+        after = paginator.decode_cursor(cursor)[:2] if cursor else None
+        entries_data = leaderboard.rankings.page(category, limit + 1, after)
+        if len(entries_data) > limit:
+            entries_data = entries_data[:limit]
+            paginator.next_cursor = paginator.encode_cursor(entries_data[-1])
+        return paginator.get_paginated_response(self.represent(entries_data, fields, expansions))
 
-    def put(self, request, entry_id):
+    def get_around(self, request, category, fields, expansions):
+        """Entries ranked just above and below a user (?around=<user_id>&window=N)"""
         try:
-            entry_data = leaderboard_collection.find_one({"_id": ObjectId(entry_id)})
-            if not entry_data:
-                return Response({"detail": "Leaderboard entry not found"}, status=status.HTTP_404_NOT_FOUND)
-            
-            entry = Leaderboard.from_mongo(entry_data)
-            serializer = LeaderboardSerializer(entry, data=request.data, partial=True)
-            if serializer.is_valid():
-                updated_entry = serializer.update(entry, serializer.validated_data)
-                leaderboard_collection.update_one(
-                    {"_id": ObjectId(entry_id)},
-                    {"$set": updated_entry.to_mongo()}
-                )
-                return Response(serializer.data)
-            return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+            user_id = ObjectId(request.query_params['around'])
         except InvalidId:
             return Response({"detail": "Invalid ID format"}, status=status.HTTP_400_BAD_REQUEST)
-
-    def delete(self, request, entry_id):
         try:
-            result = leaderboard_collection.delete_one({"_id": ObjectId(entry_id)})
-            if result.deleted_count:
-                return Response(status=status.HTTP_204_NO_CONTENT)
+            window = min(int(request.query_params.get('window', 5)), 50)
+        except ValueError:
+            return Response({"detail": "Invalid window"}, status=status.HTTP_400_BAD_REQUEST)
+        entries_data = leaderboard.rankings.around(category, user_id, max(window, 0))
+        if entries_data is None:
             return Response({"detail": "Leaderboard entry not found"}, status=status.HTTP_404_NOT_FOUND)
-        except InvalidId:
-            return Response({"detail": "Invalid ID format"}, status=status.HTTP_400_BAD_REQUEST)
+        return Response(self.represent(entries_data, fields, expansions))
 
-class WorkoutViewSet(APIView):
+class WorkoutViewSet(ProfiledAPIView):
+    @cached_response('workouts', 'workout_id')
     def get(self, request, workout_id=None):
+        fields = WorkoutSerializer.fields_from_request(request)
+        projection = conditional.with_validator_fields(WorkoutSerializer.get_projection(fields))
         if workout_id:
             try:
-                workout_data = workouts_collection.find_one({"_id": ObjectId(workout_id)})
+                workout_data = workouts_collection.find_one({"_id": ObjectId(workout_id)}, projection)
                 if workout_data:
-                    workout = Workout.from_mongo(workout_data)
-                    serializer = WorkoutSerializer(workout)
-                    return Response(serializer.data)
+                    etag, modified = conditional.validators([workout_data], fields)
+                    response = conditional.not_modified(request, etag, modified)
+                    if response is None:
+                        response = Response(WorkoutSerializer.represent(workout_data, fields))
+                    return conditional.set_validators(response, etag, modified)
                 return Response({"detail": "Workout not found"}, status=status.HTTP_404_NOT_FOUND)
             except InvalidId:
                 return Response({"detail": "Invalid ID format"}, status=status.HTTP_400_BAD_REQUEST)
+        elif 'ids' in request.query_params:
+            return batch.get_response(request, workouts_collection, WorkoutSerializer, batch.ids_from_query(request))
         else:
-            workouts_data = list(workouts_collection.find())
-            workouts = [Workout.from_mongo(workout_data) for workout_data in workouts_data]
-            serializer = WorkoutSerializer(workouts, many=True)
-            return Response(serializer.data)
+            paginator = KeysetPagination()
+            workouts_data = paginator.paginate_collection(workouts_collection, request, projection=projection)
+            etag, modified = conditional.validators(workouts_data, fields, next_cursor=paginator.next_cursor)
+            response = conditional.not_modified(request, etag, modified)
+            if response is None:
+                response = paginator.get_paginated_response(WorkoutSerializer.represent_many(workouts_data, fields))
+            return conditional.set_validators(response, etag, modified)
 
     def post(self, request):
         serializer = WorkoutSerializer(data=request.data)
         if serializer.is_valid():
             workout = serializer.create(serializer.validated_data)
+            workout.updated_at = conditional.now()
             workouts_collection.insert_one(workout.to_mongo())
+            response_cache.invalidate('workouts')
             return Response(serializer.data, status=status.HTTP_201_CREATED)
         return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
 
     def put(self, request, workout_id):
         try:
-            workout_data = workouts_collection.find_one({"_id": ObjectId(workout_id)})
-            if not workout_data:
-                return Response({"detail": "Workout not found"}, status=status.HTTP_404_NOT_FOUND)
-            
-            workout = Workout.from_mongo(workout_data)
-            serializer = WorkoutSerializer(workout, data=request.data, partial=True)
-            if serializer.is_valid():
-                updated_workout = serializer.update(workout, serializer.validated_data)
-                workouts_collection.update_one(
-                    {"_id": ObjectId(workout_id)},
-                    {"$set": updated_workout.to_mongo()}
-                )
-                return Response(serializer.data)
-            return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+            object_id = ObjectId(workout_id)
         except InvalidId:
             return Response({"detail": "Invalid ID format"}, status=status.HTTP_400_BAD_REQUEST)
+        serializer = WorkoutSerializer(data=request.data, partial=True)
+        if not serializer.is_valid():
+            return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+        workout_data = conditional.update_document(
+            workouts_collection, object_id, serializer.validated_data, conditional.expected_versions(request)
+        )
+        if not workout_data:
+            return Response({"detail": "Workout not found"}, status=status.HTTP_404_NOT_FOUND)
+        response_cache.invalidate('workouts', workout_id)
+        response = Response(WorkoutSerializer.represent(workout_data))
+        return conditional.set_validators(response, *conditional.validators([workout_data]))
 
     def delete(self, request, workout_id):
         try:
             result = workouts_collection.delete_one({"_id": ObjectId(workout_id)})
             if result.deleted_count:
+                response_cache.invalidate('workouts', workout_id)
                 return Response(status=status.HTTP_204_NO_CONTENT)
             return Response({"detail": "Workout not found"}, status=status.HTTP_404_NOT_FOUND)
         except InvalidId:
-            return Response({"detail": "Invalid ID format"}, status=status.HTTP_400_BAD_REQUEST)
\ No newline at end of file
+            return Response({"detail": "Invalid ID format"}, status=status.HTTP_400_BAD_REQUEST)
+
+class UserBatchView(BatchGetView):
+    collection = users_collection
+    serializer_class = UserSerializer
+
+class TeamBatchView(BatchGetView):
+    collection = teams_collection
+    serializer_class = TeamSerializer
+
+class WorkoutBatchView(BatchGetView):
+    collection = workouts_collection
+    serializer_class = WorkoutSerializer
@@ -0,0 +1,187 @@
+import atexit
+import logging
+import os
+import threading
+import time
+from collections import deque
+
+from django.conf import settings
+from pymongo.errors import BulkWriteError
+
+from . import leaderboard, rollups
+from .models import activities_collection
+
+# Write-behind buffer for single activity POSTs (ACTIVITY_WRITE_BEHIND).
+# ActivityViewSet.post validates each activity in the request and enqueues its
+# document here instead of calling insert_one. A flusher thread writes the
+# queue with unordered insert_many calls of up to ACTIVITY_WRITE_BEHIND_BATCH_SIZE
+# documents, as soon as that many are queued or the oldest has waited
+# ACTIVITY_WRITE_BEHIND_FLUSH_MS, then updates the leaderboard and rollups for
+# the documents written.
+#
+# ACTIVITY_WRITE_BEHIND_ACK decides when the request is answered:
+#
+#     enqueue  once queued (202); a crash loses the queued documents
+#     flush    once written (201), or 202 after ACTIVITY_WRITE_BEHIND_ACK_TIMEOUT
+#              seconds if the write has not completed by then
+#
+# At most ACTIVITY_WRITE_BEHIND_MAX_QUEUE documents wait; beyond that enqueue()
+# raises BufferFull and the view answers 503 with a Retry-After header. The
+# queue is flushed at interpreter exit. A forked child starts with an empty
+# queue and its own flusher.
+
+logger = logging.getLogger(__name__)
+
+
+def get_setting(name, default):
+    return getattr(settings, name, default)
+
+
+def enabled():
+    return get_setting('ACTIVITY_WRITE_BEHIND', False)
+
+
+class BufferFull(Exception):
+    pass
+
+
+class WriteFailed(Exception):
+    pass
+
+
+class PendingWrite:
+    """A queued document, and whether and how its write completed"""
+    __slots__ = ('document', 'enqueued_at', 'done', 'error')
+
+    def __init__(self, document):
+        self.document = document
+        self.enqueued_at = time.monotonic()
+        self.done = threading.Event()
+        self.error = None
+
+    def wait(self, timeout):
+        """True once written, False if still pending after `timeout` seconds"""
+        if not self.done.wait(timeout):
+            return False
+        if self.error is not None:
+            raise WriteFailed(self.error)
+        return True
+
+
+class WriteBehindBuffer:
+    def __init__(self, collection):
+        self.collection = collection
+        self._init_state()
+
+    def _init_state(self):
+        self._condition = threading.Condition()
+        self._queue = deque()
+        self._thread = None
+        self._closed = False
+        self._written = 0
+        self._failed = 0
+
+    def after_fork_in_child(self):
+        # The parent's queue is the parent's to write
+        self._init_state()
+
+    def __len__(self):
+        return len(self._queue)
+
+    def stats(self):
+        return {'queued': len(self._queue), 'written': self._written, 'failed': self._failed}
+
+    def enqueue(self, document):
+        """Queue a document for writing and return its PendingWrite"""
+        pending = PendingWrite(document)
+        with self._condition:
+            if self._closed:
+                raise BufferFull('the write-behind buffer is closed')
+            if len(self._queue) >= get_setting('ACTIVITY_WRITE_BEHIND_MAX_QUEUE', 10000):
+                raise BufferFull('the write-behind buffer is full')
+            self._queue.append(pending)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='octofit-write-behind', daemon=True)
+                self._thread.start()
+            # The flusher sleeps without a timeout on an empty queue, and until
+            # the oldest document is due on a partial batch
+            if len(self._queue) == 1 or len(self._queue) >= get_setting('ACTIVITY_WRITE_BEHIND_BATCH_SIZE', 500):
+                self._condition.notify()
+        return pending
+
+    def _next_batch(self):
+        """Wait for a batch to be due and take it; an empty batch once closed and drained"""
+        batch_size = get_setting('ACTIVITY_WRITE_BEHIND_BATCH_SIZE', 500)
+        max_wait = get_setting('ACTIVITY_WRITE_BEHIND_FLUSH_MS', 50) / 1000
+        with self._condition:
+            while not self._closed:
+                if len(self._queue) >= batch_size:
+                    break
+                if self._queue:
+                    remaining = self._queue[0].enqueued_at + max_wait - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self._condition.wait(remaining)
+                else:
+                    self._condition.wait()
+            return [self._queue.popleft() for _ in range(min(batch_size, len(self._queue)))]
+
+    def _run(self):
+        while True:
+            batch = self._next_batch()
+            if not batch:
+                return
+            self.write(batch)
+
+    def write(self, batch):
+        """Insert a batch of PendingWrites and complete them"""
+        documents = [pending.document for pending in batch]
+        errors = {}
+        try:
+            self.collection.insert_many(documents, ordered=False)
+        except BulkWriteError as exc:
+            for write_error in exc.details.get('writeErrors', []):
+                errors[write_error['index']] = write_error.get('errmsg', '')
+        except Exception as exc:
+            logger.exception("Write-behind insert of %d activities failed", len(batch))
+            errors = dict.fromkeys(range(len(batch)), str(exc))
+        inserted = [document for index, document in enumerate(documents) if index not in errors]
+        if inserted:
+            leaderboard.record_activity_changes(added=inserted)
+            rollups.record_activity_changes(added=inserted)
+        with self._condition:
+            self._written += len(inserted)
+            self._failed += len(errors)
+        for index, pending in enumerate(batch):
+            pending.error = errors.get(index)
+            pending.done.set()
+
+    def flush(self):
+        """Write everything queued now, in the calling thread"""
+        batch_size = get_setting('ACTIVITY_WRITE_BEHIND_BATCH_SIZE', 500)
+        while True:
+            with self._condition:
+                batch = [self._queue.popleft() for _ in range(min(batch_size, len(self._queue)))]
+            if not batch:
+                return
+            self.write(batch)
+
+    def close(self, timeout=None):
+        """Stop taking documents and wait for the queued ones to be written"""
+        with self._condition:
+            self._closed = True
+            self._condition.notify()
+            thread = self._thread
+        if thread is not None and thread.is_alive():
+            thread.join(timeout)
+        # Nothing is left unless the flusher was never started or timed out
+        self.flush()
+
+
+# Write-behind buffer of the current process
+activity_buffer = WriteBehindBuffer(activities_collection)
+
+atexit.register(activity_buffer.close)
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=activity_buffer.after_fork_in_child)